@@ -1,26 +1,62 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file
+import json
 from flask_cors import CORS
 import requests
 from datetime import datetime
 import os
-import json
 import time
-from config import supabase, WEBHOOK_VERIFY_TOKEN, get_page_config
+import queue
+import threading
+import atexit
+import hmac
+import hashlib
+import signal
+import asyncio
+from config import (supabase, get_async_supabase, WEBHOOK_VERIFY_TOKEN, FB_APP_SECRET, get_page_config, get_page_weight, get_pages,
+                    reload_pages, PAGES_FILE)
+from ingest import IngestPool, AsyncIngestPool
+from dedup import DedupStore
+from name_cache import NameCache, is_real_name
+from cache import get_cache, cache_stats, CACHE_WARM_INTERVAL
+from graph_client import graph, async_graph
+import messenger
+from job_store import JobStore
+from journal import EventJournal, JournalSyncError, event_mid
+from backfill import NameBackfill
+from attachments import AttachmentCache, spool_upload
+from media import MediaStore, MediaMirror
+from token_health import TokenValidator
+from metrics import registry as metrics_registry, HANDLE_MESSAGE_STAGE_SECONDS, HANDLE_MESSAGE_TOTAL
+from outbound import SendQueue, fan_out
+from conversations import ConversationIndex, iter_conversations, upsert_inbound_conversation
+from batcher import WriteBatcher
+from receipts import parse_receipt
+from unreplied import UnrepliedCounters, UNREPLIED_REBUILD_INTERVAL
+from events import EventBroadcaster
+from pagination import (PaginationError, parse_fields, parse_limit, paginate, changes_since,
+                        CONVERSATION_FIELDS, MESSAGE_FIELDS)
+from http_utils import conditional_json
+from log import get_logger, stats as log_stats
+
+log = get_logger('app')
 
 app = Flask(__name__)
 
-# Enable CORS for GitHub Pages
+# Enable CORS for GitHub Pages (asgi.py applies the same origins to its native routes)
+CORS_ORIGINS = [
+    "https://kaprukadm.github.io",
+    "http://localhost:3000",
+    "http://localhost:5000",
+    "http://127.0.0.1:5000"
+]
+CORS_EXPOSE_HEADERS = ["Content-Type", "ETag", "Content-Range", "Accept-Ranges"]
+
 CORS(app, resources={
     r"/api/*": {
-        "origins": [
-            "https://kaprukadm.github.io",
-            "http://localhost:3000",
-            "http://localhost:5000",
-            "http://127.0.0.1:5000"
-        ],
+        "origins": CORS_ORIGINS,
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "expose_headers": ["Content-Type"],
+        "allow_headers": ["Content-Type", "Authorization", "If-None-Match", "Last-Event-ID", "Range"],
+        "expose_headers": CORS_EXPOSE_HEADERS,
         "supports_credentials": False,
         "max_age": 3600
     }
@@ -36,11 +72,25 @@ def home():
             'webhook': '/webhook',
             'send_message': '/api/send',
             'send_image': '/api/send-image',
+            'send_attachment': '/api/send-attachment',
+            'send_status': '/api/send/<job_id>',
+            'send_bulk': '/api/send-bulk',
+            'media': '/api/media/<hash>',
+            'media_thumbnail': '/api/media/<hash>/thumb',
             'unreplied_counts': '/api/unreplied-counts',
+            'rebuild_unreplied_counts': '/api/unreplied-counts/rebuild',
             'conversations': '/api/conversations',
             'conversation': '/api/conversation/<id>',
+            'conversation_changes': '/api/conversations/changes?since=<cursor>',
+            'message_changes': '/api/conversation/<id>/messages?since=<cursor>',
             'backfill_names': '/api/backfill-names',
-            'health': '/health'
+            'job_status': '/api/jobs/<job_id>',
+            'events': '/api/events',
+            'health': '/health',
+            'ingest_health': '/health/ingest',
+            'token_health': '/health/tokens',
+            'metrics': '/metrics',
+            'reload_pages': '/api/admin/pages/reload'
         }
     })
 
@@ -49,6 +99,29 @@ def home():
 def health():
     return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
 
+# Ingest queue depth and lag
+@app.route('/health/ingest')
+def ingest_health():
+    return jsonify({'status': 'ok', 'ingest': ingest_pool.stats(), 'dedup': dedup_store.stats(),
+                    'name_cache': name_cache.stats(), 'known_conversations': known_conversations.stats(),
+                    'cache': cache_stats(), 'write_batcher': write_batcher.stats(),
+                    'events': broadcaster.stats(), 'send_queue': send_queue.stats(),
+                    'attachment_cache': attachment_cache.stats(), 'media_mirror': media_mirror.stats(),
+                    'async_ingest': async_ingest_pool.stats(), 'journal': journal.stats(),
+                    'graph': graph.stats(), 'logging': log_stats()})
+
+# Prometheus metrics, merged across gunicorn workers
+@app.route('/metrics')
+def metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Page token status (validated in the background, shared by workers)
+@app.route('/health/tokens')
+def token_health():
+    status = token_validator.status()
+    return jsonify({'status': 'ok' if status['healthy'] else 'degraded', 'pages': status['pages'],
+                    'validator': token_validator.stats()})
+
 # Webhook verification (GET)
 @app.route('/webhook', methods=['GET'])
 def verify_webhook():
@@ -58,7 +131,7 @@ def verify_webhook():
 
     if mode and token:
         if mode == 'subscribe' and token == WEBHOOK_VERIFY_TOKEN:
-            print('WEBHOOK_VERIFIED')
+            log.info('Webhook verified')
             return challenge, 200
         else:
             return 'Forbidden', 403
@@ -67,141 +140,450 @@ def verify_webhook():
 # Webhook receiver (POST)
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    body = request.get_json()
+    if not valid_webhook_signature(request.get_data(cache=True), request.headers.get('X-Hub-Signature-256')):
+        log.warning('Webhook signature mismatch', remote_addr=request.remote_addr)
+        return 'Forbidden', 403
+    body = request.get_json(silent=True) or {}
 
     if body.get('object') == 'page':
-        for entry in body.get('entry', []):
-            page_id = entry.get('id')
-
-            for messaging_event in entry.get('messaging', []):
-                handle_message(messaging_event, page_id)
+        # Acknowledge (and process, on the ingest pool) once the entries are journaled
+        try:
+            entries = accept_webhook_entries(body)
+        except JournalSyncError:
+            # Not durable - have Facebook redeliver
+            return 'Service Unavailable', 503
+        for entry in entries:
+            ingest_pool.submit(entry)
 
         return 'EVENT_RECEIVED', 200
     else:
         return 'Not Found', 404
 
-def handle_message(event, page_id):
-    """Process incoming Facebook message - UPDATED with Message ID name fetching"""
+def valid_webhook_signature(raw_body, signature):
+    """True if the X-Hub-Signature-256 header is the app secret's HMAC of the raw body (or no secret is set)"""
+    if not FB_APP_SECRET:
+        return True
+    expected = 'sha256=' + hmac.new(FB_APP_SECRET.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+def accept_webhook_entries(body):
+    """
+    Dedup and journal the entries of a webhook body, waiting for the fsync.
+
+    Returns:
+        list: the new entries, durable and ready to process
+
+    Raises:
+        JournalSyncError: not journaled - their message ids are forgotten (by the
+        dedup store and the journal) so Facebook's redelivery is processed
+    """
+    entries = list(new_webhook_entries(body))
+    mids = [event_mid(e) for entry in entries for e in entry['messaging'] if event_mid(e)]
     try:
-        sender_id = event['sender']['id']
-        page_config = get_page_config(page_id)
+        seq = 0
+        for entry in entries:
+            seq = journal.append(entry) or seq
+        if not journal.wait(seq):
+            raise JournalSyncError('journal fsync timed out')
+    except JournalSyncError:
+        journal.discard(mids)
+        for mid in mids:
+            dedup_store.forget(mid)
+        raise
+    return entries
 
-        if not page_config:
-            print(f'⚠️ Page {page_id} not configured')
-            return
+def new_webhook_entries(body):
+    """Entries of a webhook body with redelivered messages dropped (before any other work)"""
+    for entry in body.get('entry', []):
+        events = [e for e in entry.get('messaging', []) if not is_duplicate_event(e)]
+        if events:
+            yield dict(entry, messaging=events)
 
-        # Handle text messages and attachments
-        if event.get('message'):
-            message_id = event['message']['mid']
-            message_text = event['message'].get('text', '')
-            
-            # Check for attachments (images, videos, files, etc.)
-            attachments = event['message'].get('attachments', [])
-            message_type = 'text'
-            image_url = None
-            attachment_type = None
-            
-            if attachments:
-                for attachment in attachments:
-                    att_type = attachment.get('type')
-                    if att_type == 'image':
-                        message_type = 'image'
-                        attachment_type = 'image'
-                        image_url = attachment.get('payload', {}).get('url')
-                        if not message_text:
-                            message_text = '[Image]'
-                        break
-                    elif att_type == 'video':
-                        message_type = 'video'
-                        attachment_type = 'video'
-                        image_url = attachment.get('payload', {}).get('url')
-                        if not message_text:
-                            message_text = '[Video]'
-                        break
-                    elif att_type == 'file':
-                        message_type = 'file'
-                        attachment_type = 'file'
-                        image_url = attachment.get('payload', {}).get('url')
-                        if not message_text:
-                            message_text = '[File]'
-                        break
-                    elif att_type == 'audio':
-                        message_type = 'audio'
-                        attachment_type = 'audio'
-                        image_url = attachment.get('payload', {}).get('url')
-                        if not message_text:
-                            message_text = '[Audio]'
-                        break
+def handle_entry(entry):
+    """Process one webhook entry (runs on an ingest worker)"""
+    page_id = entry.get('id')
+
+    for messaging_event in entry.get('messaging', []):
+        handle_message(messaging_event, page_id)
+
+async def handle_entry_async(entry):
+    """Process one webhook entry on the event loop (ASGI mode)"""
+    page_id = entry.get('id')
+
+    # In order, like handle_entry - other entries run concurrently
+    for messaging_event in entry.get('messaging', []):
+        await handle_message_async(messaging_event, page_id)
+
+# Entries are scheduled fairly per page (weights from the page registry)
+def entry_page_id(entry):
+    return entry.get('id')
+
+ingest_pool = IngestPool(handle_entry, key=entry_page_id, weight=get_page_weight)
+async_ingest_pool = AsyncIngestPool(handle_entry_async, key=entry_page_id, weight=get_page_weight)
+
+# Message ids already received - shared by workers through a local SQLite file
+dedup_store = DedupStore()
+
+def is_duplicate_event(event):
+    """True if this messaging event's message id was already received"""
+    mid = (event.get('message') or {}).get('mid')
+    return bool(mid) and dedup_store.seen(mid)
+
+# Sender names keyed by (page_id, psid) - loaded from file, then warmed from Supabase in the background
+name_cache = NameCache()
+name_cache.load()
+atexit.register(name_cache.save)
+
+def stored_message_ids(message_ids):
+    """The ids among message_ids that already have a messages row"""
+    stored = set()
+    for start in range(0, len(message_ids), 100):
+        result = supabase.table('messages').select('message_id') \
+            .in_('message_id', message_ids[start:start + 100]).execute()
+        stored.update(row['message_id'] for row in result.data or [])
+    return stored
+
+# Accepted message events on local disk until their rows are stored (replayed if the write fails)
+journal = EventJournal(ingest_pool.submit, stored_message_ids)
+
+# Bulk writes for conversations and messages (flushed by size or time)
+def on_messages_written(message_ids):
+    journal.ack(message_ids)
+    mirror_written_media(message_ids)
+
+def on_messages_failed(message_ids):
+    journal.fail(message_ids)
+    forget_pending_media(message_ids)
+
+write_batcher = WriteBatcher(supabase, on_messages_written=on_messages_written, on_messages_failed=on_messages_failed)
+journal.start()
+
+# Conversations already stored in Supabase - repeat senders skip the existence check
+known_conversations = ConversationIndex()
+
+def warm_caches():
+    """
+    Fill the name cache and conversation index with one scan of the
+    conversations table. With a shared cache only the first worker to
+    start in CACHE_WARM_INTERVAL seconds does the scan.
+    """
+    if not get_cache('meta').add('warmed', os.getpid(), ttl=CACHE_WARM_INTERVAL):
+        log.info('Caches already warmed by another worker')
+        return
+    try:
+        names = 0
+        rows = []
+        for row in iter_conversations(supabase, 'conversation_id, page_id, customer_psid, customer_name'):
+            rows.append(row)
+            if len(rows) >= 1000:
+                known_conversations.add_many(rows)
+                names += name_cache.warm(rows)
+                rows = []
+        known_conversations.add_many(rows)
+        names += name_cache.warm(rows)
+        log.info('Caches warmed', conversations=len(known_conversations), names=names)
+    except Exception as e:
+        log.warning('Could not warm caches', error=str(e))
+
+threading.Thread(target=warm_caches, name='cache-warm', daemon=True).start()
+
+# Live inbox deltas for /api/events
+broadcaster = EventBroadcaster()
+
+# Unreplied message counts per conversation (shared by workers) - counted by the webhook, reset by replies
+unreplied_counters = UnrepliedCounters()
+
+def rebuild_unreplied_loop():
+    """Build the counters if no worker has yet, then reconcile them with Supabase (one worker per interval)"""
+    min_interval = UNREPLIED_REBUILD_INTERVAL if UNREPLIED_REBUILD_INTERVAL > 0 else float('inf')
+    while True:
+        try:
+            unreplied_counters.rebuild(supabase, min_interval=min_interval)
+        except Exception as e:
+            log.warning('Could not rebuild unreplied counters', error=str(e))
+        if UNREPLIED_REBUILD_INTERVAL <= 0:
+            break
+        time.sleep(UNREPLIED_REBUILD_INTERVAL)
 
+threading.Thread(target=rebuild_unreplied_loop, name='unreplied-rebuild', daemon=True).start()
+
+# Inbound attachments mirrored from the Facebook CDN (downloaded in the background).
+# Off unless MEDIA_BASE_URL (this server's public URL) is set - messages keep their CDN URL.
+MEDIA_BASE_URL = os.environ.get('MEDIA_BASE_URL', '').rstrip('/')
+
+# message_id -> CDN URL, waiting for the write batcher to store the message row
+pending_media = {}
+pending_media_lock = threading.Lock()
+
+def media_url(sha256, thumbnail=False):
+    return f"{MEDIA_BASE_URL}/api/media/{sha256}" + ('/thumb' if thumbnail else '')
+
+def queue_media(message_id, url):
+    """Mirror an attachment once its message row is written (see mirror_written_media)"""
+    if MEDIA_BASE_URL:
+        with pending_media_lock:
+            pending_media[message_id] = url
+
+def mirror_written_media(message_ids):
+    """Write batcher hook: start downloads for attachments whose rows are now stored"""
+    with pending_media_lock:
+        ready = [(mid, pending_media.pop(mid)) for mid in message_ids if mid in pending_media]
+    for message_id, url in ready:
+        media_mirror.submit(message_id, url)
+
+def forget_pending_media(message_ids):
+    with pending_media_lock:
+        for mid in message_ids:
+            pending_media.pop(mid, None)
+
+def on_media_stored(message_id, info):
+    """Point the message at the mirrored copy instead of the expiring CDN URL"""
+    url = media_url(info['sha256'])
+    result = supabase.table('messages').update({'image_url': url}).eq('message_id', message_id).execute()
+    if not result.data:
+        log.warning('Message not found, mirrored media not linked', message_id=message_id)
+        return
+
+    broadcaster.publish('message.media', {
+        'message_id': message_id,
+        'conversation_id': result.data[0].get('conversation_id'),
+        'image_url': url,
+        'thumbnail_url': media_url(info['sha256'], thumbnail=True) if info['thumbnail'] else None
+    })
+
+media_store = MediaStore()
+media_mirror = MediaMirror(media_store, on_media_stored)
+
+def record_agent_reply(conversation_id):
+    """Reset the unreplied counter and advance the reply watermark"""
+    watermark = datetime.now().isoformat()
+    unreplied_counters.reset(conversation_id, watermark)
+    write_batcher.add_reply_watermark(conversation_id, watermark)
+    broadcaster.publish('unreplied.changed', {'conversation_id': conversation_id, 'count': 0})
+
+def parse_inbound_message(event):
+    """
+    Text and attachment details of an inbound message event.
+
+    Returns:
+        dict: message_id, message_text, message_type, image_url, attachment_type
+    """
+    message_id = event['message']['mid']
+    message_text = event['message'].get('text', '')
+    
+    # Check for attachments (images, videos, files, etc.)
+    attachments = event['message'].get('attachments', [])
+    message_type = 'text'
+    image_url = None
+    attachment_type = None
+    
+    if attachments:
+        for attachment in attachments:
+            att_type = attachment.get('type')
+            if att_type == 'image':
+                message_type = 'image'
+                attachment_type = 'image'
+                image_url = attachment.get('payload', {}).get('url')
+                if not message_text:
+                    message_text = '[Image]'
+                break
+            elif att_type == 'video':
+                message_type = 'video'
+                attachment_type = 'video'
+                image_url = attachment.get('payload', {}).get('url')
+                if not message_text:
+                    message_text = '[Video]'
+                break
+            elif att_type == 'file':
+                message_type = 'file'
+                attachment_type = 'file'
+                image_url = attachment.get('payload', {}).get('url')
+                if not message_text:
+                    message_text = '[File]'
+                break
+            elif att_type == 'audio':
+                message_type = 'audio'
+                attachment_type = 'audio'
+                image_url = attachment.get('payload', {}).get('url')
+                if not message_text:
+                    message_text = '[Audio]'
+                break
+
+    return {
+        'message_id': message_id,
+        'message_text': message_text,
+        'message_type': message_type,
+        'image_url': image_url,
+        'attachment_type': attachment_type
+    }
+
+def record_inbound_message(page_id, page_config, sender_id, sender_name, message, started):
+    """Queue the conversation and message writes for a parsed inbound message and publish live events"""
+    # Fallback to friendly PSID display if name fetch fails
+    if not sender_name or sender_name == 'Unknown':
+        sender_name = f"Customer {sender_id[:8]}"
+        log.info('Using display name', page_id=page_id, sender_name=sender_name, sample=page_id)
+    else:
+        log.info('Got real name', page_id=page_id, sender_name=sender_name, sample=page_id)
+
+    # Create conversation ID
+    conversation_id = f"fb_{page_id}_{sender_id}"
+
+    # Insert-if-missing / touch, skipping the existence check for known conversations
+    with HANDLE_MESSAGE_STAGE_SECONDS.time(stage='conversation_upsert'):
+        upsert_inbound_conversation(write_batcher, known_conversations, conversation_id, page_id,
+                                    page_config.get('name', 'Unknown Page'), sender_id, sender_name)
+
+    # Store message (bulk-inserted by the write batcher)
+    message_row = {
+        'conversation_id': conversation_id,
+        'platform': 'facebook',
+        'message_id': message['message_id'],
+        'sender_type': 'customer',
+        'sender_psid': sender_id,
+        'message_text': message['message_text'],
+        'message_type': message['message_type'],
+        'image_url': message['image_url'],
+        'attachment_type': message['attachment_type'],
+        'replied': False,
+        'created_at': datetime.now().isoformat(),
+        'status': 'received'
+    }
+    if message['image_url']:
+        # Before add_message, so the batcher's written hook always finds it
+        queue_media(message['message_id'], message['image_url'])
+    with HANDLE_MESSAGE_STAGE_SECONDS.time(stage='message_insert'):
+        write_batcher.add_message(message_row)
+        unread = unreplied_counters.increment(conversation_id, message['message_id'], message_row['created_at'])
+
+    stage_started = time.perf_counter()
+    broadcaster.publish('message.new', message_row)
+    broadcaster.publish('conversation.touched', {
+        'conversation_id': conversation_id,
+        'page_id': page_id,
+        'customer_psid': sender_id,
+        'customer_name': sender_name,
+        'last_message_time': message_row['created_at']
+    })
+    broadcaster.publish('unreplied.changed', {'conversation_id': conversation_id, 'count': unread})
+    HANDLE_MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - stage_started, stage='publish')
+
+    log.info('Message queued', conversation_id=conversation_id, sender_name=sender_name,
+             message_type=message['message_type'], sample=page_id)
+    HANDLE_MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - started, stage='total')
+    HANDLE_MESSAGE_TOTAL.inc(outcome='queued')
+
+def record_receipt(event, page_id):
+    """Queue a delivery / read watermark (coalesced by the write batcher) and publish it live"""
+    receipt = parse_receipt(event, page_id)
+    if not receipt:
+        HANDLE_MESSAGE_TOTAL.inc(outcome='ignored')
+        return
+    conversation_id, status, watermark = receipt
+    write_batcher.add_receipt_watermark(conversation_id, status, watermark)
+    broadcaster.publish('message.status', {'conversation_id': conversation_id, 'status': status,
+                                           'watermark': watermark})
+    HANDLE_MESSAGE_TOTAL.inc(outcome=status)
+
+def release_failed_message(event):
+    """Let a redelivery of this message be processed again"""
+    mid = (event.get('message') or {}).get('mid')
+    if mid:
+        dedup_store.forget(mid)
+        # Replayed from the journal on its next pass
+        journal.fail([mid])
+
+def handle_message_failed(event, e):
+    release_failed_message(event)
+    HANDLE_MESSAGE_TOTAL.inc(outcome='error')
+    log.exception('Error handling message', error=str(e))
+
+def begin_message(event, page_id):
+    """
+    handle_message up to the Graph name lookup (page config, parsing, cached name).
+
+    Returns:
+        dict: state for finish_message - 'sender_name' is None when the name
+        has to be looked up - or None when the event is fully handled
+    """
+    sender_id = event['sender']['id']
+    page_config = get_page_config(page_id)
+
+    if not page_config:
+        log.warning('Page not configured', page_id=page_id)
+        HANDLE_MESSAGE_TOTAL.inc(outcome='unknown_page')
+        journal.ack([event_mid(event)])
+        return None
+
+    # Handle text messages and attachments
+    if event.get('message'):
+        message = parse_inbound_message(event)
+
+        # Cached name first, Graph API only on miss/expiry
+        stage_started = time.perf_counter()
+        sender_name = name_cache.get(page_id, sender_id)
+        if sender_name is not None:
+            HANDLE_MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - stage_started, stage='name_lookup_cache')
+        return {'page_config': page_config, 'sender_id': sender_id, 'message': message,
+                'sender_name': sender_name, 'lookup_started': stage_started}
+    elif event.get('delivery') or event.get('read'):
+        record_receipt(event, page_id)
+    else:
+        HANDLE_MESSAGE_TOTAL.inc(outcome='ignored')
+    return None
+
+def finish_message(pending, page_id, fetched_name, started):
+    """handle_message after the name lookup - fetched_name is the Graph result, if one was needed"""
+    sender_name = pending['sender_name']
+    if sender_name is None:
+        sender_name = fetched_name
+        name_cache.set(page_id, pending['sender_id'], sender_name)
+        HANDLE_MESSAGE_STAGE_SECONDS.observe(time.perf_counter() - pending['lookup_started'],
+                                             stage='name_lookup_graph')
+    record_inbound_message(page_id, pending['page_config'], pending['sender_id'], sender_name,
+                           pending['message'], started)
+
+def handle_message(event, page_id):
+    """Process incoming Facebook message - UPDATED with Message ID name fetching"""
+    started = time.perf_counter()
+    try:
+        pending = begin_message(event, page_id)
+        if pending is None:
+            return
+        fetched_name = None
+        if pending['sender_name'] is None:
             # ✅ NEW METHOD: Get name from Message ID (THIS WORKS!)
-            access_token = page_config.get('accessToken')
-            sender_name = get_sender_name_from_message(message_id, access_token)
-            
-            # Fallback to friendly PSID display if name fetch fails
-            if not sender_name or sender_name == 'Unknown':
-                sender_name = f"Customer {sender_id[:8]}"
-                print(f'ℹ️ Using display name: {sender_name}')
-            else:
-                print(f'✅ Got real name: {sender_name}')
-
-            # Create conversation ID
-            conversation_id = f"fb_{page_id}_{sender_id}"
-
-            # Check if conversation exists
-            result = supabase.table('conversations').select('*').eq('conversation_id', conversation_id).execute()
-
-            if not result.data:
-                # Create new conversation
-                supabase.table('conversations').insert({
-                    'conversation_id': conversation_id,
-                    'platform': 'facebook',
-                    'page_id': page_id,
-                    'page_name': page_config.get('name', 'Unknown Page'),
-                    'customer_psid': sender_id,
-                    'customer_name': sender_name,
-                    'customer_name_fetched': True,
-                    'last_message_time': datetime.now().isoformat(),
-                    'status': 'active'
-                }).execute()
-                print(f'✅ New conversation created: {conversation_id} - {sender_name}')
-            else:
-                # Update conversation - always update name if we got a real one
-                existing_name = result.data[0].get('customer_name', 'Unknown')
-                update_data = {'last_message_time': datetime.now().isoformat()}
-                
-                # Update name if: we have a real name (not auto-generated)
-                if sender_name and not sender_name.startswith('Customer ') and not sender_name.startswith('User #') and sender_name != 'Unknown':
-                    update_data['customer_name'] = sender_name
-                    update_data['customer_name_fetched'] = True
-                    if existing_name != sender_name:
-                        print(f'✅ Updated conversation name: {existing_name} → {sender_name}')
-                
-                supabase.table('conversations').update(update_data).eq('conversation_id', conversation_id).execute()
-
-            # Store message
-            supabase.table('messages').insert({
-                'conversation_id': conversation_id,
-                'platform': 'facebook',
-                'message_id': message_id,
-                'sender_type': 'customer',
-                'sender_psid': sender_id,
-                'message_text': message_text,
-                'message_type': message_type,
-                'image_url': image_url,
-                'attachment_type': attachment_type,
-                'replied': False,
-                'created_at': datetime.now().isoformat(),
-                'status': 'received'
-            }).execute()
+            fetched_name = get_sender_name_from_message(pending['message']['message_id'],
+                                                        pending['page_config'].get('accessToken'), page_id)
+        finish_message(pending, page_id, fetched_name, started)
+
+    except Exception as e:
+        handle_message_failed(event, e)
 
-            print(f'📨 Message stored: {conversation_id} - {sender_name} - Type: {message_type}')
+async def handle_message_async(event, page_id):
+    """
+    handle_message in ASGI mode: the Graph name lookup is awaited on the event
+    loop, the SQLite-backed steps (page registry, caches, counters, events) run
+    in a thread so lock waits never stall the loop.
+    """
+    started = time.perf_counter()
+    try:
+        pending = await asyncio.to_thread(begin_message, event, page_id)
+        if pending is None:
+            return
+        fetched_name = None
+        if pending['sender_name'] is None:
+            fetched_name = await get_sender_name_from_message_async(pending['message']['message_id'],
+                                                                    pending['page_config'].get('accessToken'),
+                                                                    page_id)
+        await asyncio.to_thread(finish_message, pending, page_id, fetched_name, started)
 
     except Exception as e:
-        print(f'❌ Error handling message: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        HANDLE_MESSAGE_TOTAL.inc(outcome='error')
+        log.exception('Error handling message', error=str(e))
+        await asyncio.to_thread(release_failed_message, event)
 
-def get_sender_name_from_message(message_id, access_token):
+def get_sender_name_from_message(message_id, access_token, page_id=None):
     """
     ✅ NEW METHOD: Get sender name from Message ID instead of PSID
     This bypasses Facebook's privacy restrictions!
@@ -209,62 +591,195 @@ def get_sender_name_from_message(message_id, access_token):
     """
     try:
         if not access_token or not message_id:
-            print('⚠️ Missing access_token or message_id')
+            log.warning('Missing access_token or message_id', page_id=page_id)
             return 'Unknown'
         
-        print(f'🔍 Fetching sender info from Message ID: {message_id}')
+        log.debug('Fetching sender info from message id', message_id=message_id, page_id=page_id)
         
         # Query the MESSAGE, not the USER directly
-        url = f'https://graph.facebook.com/v19.0/{message_id}'
         params = {
-            'fields': 'from',  # Get sender info from message
-            'access_token': access_token
+            'fields': 'from'  # Get sender info from message
         }
         
-        response = requests.get(url, params=params, timeout=5)
-        data = response.json()
-        
-        print(f'📡 Facebook API Response: {data}')
-        
-        # Check for errors
-        if 'error' in data:
-            error_msg = data['error'].get('message', 'Unknown error')
-            error_code = data['error'].get('code', 'N/A')
-            print(f'⚠️ Facebook API Error: [{error_code}] {error_msg}')
-            return 'Unknown'
-        
-        # Extract name from "from" field
-        if 'from' in data and isinstance(data['from'], dict):
-            if 'name' in data['from']:
-                name = data['from']['name']
-                print(f'✅ Successfully fetched name from message: {name}')
-                return name
-            elif 'id' in data['from']:
-                # Has ID but no name (rare case)
-                print(f'⚠️ Message has sender ID but no name')
-                return 'Unknown'
+        response = graph.get(message_id, access_token=access_token, page_id=page_id, params=params, timeout=5)
+        return sender_name_from_response(response.json(), message_id, page_id)
         
-        print(f'⚠️ No "from" field in message response')
+    except requests.exceptions.Timeout:
+        log.warning('Timeout fetching sender name', message_id=message_id, page_id=page_id)
         return 'Unknown'
-        
+    except requests.exceptions.RequestException as e:
+        log.warning('Network error fetching sender name', page_id=page_id, error=str(e))
+        return 'Unknown'
+    except Exception as e:
+        log.exception('Unexpected error fetching sender name', error=str(e))
+        return 'Unknown'
+
+async def get_sender_name_from_message_async(message_id, access_token, page_id=None):
+    """get_sender_name_from_message through the async Graph client"""
+    try:
+        if not access_token or not message_id:
+            log.warning('Missing access_token or message_id', page_id=page_id)
+            return 'Unknown'
+
+        log.debug('Fetching sender info from message id', message_id=message_id, page_id=page_id)
+        response = await async_graph.get(message_id, access_token=access_token, page_id=page_id,
+                                         params={'fields': 'from'}, timeout=5)
+        return sender_name_from_response(response.json(), message_id, page_id)
+
     except requests.exceptions.Timeout:
-        print(f'⏱️ Timeout fetching name for message {message_id}')
+        log.warning('Timeout fetching sender name', message_id=message_id, page_id=page_id)
         return 'Unknown'
     except requests.exceptions.RequestException as e:
-        print(f'🌐 Network error fetching sender name: {str(e)}')
+        log.warning('Network error fetching sender name', page_id=page_id, error=str(e))
         return 'Unknown'
     except Exception as e:
-        print(f'❌ Unexpected error fetching sender name: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        log.exception('Unexpected error fetching sender name', error=str(e))
         return 'Unknown'
 
+def sender_name_from_response(data, message_id, page_id=None):
+    """Sender name from a Graph {message_id}?fields=from response, or 'Unknown'"""
+    log.debug('Facebook API response', message_id=message_id, response=data)
+    
+    # Check for errors
+    if 'error' in data:
+        error_msg = data['error'].get('message', 'Unknown error')
+        error_code = data['error'].get('code', 'N/A')
+        log.warning('Facebook API error fetching sender name', page_id=page_id, code=error_code, error=error_msg)
+        return 'Unknown'
+    
+    # Extract name from "from" field
+    if 'from' in data and isinstance(data['from'], dict):
+        if 'name' in data['from']:
+            name = data['from']['name']
+            log.info('Fetched name from message', page_id=page_id, name=name, sample=page_id)
+            return name
+        elif 'id' in data['from']:
+            # Has ID but no name (rare case)
+            log.warning('Message has sender id but no name', message_id=message_id)
+            return 'Unknown'
+    
+    log.warning('No "from" field in message response', message_id=message_id)
+    return 'Unknown'
+
+# ============================================
+# Sent message storage + async send queue
+# ============================================
+def store_sent_message(page_id, recipient_id, message_id, message_text, message_type='text',
+                       image_url=None, status='sent'):
+    """Insert an agent message row and, if delivered, count it as a reply"""
+    message_row = sent_message_row(page_id, recipient_id, message_id, message_text, message_type, image_url, status)
+    supabase.table('messages').insert(message_row).execute()
+    sent_message_stored(message_row)
+    return message_row
+
+async def store_sent_message_async(page_id, recipient_id, message_id, message_text, message_type='text',
+                                   image_url=None, status='sent'):
+    """store_sent_message through the async Supabase client"""
+    message_row = sent_message_row(page_id, recipient_id, message_id, message_text, message_type, image_url, status)
+    client = await get_async_supabase()
+    await client.table('messages').insert(message_row).execute()
+    sent_message_stored(message_row)
+    return message_row
+
+def sent_message_row(page_id, recipient_id, message_id, message_text, message_type='text', image_url=None,
+                     status='sent'):
+    conversation_id = f"fb_{page_id}_{recipient_id}"
+    message_row = {
+        'conversation_id': conversation_id,
+        'platform': 'facebook',
+        'message_id': message_id,
+        'sender_type': 'agent',
+        'message_text': message_text,
+        'message_type': message_type,
+        'created_at': datetime.now().isoformat(),
+        'status': status
+    }
+    if image_url is not None:
+        message_row['image_url'] = image_url
+    return message_row
+
+def sent_message_stored(message_row):
+    if message_row['status'] == 'sent':
+        record_agent_reply(message_row['conversation_id'])
+    broadcaster.publish('message.new', message_row)
+
+def deliver_send_job(job, payload):
+    """Deliver one queued message (runs on a sender thread)"""
+    page_config = get_page_config(job['page_id'])
+    if not page_config:
+        return 400, {'error': {'message': f'Page {job["page_id"]} not configured'}}
+    access_token = page_config.get('accessToken')
+
+    if job['kind'] == 'send_image':
+        return attachment_cache.send_image(job['page_id'], access_token, job['recipient_id'], payload['upload'],
+                                           job['use_human_agent_tag'])
+    return messenger.send_text(job['page_id'], access_token, job['recipient_id'], payload['message_text'],
+                               job['use_human_agent_tag'])
+
+def finish_send_job(job, response_data):
+    """Write the messages row with the job's final status"""
+    try:
+        if job['kind'] == 'send_image':
+            store_sent_message(job['page_id'], job['recipient_id'], response_data.get('message_id'), '[Image]',
+                               'image', response_data.get('attachment_id', ''), status=job['status'])
+        else:
+            store_sent_message(job['page_id'], job['recipient_id'], response_data.get('message_id'),
+                               job['message_text'], status=job['status'])
+    except Exception as e:
+        log.error('Error storing result of send job', job_id=job['id'], error=str(e))
+
+job_store = JobStore()
+attachment_cache = AttachmentCache()
+send_queue = SendQueue(deliver_send_job, finish_send_job, job_store, weight=get_page_weight)
+
+def enqueue_send(kind, page_id, recipient_id, payload, **fields):
+    """Queue a send and build the 202 response with its job id"""
+    body, status = queue_send(kind, page_id, recipient_id, payload, **fields)
+    return jsonify(body), status
+
+def queue_send(kind, page_id, recipient_id, payload, **fields):
+    """
+    Returns:
+        tuple: (response body dict, HTTP status) - 202 with the job id, or 503 when the queue is full
+    """
+    try:
+        job = send_queue.submit(kind, page_id, recipient_id, payload, **fields)
+    except queue.Full:
+        return {'error': 'Send queue is full, try again shortly'}, 503
+    log.info('Queued send job', kind=kind, job_id=job['id'], page_id=page_id, recipient_id=recipient_id,
+             sample=page_id)
+    return {'success': True, 'queued': True, 'job_id': job['id'], 'status_url': f'/api/send/{job["id"]}'}, 202
+
+def send_target(page_id, recipient_id, message_text):
+    """
+    Validate a /api/send request.
+
+    Returns:
+        tuple: (access_token, None) or (None, (error body dict, HTTP status))
+    """
+    if not all([page_id, recipient_id, message_text]):
+        return None, ({'error': 'Missing required fields'}, 400)
+
+    page_config = get_page_config(page_id)
+    if not page_config:
+        return None, ({'error': f'Page {page_id} not configured'}, 400)
+
+    # Check if accessToken exists
+    access_token = page_config.get('accessToken')
+    if not access_token:
+        log.error('accessToken missing for page', page_id=page_id)
+        return None, ({'error': 'Page access token not configured. Check your .env file.'}, 400)
+    return access_token, None
+
 # ============================================
 # Send message with HUMAN_AGENT tag support
 # ============================================
 @app.route('/api/send', methods=['POST', 'OPTIONS'])
 def send_message():
-    """Send reply back to Facebook Messenger"""
+    """
+    Send reply back to Facebook Messenger.
+    With "async": true the message is queued and a job id is returned (202).
+    """
 
     # Handle preflight OPTIONS request
     if request.method == 'OPTIONS':
@@ -276,77 +791,61 @@ def send_message():
         recipient_id = data.get('recipient_id')
         message_text = data.get('message_text')
         use_human_agent_tag = data.get('use_human_agent_tag', False)
+        use_async = data.get('async', False) or request.args.get('async', 'false').lower() == 'true'
 
-        print(f'📤 Send message request: page={page_id}, recipient={recipient_id}, use_tag={use_human_agent_tag}')
+        log.info('Send message request', page_id=page_id, recipient_id=recipient_id,
+                 use_tag=use_human_agent_tag, sample=page_id)
 
-        if not all([page_id, recipient_id, message_text]):
-            return jsonify({'error': 'Missing required fields'}), 400
+        access_token, error = send_target(page_id, recipient_id, message_text)
+        if error:
+            return jsonify(error[0]), error[1]
 
-        page_config = get_page_config(page_id)
-        if not page_config:
-            return jsonify({'error': f'Page {page_id} not configured'}), 400
+        if use_human_agent_tag:
+            log.debug('Using HUMAN_AGENT tag', recipient_id=recipient_id)
 
-        # Check if accessToken exists
-        access_token = page_config.get('accessToken')
-        if not access_token:
-            print(f'❌ Error: accessToken missing for page {page_id}')
-            return jsonify({'error': 'Page access token not configured. Check your .env file.'}), 400
+        if use_async:
+            return enqueue_send('send_text', page_id, recipient_id, {'message_text': message_text},
+                                message_text=message_text, use_human_agent_tag=bool(use_human_agent_tag))
 
         # Send to Facebook
-        url = 'https://graph.facebook.com/v19.0/me/messages'
-        params = {'access_token': access_token}
-        headers = {'Content-Type': 'application/json'}
-        
-        # Build payload with optional HUMAN_AGENT tag
-        payload = {
-            'recipient': {'id': recipient_id},
-            'message': {'text': message_text}
-        }
-        
-        if use_human_agent_tag:
-            payload['messaging_type'] = 'MESSAGE_TAG'
-            payload['tag'] = 'HUMAN_AGENT'
-            print(f'🏷️ Using HUMAN_AGENT tag for message to {recipient_id}')
-        else:
-            payload['messaging_type'] = 'RESPONSE'
-
-        response = requests.post(url, params=params, headers=headers, json=payload, timeout=10)
-        response_data = response.json()
+        status_code, response_data = messenger.send_text(page_id, access_token, recipient_id, message_text,
+                                                         use_human_agent_tag)
 
-        if response.status_code == 200:
+        if status_code == 200:
             # Store sent message
-            conversation_id = f"fb_{page_id}_{recipient_id}"
-            supabase.table('messages').insert({
-                'conversation_id': conversation_id,
-                'platform': 'facebook',
-                'message_id': response_data.get('message_id'),
-                'sender_type': 'agent',
-                'message_text': message_text,
-                'message_type': 'text',
-                'created_at': datetime.now().isoformat(),
-                'status': 'sent'
-            }).execute()
+            store_sent_message(page_id, recipient_id, response_data.get('message_id'), message_text)
 
-            print(f'✅ Message sent successfully: {response_data.get("message_id")}')
+            log.info('Message sent', page_id=page_id, message_id=response_data.get('message_id'), sample=page_id)
             return jsonify({'success': True, 'data': response_data}), 200
         else:
-            error_msg = response_data.get('error', {}).get('message', 'Unknown Facebook error')
-            error_code = response_data.get('error', {}).get('code', 'N/A')
-            print(f'❌ Facebook API Error: [{error_code}] {error_msg}')
-            return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), response.status_code
+            error_msg, error_code = messenger.error_details(response_data)
+            log.error('Facebook API error sending message', page_id=page_id, code=error_code, error=error_msg)
+            return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), status_code
 
     except Exception as e:
-        print(f'❌ Error in send_message: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        log.exception('Error in send_message', error=str(e))
         return jsonify({'error': str(e)}), 500
 
+# ============================================
+# Queued send status
+# ============================================
+@app.route('/api/send/<job_id>', methods=['GET'])
+def get_send_status(job_id):
+    """Status of a queued send: queued, sending, sent or failed"""
+    job = job_store.get(job_id)
+    if not job or job.get('kind') not in ('send_text', 'send_image'):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job}), 200
+
 # ============================================
 # Send image message
 # ============================================
 @app.route('/api/send-image', methods=['POST', 'OPTIONS'])
 def send_image():
-    """Send image message to Facebook Messenger"""
+    """
+    Send image message to Facebook Messenger.
+    With form field async=true the image is queued and a job id is returned (202).
+    """
     
     if request.method == 'OPTIONS':
         return '', 204
@@ -355,8 +854,10 @@ def send_image():
         page_id = request.form.get('page_id')
         recipient_id = request.form.get('recipient_id')
         use_human_agent_tag = request.form.get('use_human_agent_tag', 'false').lower() == 'true'
+        use_async = request.form.get('async', 'false').lower() == 'true'
         
-        print(f'📤 Send image request: page={page_id}, recipient={recipient_id}, use_tag={use_human_agent_tag}')
+        log.info('Send image request', page_id=page_id, recipient_id=recipient_id,
+                 use_tag=use_human_agent_tag, sample=page_id)
         
         if 'image' not in request.files:
             return jsonify({'error': 'No image file provided'}), 400
@@ -377,79 +878,269 @@ def send_image():
         if not access_token:
             return jsonify({'error': 'Page access token not configured'}), 400
 
-        # Send image to Facebook
-        url = 'https://graph.facebook.com/v19.0/me/messages'
-        params = {'access_token': access_token}
-        
-        # Build message payload as JSON strings for multipart/form-data
-        message_data = {
-            'attachment': {
-                'type': 'image',
-                'payload': {
-                    'is_reusable': True
-                }
-            }
-        }
-        
-        # Prepare form data
-        payload = {
-            'recipient': json.dumps({'id': recipient_id}),
-            'message': json.dumps(message_data)
-        }
-        
         if use_human_agent_tag:
-            payload['messaging_type'] = 'MESSAGE_TAG'
-            payload['tag'] = 'HUMAN_AGENT'
-            print('🏷️ Using HUMAN_AGENT tag for image')
-        else:
-            payload['messaging_type'] = 'RESPONSE'
+            log.debug('Using HUMAN_AGENT tag for image', recipient_id=recipient_id)
 
-        # Read image file
-        image_bytes = image_file.read()
-        image_file.seek(0)
-        
-        # Prepare multipart form data
-        files = {
-            'filedata': (image_file.filename, image_bytes, image_file.content_type or 'image/jpeg')
-        }
+        # Spool + hash the upload; repeat images are sent by cached attachment_id
+        upload = spool_upload(image_file)
 
-        print(f'📡 Sending image to Facebook: {image_file.filename} ({len(image_bytes)} bytes)')
-        response = requests.post(url, params=params, data=payload, files=files, timeout=30)
-        response_data = response.json()
+        if use_async:
+            return enqueue_send('send_image', page_id, recipient_id, {'upload': upload},
+                                filename=image_file.filename, sha256=upload.sha256,
+                                use_human_agent_tag=use_human_agent_tag)
 
-        if response.status_code == 200:
+        log.info('Sending image', page_id=page_id, filename=image_file.filename, size=upload.size,
+                 sha256=upload.sha256, sample=page_id)
+        try:
+            status_code, response_data = attachment_cache.send_image(page_id, access_token, recipient_id, upload,
+                                                                     use_human_agent_tag)
+        finally:
+            upload.close()
+
+        if status_code == 200:
             # Get attachment/message ID
             msg_id = response_data.get('message_id')
             attachment_id = response_data.get('attachment_id', '')
             
             # Store sent message
+            store_sent_message(page_id, recipient_id, msg_id, '[Image]', 'image', attachment_id)
+
+            log.info('Image sent', page_id=page_id, message_id=msg_id, sample=page_id)
+            return jsonify({'success': True, 'data': response_data}), 200
+        else:
+            error_msg, error_code = messenger.error_details(response_data)
+            log.error('Facebook API error sending image', page_id=page_id, code=error_code, error=error_msg)
+            return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), status_code
+
+    except Exception as e:
+        log.exception('Error in send_image', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# Send a previously uploaded attachment
+# ============================================
+@app.route('/api/send-attachment', methods=['POST', 'OPTIONS'])
+def send_attachment():
+    """
+    Send an attachment by id (e.g. the attachment_id returned by /api/send-image).
+    JSON body: {page_id, recipient_id, attachment_id, attachment_type, use_human_agent_tag}
+    """
+
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    try:
+        data = request.get_json() or {}
+        page_id = data.get('page_id')
+        recipient_id = data.get('recipient_id')
+        attachment_id = data.get('attachment_id')
+        attachment_type = data.get('attachment_type', 'image')
+        use_human_agent_tag = bool(data.get('use_human_agent_tag', False))
+
+        log.info('Send attachment request', page_id=page_id, recipient_id=recipient_id,
+                 attachment_id=attachment_id, sample=page_id)
+
+        if not all([page_id, recipient_id, attachment_id]):
+            return jsonify({'error': 'Missing required fields'}), 400
+
+        page_config = get_page_config(page_id)
+        if not page_config:
+            return jsonify({'error': f'Page {page_id} not configured'}), 400
+
+        access_token = page_config.get('accessToken')
+        if not access_token:
+            return jsonify({'error': 'Page access token not configured'}), 400
+
+        status_code, response_data = messenger.send_attachment(page_id, access_token, recipient_id, attachment_id,
+                                                               attachment_type, use_human_agent_tag)
+
+        if status_code == 200:
+            store_sent_message(page_id, recipient_id, response_data.get('message_id'),
+                               f'[{attachment_type.capitalize()}]', attachment_type, attachment_id)
+
+            log.info('Attachment sent', page_id=page_id, message_id=response_data.get('message_id'), sample=page_id)
+            return jsonify({'success': True, 'data': dict(response_data, attachment_id=attachment_id)}), 200
+        else:
+            error_msg, error_code = messenger.error_details(response_data)
+            log.error('Facebook API error sending attachment', page_id=page_id, code=error_code, error=error_msg)
+            return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), status_code
+
+    except Exception as e:
+        log.exception('Error in send_attachment', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# Bulk / broadcast send
+# ============================================
+SEND_BULK_MAX_RECIPIENTS = int(os.environ.get('SEND_BULK_MAX_RECIPIENTS', 1000))
+
+@app.route('/api/send-bulk', methods=['POST', 'OPTIONS'])
+def send_bulk():
+    """
+    Send one message to many recipients of a page.
+
+    JSON body: {page_id, recipient_ids: [...], message_text, use_human_agent_tag}
+    or multipart form with page_id, recipient_ids (JSON list or comma separated),
+    use_human_agent_tag and an `image` file - uploaded once and reused by id.
+
+    Streams one NDJSON line per recipient as sends complete, then a summary line.
+    """
+
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    try:
+        if request.files:
+            data = request.form
+            raw_recipients = data.get('recipient_ids', '')
+            recipient_ids = json.loads(raw_recipients) if raw_recipients.strip().startswith('[') \
+                else [r.strip() for r in raw_recipients.split(',')]
+            use_human_agent_tag = data.get('use_human_agent_tag', 'false').lower() == 'true'
+        else:
+            data = request.get_json() or {}
+            recipient_ids = data.get('recipient_ids') or []
+            use_human_agent_tag = bool(data.get('use_human_agent_tag', False))
+
+        page_id = data.get('page_id')
+        message_text = data.get('message_text')
+        image_file = request.files.get('image')
+        recipient_ids = list(dict.fromkeys(str(r) for r in recipient_ids if r))
+
+        log.info('Bulk send request', page_id=page_id, recipients=len(recipient_ids), use_tag=use_human_agent_tag)
+
+        if not page_id or not recipient_ids or not (message_text or image_file):
+            return jsonify({'error': 'Missing required fields'}), 400
+        if len(recipient_ids) > SEND_BULK_MAX_RECIPIENTS:
+            return jsonify({'error': f'Too many recipients (max {SEND_BULK_MAX_RECIPIENTS})'}), 400
+
+        page_config = get_page_config(page_id)
+        if not page_config:
+            return jsonify({'error': f'Page {page_id} not configured'}), 400
+        access_token = page_config.get('accessToken')
+        if not access_token:
+            return jsonify({'error': 'Page access token not configured'}), 400
+
+        # Upload the image once, then every recipient gets it by attachment_id
+        attachment_id = None
+        if image_file:
+            upload = spool_upload(image_file)
+            try:
+                status_code, response_data = attachment_cache.upload(page_id, access_token, upload)
+            finally:
+                upload.close()
+            attachment_id = response_data.get('attachment_id') if status_code == 200 else None
+            if not attachment_id:
+                error_msg, error_code = messenger.error_details(response_data)
+                log.error('Facebook API error uploading attachment', page_id=page_id, code=error_code, error=error_msg)
+                return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), status_code or 502
+            log.info('Uploaded bulk attachment', page_id=page_id, attachment_id=attachment_id)
+
+        def send_one(recipient_id):
+            if attachment_id:
+                status_code, response_data = messenger.send_attachment(
+                    page_id, access_token, recipient_id, attachment_id, use_human_agent_tag=use_human_agent_tag)
+            else:
+                status_code, response_data = messenger.send_text(
+                    page_id, access_token, recipient_id, message_text, use_human_agent_tag)
+
+            if status_code != 200:
+                error_msg, error_code = messenger.error_details(response_data)
+                return {'recipient_id': recipient_id, 'success': False, 'error': error_msg, 'code': error_code}
+
+            # Rows go out in bulk through the write batcher
             conversation_id = f"fb_{page_id}_{recipient_id}"
-            supabase.table('messages').insert({
+            message_row = {
                 'conversation_id': conversation_id,
                 'platform': 'facebook',
-                'message_id': msg_id,
+                'message_id': response_data.get('message_id'),
                 'sender_type': 'agent',
-                'message_text': '[Image]',
-                'message_type': 'image',
+                'message_text': '[Image]' if attachment_id else message_text,
+                'message_type': 'image' if attachment_id else 'text',
                 'image_url': attachment_id,
                 'created_at': datetime.now().isoformat(),
                 'status': 'sent'
-            }).execute()
+            }
+            write_batcher.add_message(message_row)
+            record_agent_reply(conversation_id)
+            broadcaster.publish('message.new', message_row)
+            return {'recipient_id': recipient_id, 'success': True, 'message_id': response_data.get('message_id')}
 
-            print(f'✅ Image sent successfully: {msg_id}')
-            return jsonify({'success': True, 'data': response_data}), 200
-        else:
-            error_msg = response_data.get('error', {}).get('message', 'Unknown error')
-            error_code = response_data.get('error', {}).get('code', 'N/A')
-            print(f'❌ Facebook image error: [{error_code}] {error_msg}')
-            return jsonify({'error': f'Facebook error: {error_msg}', 'code': error_code}), response.status_code
+        def generate():
+            sent = failed = 0
+            for result in fan_out(page_id, recipient_ids, send_one, bucket=send_queue.bucket(page_id)):
+                if result['success']:
+                    sent += 1
+                else:
+                    failed += 1
+                yield json.dumps(result) + '\n'
+            log.info('Bulk send complete', page_id=page_id, sent=sent, failed=failed)
+            yield json.dumps({'done': True, 'total': len(recipient_ids), 'sent': sent, 'failed': failed}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
 
     except Exception as e:
-        print(f'❌ Error in send_image: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        log.exception('Error in send_bulk', error=str(e))
         return jsonify({'error': str(e)}), 500
 
+# ============================================
+# Mirrored inbound media
+# ============================================
+@app.route('/api/media/<sha256>', methods=['GET'])
+@app.route('/api/media/<sha256>/thumb', methods=['GET'], defaults={'thumbnail': True})
+def get_media(sha256, thumbnail=False):
+    """
+    Serve a mirrored attachment by content hash.
+    Content never changes for a hash, so responses are cacheable forever;
+    Range requests and If-None-Match are handled by send_file.
+    """
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        return jsonify({'error': 'Invalid media hash'}), 400
+
+    info = media_store.get(sha256)
+    if not info:
+        return jsonify({'error': 'Media not found'}), 404
+
+    # No thumbnail (not an image, or Pillow missing) - serve the original
+    if thumbnail and info['thumbnail']:
+        path, mimetype, etag = media_store.path(sha256, thumbnail=True), 'image/jpeg', f'{sha256}-thumb'
+    else:
+        path, mimetype, etag = media_store.path(sha256), info['content_type'], sha256
+
+    response = send_file(os.path.abspath(path), mimetype=mimetype or 'application/octet-stream',
+                         conditional=True, etag=etag, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# ============================================
+# Live inbox updates (Server-Sent Events)
+# ============================================
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    Stream inbox deltas as Server-Sent Events.
+    Resumes after the Last-Event-ID header (or ?last_event_id=) when the
+    events are still in the shared log, otherwise sends a 'resync' event.
+    Needs a threaded worker (see events.py).
+    """
+    if not request.environ.get('wsgi.multithread'):
+        # Each stream holds its thread for as long as the tab is open
+        return jsonify({'error': '/api/events needs a threaded worker (gunicorn --threads N) or asgi.py'}), 503
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    client = broadcaster.subscribe(last_event_id)
+    return Response(stream_with_context(broadcaster.stream(client)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # ============================================
 # Get unreplied message counts
 # ============================================
@@ -457,8 +1148,13 @@ def send_image():
 def get_unreplied_counts():
     """Get count of unreplied messages per page/customer"""
     try:
-        print('📊 Fetching unreplied counts...')
-        
+        # Shared counters - O(unreplied messages), no Supabase query
+        if unreplied_counters.ready:
+            counts = unreplied_counters.snapshot()
+            return conditional_json({'success': True, 'counts': counts})
+
+        log.info('Counters not built yet, fetching unreplied counts from Supabase')
+
         # Try to call the Supabase function first
         try:
             result = supabase.rpc('get_unreplied_counts').execute()
@@ -470,64 +1166,166 @@ def get_unreplied_counts():
                     key = f"{row['page_id']}_{row['customer_psid']}"
                     counts[key] = row['unreplied_count']
             
-            print(f'✅ Unreplied counts: {len(counts)} conversations with unreplied messages')
+            log.info('Unreplied counts fetched', conversations=len(counts))
             return jsonify({'success': True, 'counts': counts}), 200
             
         except Exception as rpc_error:
-            print(f'⚠️ RPC function failed, using fallback method: {str(rpc_error)}')
+            log.warning('RPC function failed, rebuilding counters', error=str(rpc_error))
             
-            # Fallback: calculate manually
-            convs = supabase.table('conversations').select('conversation_id, page_id, customer_psid').execute()
-            counts = {}
-            
-            for conv in convs.data:
-                # Count unreplied customer messages
-                messages = supabase.table('messages').select('id').eq('conversation_id', conv['conversation_id']).eq('sender_type', 'customer').eq('replied', False).execute()
-                
-                count = len(messages.data)
-                if count > 0:
-                    key = f"{conv['page_id']}_{conv['customer_psid']}"
-                    counts[key] = count
-            
-            print(f'✅ Unreplied counts (fallback): {len(counts)} conversations')
+            # Fallback: one scan of unreplied messages instead of a query per conversation
+            unreplied_counters.rebuild(supabase)
+            counts = unreplied_counters.snapshot()
+            log.info('Unreplied counts rebuilt', conversations=len(counts))
             return jsonify({'success': True, 'counts': counts}), 200
         
     except Exception as e:
-        print(f'❌ Error in get_unreplied_counts: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        log.exception('Error in get_unreplied_counts', error=str(e))
         return jsonify({'error': str(e)}), 500
 
+# ============================================
+# REBUILD UNREPLIED COUNTERS (one-time for existing data)
+# ============================================
+@app.route('/api/unreplied-counts/rebuild', methods=['POST', 'OPTIONS'])
+def rebuild_unreplied_counts():
+    """
+    Recompute counters from Supabase.
+    With ?persist=true, also flips replied=True on customer messages older
+    than each conversation's latest agent reply (one-time migration).
+    """
+    
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    try:
+        persist = request.args.get('persist', 'false').lower() == 'true'
+        conversations_unread = unreplied_counters.rebuild(supabase, persist=persist)
+        return jsonify({'success': True, 'conversations_with_unreplied': conversations_unread,
+                        'persisted': persist}), 200
+    except Exception as e:
+        log.exception('Error in rebuild_unreplied_counts', error=str(e))
+        return jsonify({'error': str(e), 'success': False}), 500
+
 # Get conversation messages
 @app.route('/api/conversation/<conversation_id>', methods=['GET'])
 def get_conversation(conversation_id):
-    """Get all messages for a conversation"""
+    """
+    Get messages for a conversation.
+
+    Without paging parameters the full history is returned (oldest first).
+    With ?limit=, ?before=<cursor> or ?after=<cursor> one keyset page is
+    returned, oldest first, plus cursors for the neighbouring pages.
+    ?fields= limits the returned columns.
+    """
     try:
-        result = supabase.table('messages').select('*').eq('conversation_id', conversation_id).order('created_at').execute()
-        return jsonify({'success': True, 'messages': result.data}), 200
+        fields = parse_fields(request.args.get('fields'), MESSAGE_FIELDS, required=('id', 'created_at'))
+        query = supabase.table('messages').select(fields).eq('conversation_id', conversation_id)
+
+        if not any(k in request.args for k in ('limit', 'before', 'after')):
+            result = query.order('created_at').execute()
+            return conditional_json({'success': True, 'messages': result.data})
+
+        page = paginate(query, 'created_at', 'id', parse_limit(request.args.get('limit')),
+                        before=request.args.get('before'), after=request.args.get('after'), newest_first=False)
+        return conditional_json({'success': True, 'messages': page['items'], 'before': page['before'],
+                                 'after': page['after'], 'has_more': page['has_more']})
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f'❌ Error in get_conversation: {str(e)}')
+        log.error('Error in get_conversation', conversation_id=conversation_id, error=str(e))
         return jsonify({'error': str(e)}), 500
 
 # Get all active conversations
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    """Get all active conversations"""
+    """
+    Get active conversations, most recent first.
+
+    Without paging parameters every active conversation is returned.
+    With ?limit=, ?before=<cursor> or ?after=<cursor> one keyset page on
+    (last_message_time, conversation_id) is returned plus cursors.
+    ?fields= limits the returned columns, e.g.
+    fields=conversation_id,customer_name,page_id,last_message_time
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'), CONVERSATION_FIELDS,
+                              required=('conversation_id', 'last_message_time'))
+        query = supabase.table('conversations').select(fields).eq('status', 'active')
+
+        if not any(k in request.args for k in ('limit', 'before', 'after')):
+            result = query.order('last_message_time', desc=True).execute()
+            return conditional_json({'success': True, 'conversations': result.data})
+
+        page = paginate(query, 'last_message_time', 'conversation_id', parse_limit(request.args.get('limit')),
+                        before=request.args.get('before'), after=request.args.get('after'))
+        return conditional_json({'success': True, 'conversations': page['items'], 'before': page['before'],
+                                 'after': page['after'], 'has_more': page['has_more']})
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error('Error in get_conversations', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# DELTA SYNC - rows changed since a cursor
+# ============================================
+@app.route('/api/conversations/changes', methods=['GET'])
+def get_conversation_changes():
+    """
+    Conversations touched after ?since=<cursor> (any status), oldest first.
+
+    Returns the rows plus a new cursor to pass on the next call. Without
+    `since` the sync starts from the beginning. A conversation counts as
+    changed when its last_message_time moves, i.e. on every new message.
+    Rows from the last CHANGES_SETTLE_SECONDS come back on the next call
+    too - clients dedupe by conversation_id.
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'), CONVERSATION_FIELDS,
+                              required=('conversation_id', 'last_message_time'))
+        query = supabase.table('conversations').select(fields)
+        changes = changes_since(query, 'last_message_time', 'conversation_id', request.args.get('since'),
+                                parse_limit(request.args.get('limit')))
+        return conditional_json({'success': True, 'conversations': changes['items'],
+                                 'cursor': changes['cursor'], 'has_more': changes['has_more']})
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error('Error in get_conversation_changes', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/conversation/<conversation_id>/messages', methods=['GET'])
+def get_message_changes(conversation_id):
+    """
+    Messages of a conversation created after ?since=<cursor>, oldest first, plus the new cursor.
+    Messages from the last CHANGES_SETTLE_SECONDS come back on the next call too - clients dedupe by id.
+    """
     try:
-        result = supabase.table('conversations').select('*').eq('status', 'active').order('last_message_time', desc=True).execute()
-        return jsonify({'success': True, 'conversations': result.data}), 200
+        fields = parse_fields(request.args.get('fields'), MESSAGE_FIELDS, required=('id', 'created_at'))
+        query = supabase.table('messages').select(fields).eq('conversation_id', conversation_id)
+        changes = changes_since(query, 'created_at', 'id', request.args.get('since'),
+                                parse_limit(request.args.get('limit')))
+        return conditional_json({'success': True, 'messages': changes['items'],
+                                 'cursor': changes['cursor'], 'has_more': changes['has_more']})
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f'❌ Error in get_conversations: {str(e)}')
+        log.error('Error in get_message_changes', conversation_id=conversation_id, error=str(e))
         return jsonify({'error': str(e)}), 500
 
 # ============================================
-# BACKFILL CUSTOMER NAMES (One-time script)
+# BACKFILL CUSTOMER NAMES (background job)
 # ============================================
+name_backfill = NameBackfill(supabase, job_store, get_page_config, on_name=name_cache.set,
+                             on_complete=name_cache.save)
+name_backfill.watch()
+
 @app.route('/api/backfill-names', methods=['POST', 'OPTIONS'])
 def backfill_customer_names():
     """
-    One-time script to fetch real names for existing conversations
-    Queries the FIRST message from each conversation to get sender name
+    Fetch real names for existing conversations in the background.
+    Returns the job id right away (202); progress is at /api/jobs/<job_id>.
+    If a backfill is already running its job is returned instead, and a
+    failed one is resumed from its last checkpoint.
     """
     
     # Handle preflight OPTIONS request
@@ -535,96 +1333,88 @@ def backfill_customer_names():
         return '', 204
     
     try:
-        print('🔄 Starting customer name backfill...')
-        
-        # Get all conversations that need names updated
-        result = supabase.table('conversations').select('*').eq('status', 'active').execute()
-        conversations = result.data or []
-        
-        print(f'📊 Found {len(conversations)} conversations to check')
-        
-        updated_count = 0
-        failed_count = 0
-        skipped_count = 0
-        
-        for conv in conversations:
-            conversation_id = conv.get('conversation_id')
-            customer_name = conv.get('customer_name', '')
-            page_id = conv.get('page_id')
-            
-            # Skip if already has a real name (not auto-generated)
-            if customer_name and not customer_name.startswith('Customer ') and not customer_name.startswith('User #') and customer_name != 'Unknown':
-                print(f'⏭️ Skipping {conversation_id} - already has name: {customer_name}')
-                skipped_count += 1
-                continue
-            
-            # Get the FIRST customer message from this conversation
-            messages_result = supabase.table('messages').select('*').eq('conversation_id', conversation_id).eq('sender_type', 'customer').order('created_at').limit(1).execute()
-            
-            if not messages_result.data or len(messages_result.data) == 0:
-                print(f'⚠️ No customer messages found for {conversation_id}')
-                failed_count += 1
-                continue
-            
-            first_message = messages_result.data[0]
-            message_id = first_message.get('message_id')
-            
-            if not message_id:
-                print(f'⚠️ No message_id for {conversation_id}')
-                failed_count += 1
-                continue
-            
-            # Get page config for access token
-            page_config = get_page_config(page_id)
-            if not page_config:
-                print(f'⚠️ Page {page_id} not configured')
-                failed_count += 1
-                continue
-            
-            access_token = page_config.get('accessToken')
-            
-            # Fetch name using Message ID method
-            real_name = get_sender_name_from_message(message_id, access_token)
-            
-            if real_name and real_name != 'Unknown' and not real_name.startswith('Customer '):
-                # Update conversation with real name
-                supabase.table('conversations').update({
-                    'customer_name': real_name,
-                    'customer_name_fetched': True
-                }).eq('conversation_id', conversation_id).execute()
-                
-                print(f'✅ Updated {conversation_id}: {customer_name} → {real_name}')
-                updated_count += 1
-            else:
-                print(f'❌ Could not fetch name for {conversation_id} (message_id: {message_id})')
-                failed_count += 1
-            
-            # Small delay to avoid rate limiting
-            time.sleep(0.5)
-        
-        summary = {
-            'total_checked': len(conversations),
-            'updated': updated_count,
-            'failed': failed_count,
-            'skipped': skipped_count,
-            'success': True
-        }
-        
-        print(f'✨ Backfill complete: {updated_count} updated, {failed_count} failed, {skipped_count} skipped')
-        
-        return jsonify(summary), 200
+        job, created = name_backfill.start()
+        return jsonify({
+            'success': True,
+            'job_id': job['id'],
+            'created': created,
+            'status': job['status'],
+            'status_url': f"/api/jobs/{job['id']}"
+        }), 202
         
     except Exception as e:
-        print(f'❌ Error in backfill_customer_names: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        log.exception('Error in backfill_customer_names', error=str(e))
         return jsonify({'error': str(e), 'success': False}), 500
 
 # ============================================
-# VALIDATE TOKENS ON STARTUP
+# Background job status
+# ============================================
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Status and progress of any background job (backfill, queued send, ...)"""
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job}), 200
+
+# ============================================
+# Page registry hot reload
 # ============================================
-from config import validate_all_tokens
-validate_all_tokens()
+# SIGHUP or POST /api/admin/pages/reload reloads this worker and tells the
+# others (shared cache broadcast); every worker also polls PAGES_FILE and
+# reloads when it changes - locally only, since each worker sees the edit.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PAGES_RELOAD_INTERVAL = float(os.environ.get('PAGES_RELOAD_INTERVAL', 5))
+
+def reload_pages_safely(reason, broadcast=True):
+    try:
+        summary = reload_pages(broadcast=broadcast)
+        if summary['added'] or summary['changed']:
+            # Check new / replaced tokens now instead of at the next refresh
+            threading.Thread(target=token_validator.refresh, name='token-validation-reload', daemon=True).start()
+        return summary
+    except Exception as e:
+        log.error('Page reload failed, keeping current pages', reason=reason, error=str(e))
+        return None
+
+@app.route('/api/admin/pages/reload', methods=['POST'])
+def admin_reload_pages():
+    """Reload pages from env + PAGES_FILE (requires Authorization: Bearer <ADMIN_TOKEN>)"""
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not ADMIN_TOKEN or not hmac.compare_digest(supplied, ADMIN_TOKEN):
+        return jsonify({'error': 'Forbidden'}), 403
+    summary = reload_pages_safely('admin')
+    if summary is None:
+        return jsonify({'error': 'Could not load pages file, current pages kept'}), 500
+    return jsonify({'success': True, 'reload': summary}), 200
+
+def watch_pages_file():
+    """Reload when PAGES_FILE changes, so every worker follows an edit"""
+    last_mtime = os.path.getmtime(PAGES_FILE) if os.path.exists(PAGES_FILE) else None
+    while True:
+        time.sleep(PAGES_RELOAD_INTERVAL)
+        try:
+            mtime = os.path.getmtime(PAGES_FILE)
+        except OSError:
+            continue
+        if mtime != last_mtime:
+            last_mtime = mtime
+            # Every worker's watcher sees the same edit - a broadcast would reload them all again
+            reload_pages_safely('file changed', broadcast=False)
+
+if PAGES_FILE and PAGES_RELOAD_INTERVAL > 0:
+    threading.Thread(target=watch_pages_file, name='pages-watch', daemon=True).start()
+
+try:
+    # Handler runs on the main thread - reload on a helper thread so it never waits on a lock held there
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=reload_pages_safely, args=('SIGHUP',), name='pages-reload', daemon=True).start())
+except ValueError:
+    pass  # not imported on the main thread
+
+# Validate page tokens off the boot path (concurrently, cached in a shared file)
+token_validator = TokenValidator(get_pages)
+token_validator.start()
 
 if __name__ == '__main__':
     # For local development with Flask dev server
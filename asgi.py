@@ -0,0 +1,489 @@
+import os
+import re
+import sys
+import json
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import messenger
+from app import (app as flask_app, CORS_ORIGINS, CORS_EXPOSE_HEADERS, async_ingest_pool, accept_webhook_entries,
+                 valid_webhook_signature, send_target, queue_send, store_sent_message_async, write_batcher)
+from config import get_page_config, get_async_supabase, close_async_supabase
+from graph_client import async_graph
+from journal import JournalSyncError
+from pagination import (PaginationError, parse_fields, parse_limit, paginate_query, paginate_page,
+                        changes_query, changes_page, CONVERSATION_FIELDS, MESSAGE_FIELDS)
+from http_utils import conditional_json_parts
+from log import get_logger
+
+# ============================================
+# ASGI ENTRY POINT (asyncio mode)
+# ============================================
+# An ASGI application next to the Flask `app`:
+#
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+#   uvicorn asgi:application --workers 4
+#
+# The hot routes run natively on the event loop and do their outbound I/O
+# with httpx (async_graph, the async Supabase client), so one worker keeps
+# hundreds of Graph / Supabase calls in flight instead of one per thread:
+#   POST /webhook                       entries become asyncio tasks (AsyncIngestPool)
+#   POST /api/send                      (queued sends still go to the send queue)
+#   GET  /api/conversations, /api/conversation/<id>,
+#        /api/conversations/changes, /api/conversation/<id>/messages
+#
+# Every other route (and every OPTIONS preflight) is served by the Flask app
+# unchanged, on a thread pool, so both entry points behave the same. The
+# background machinery (write batcher, send queue, media mirror, ...) is
+# shared with the Flask app and keeps its own threads.
+#
+# Settings (env):
+#   ASGI_WSGI_THREADS            threads for routes served by Flask (default 32);
+#                                each open /api/events stream holds one
+# ============================================
+
+log = get_logger('asgi')
+
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '32'))
+
+# Request bodies bigger than this are spooled to disk before Flask reads them
+WSGI_SPOOL_MEMORY = 1024 * 1024
+
+
+class Request:
+    """The parts of an ASGI HTTP request the native routes need"""
+
+    def __init__(self, scope, receive, params=None):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.params = params or {}
+        self.args = {k: v[0] for k, v in parse_qs(scope.get('query_string', b'').decode('latin-1'),
+                                                  keep_blank_values=True).items()}
+        self.headers = {}
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = f'{self.headers[name]},{value}' if name in self.headers else value
+        self._body = None
+
+    async def body(self):
+        if self._body is None:
+            self._body = await read_body(self.receive)
+        return self._body
+
+    async def json(self):
+        """Parsed JSON body (None when empty)"""
+        body = await self.body()
+        return json.loads(body) if body else None
+
+
+async def read_body(receive, spool=None):
+    """
+    The whole request body.
+
+    Args:
+        spool: optional file object to write it to instead of returning bytes
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        if spool is not None:
+            spool.write(chunk)
+        else:
+            chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+class Response:
+    def __init__(self, body=b'', status=200, headers=None, content_type='application/json'):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type and status != 304:
+            self.headers.setdefault('Content-Type', content_type)
+
+    async def send(self, send, request):
+        headers = dict(self.headers, **cors_headers(request))
+        headers['Content-Length'] = str(len(self.body))
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def json_response(payload, status=200):
+    return Response(json.dumps(payload, default=str), status=status)
+
+
+def conditional_json_response(request, payload):
+    """conditional_json for the native routes (ETag / 304 / gzip)"""
+    status, headers, body = conditional_json_parts(payload, request.headers.get('if-none-match'),
+                                                   request.headers.get('accept-encoding', ''))
+    return Response(body, status=status, headers=headers)
+
+
+def cors_headers(request):
+    """The headers Flask-CORS adds to /api/* responses for an allowed origin"""
+    origin = request.headers.get('origin')
+    if not request.path.startswith('/api/') or origin not in CORS_ORIGINS:
+        return {}
+    return {'Access-Control-Allow-Origin': origin, 'Access-Control-Expose-Headers': ', '.join(CORS_EXPOSE_HEADERS),
+            'Vary': 'Origin'}
+
+
+# ============================================
+# Native routes
+# ============================================
+
+async def webhook(request):
+    if not valid_webhook_signature(await request.body(), request.headers.get('x-hub-signature-256')):
+        log.warning('Webhook signature mismatch')
+        return Response('Forbidden', status=403, content_type='text/plain')
+    try:
+        body = await request.json()
+    except ValueError:
+        return Response('Bad Request', status=400, content_type='text/plain')
+
+    if isinstance(body, dict) and body.get('object') == 'page':
+        # Acknowledge (and process, as tasks on this loop) once the entries are journaled -
+        # dedup and journal writes hit SQLite / the disk, so they run off the event loop
+        try:
+            entries = await asyncio.to_thread(accept_webhook_entries, body)
+        except JournalSyncError:
+            return Response('Service Unavailable', status=503, content_type='text/plain')
+        for entry in entries:
+            await async_ingest_pool.submit(entry)
+        return Response('EVENT_RECEIVED', content_type='text/html; charset=utf-8')
+    return Response('Not Found', status=404, content_type='text/html; charset=utf-8')
+
+
+async def send_message(request):
+    """POST /api/send without holding a thread for the Graph call"""
+    try:
+        data = await request.json() or {}
+        page_id = data.get('page_id')
+        recipient_id = data.get('recipient_id')
+        message_text = data.get('message_text')
+        use_human_agent_tag = data.get('use_human_agent_tag', False)
+        use_async = data.get('async', False) or request.args.get('async', 'false').lower() == 'true'
+
+        log.info('Send message request', page_id=page_id, recipient_id=recipient_id,
+                 use_tag=use_human_agent_tag, sample=page_id)
+
+        access_token, error = send_target(page_id, recipient_id, message_text)
+        if error:
+            return json_response(*error)
+
+        if use_async:
+            return json_response(*queue_send('send_text', page_id, recipient_id, {'message_text': message_text},
+                                             message_text=message_text,
+                                             use_human_agent_tag=bool(use_human_agent_tag)))
+
+        status_code, response_data = await messenger.send_text_async(page_id, access_token, recipient_id,
+                                                                     message_text, use_human_agent_tag)
+        if status_code == 200:
+            await store_sent_message_async(page_id, recipient_id, response_data.get('message_id'), message_text)
+            log.info('Message sent', page_id=page_id, message_id=response_data.get('message_id'), sample=page_id)
+            return json_response({'success': True, 'data': response_data})
+
+        error_msg, error_code = messenger.error_details(response_data)
+        log.error('Facebook API error sending message', page_id=page_id, code=error_code, error=error_msg)
+        return json_response({'error': f'Facebook error: {error_msg}', 'code': error_code}, status_code)
+
+    except Exception as e:
+        log.exception('Error in send_message', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+
+async def get_conversations(request):
+    try:
+        fields = parse_fields(request.args.get('fields'), CONVERSATION_FIELDS,
+                              required=('conversation_id', 'last_message_time'))
+        client = await get_async_supabase()
+        query = client.table('conversations').select(fields).eq('status', 'active')
+
+        if not any(k in request.args for k in ('limit', 'before', 'after')):
+            result = await query.order('last_message_time', desc=True).execute()
+            return conditional_json_response(request, {'success': True, 'conversations': result.data})
+
+        limit = parse_limit(request.args.get('limit'))
+        before, after = request.args.get('before'), request.args.get('after')
+        result = await paginate_query(query, 'last_message_time', 'conversation_id', limit, before, after).execute()
+        page = paginate_page(result.data or [], 'last_message_time', 'conversation_id', limit, after)
+        return conditional_json_response(request, {'success': True, 'conversations': page['items'],
+                                                   'before': page['before'], 'after': page['after'],
+                                                   'has_more': page['has_more']})
+    except PaginationError as e:
+        return json_response({'error': str(e)}, 400)
+    except Exception as e:
+        log.error('Error in get_conversations', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+
+async def get_conversation(request):
+    conversation_id = request.params['conversation_id']
+    try:
+        fields = parse_fields(request.args.get('fields'), MESSAGE_FIELDS, required=('id', 'created_at'))
+        client = await get_async_supabase()
+        query = client.table('messages').select(fields).eq('conversation_id', conversation_id)
+
+        if not any(k in request.args for k in ('limit', 'before', 'after')):
+            result = await query.order('created_at').execute()
+            return conditional_json_response(request, {'success': True, 'messages': result.data})
+
+        limit = parse_limit(request.args.get('limit'))
+        before, after = request.args.get('before'), request.args.get('after')
+        result = await paginate_query(query, 'created_at', 'id', limit, before, after).execute()
+        page = paginate_page(result.data or [], 'created_at', 'id', limit, after, newest_first=False)
+        return conditional_json_response(request, {'success': True, 'messages': page['items'],
+                                                   'before': page['before'], 'after': page['after'],
+                                                   'has_more': page['has_more']})
+    except PaginationError as e:
+        return json_response({'error': str(e)}, 400)
+    except Exception as e:
+        log.error('Error in get_conversation', conversation_id=conversation_id, error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+
+async def get_conversation_changes(request):
+    try:
+        fields = parse_fields(request.args.get('fields'), CONVERSATION_FIELDS,
+                              required=('conversation_id', 'last_message_time'))
+        client = await get_async_supabase()
+        since, limit = request.args.get('since'), parse_limit(request.args.get('limit'))
+        query = changes_query(client.table('conversations').select(fields), 'last_message_time', 'conversation_id',
+                              since, limit)
+        changes = changes_page((await query.execute()).data or [], 'last_message_time', 'conversation_id',
+                               since, limit)
+        return conditional_json_response(request, {'success': True, 'conversations': changes['items'],
+                                                   'cursor': changes['cursor'], 'has_more': changes['has_more']})
+    except PaginationError as e:
+        return json_response({'error': str(e)}, 400)
+    except Exception as e:
+        log.error('Error in get_conversation_changes', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+
+async def get_message_changes(request):
+    conversation_id = request.params['conversation_id']
+    try:
+        fields = parse_fields(request.args.get('fields'), MESSAGE_FIELDS, required=('id', 'created_at'))
+        client = await get_async_supabase()
+        since, limit = request.args.get('since'), parse_limit(request.args.get('limit'))
+        query = changes_query(client.table('messages').select(fields).eq('conversation_id', conversation_id),
+                              'created_at', 'id', since, limit)
+        changes = changes_page((await query.execute()).data or [], 'created_at', 'id', since, limit)
+        return conditional_json_response(request, {'success': True, 'messages': changes['items'],
+                                                   'cursor': changes['cursor'], 'has_more': changes['has_more']})
+    except PaginationError as e:
+        return json_response({'error': str(e)}, 400)
+    except Exception as e:
+        log.error('Error in get_message_changes', conversation_id=conversation_id, error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+
+ROUTES = [
+    ('POST', r'/webhook', webhook),
+    ('POST', r'/api/send', send_message),
+    ('GET', r'/api/conversations', get_conversations),
+    ('GET', r'/api/conversations/changes', get_conversation_changes),
+    ('GET', r'/api/conversation/(?P<conversation_id>[^/]+)', get_conversation),
+    ('GET', r'/api/conversation/(?P<conversation_id>[^/]+)/messages', get_message_changes),
+]
+ROUTES = [(method, re.compile(pattern + r'/?\Z'), handler) for method, pattern, handler in ROUTES]
+
+
+def match_route(method, path):
+    for route_method, pattern, handler in ROUTES:
+        if route_method == method:
+            match = pattern.match(path)
+            if match:
+                return handler, match.groupdict()
+    return None, None
+
+
+# ============================================
+# Everything else: the Flask app on a thread pool
+# ============================================
+
+class WSGIBridge:
+    """
+    Serve a WSGI app from ASGI. The app runs on a thread pool; its response
+    is streamed back chunk by chunk (SSE and NDJSON routes keep working) and
+    a client disconnect stops the iteration at the next chunk.
+    """
+
+    def __init__(self, wsgi_app, threads=ASGI_WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi-wsgi')
+            self._pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=WSGI_SPOOL_MEMORY)
+        await read_body(receive, spool=body)
+        length = body.tell()
+        body.seek(0)
+        environ = self._environ(scope, body, length)
+
+        chunks = asyncio.Queue(maxsize=16)
+        disconnected = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(('start', (int(status.split(' ', 1)[0]), headers)))
+
+        def run():
+            try:
+                iterable = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if disconnected.is_set():
+                            break
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+            except Exception as e:
+                log.exception('Error in WSGI app', path=scope['path'], error=str(e))
+                put(('error', None))
+            finally:
+                body.close()
+                put(('end', None))
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = loop.create_task(watch_disconnect())
+        worker = loop.run_in_executor(self._pool(), run)
+        start = None
+        opened = closed = False
+        try:
+            while True:
+                kind, value = await chunks.get()
+                if kind == 'start':
+                    start = value
+                    continue
+                if kind == 'end':
+                    break
+                if closed or disconnected.is_set():
+                    continue  # keep draining so the thread can finish
+                try:
+                    if kind == 'error' or start is None:
+                        if not opened:
+                            await send({'type': 'http.response.start', 'status': 500,
+                                        'headers': [(b'content-type', b'text/plain')]})
+                            opened = True
+                        await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                        closed = True
+                        continue
+                    if not opened:
+                        await self._start(send, start)
+                        opened = True
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+                except OSError:
+                    disconnected.set()
+
+            if not closed and not disconnected.is_set():
+                if not opened:
+                    await self._start(send, start or (500, []))
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            await worker
+
+    @staticmethod
+    async def _start(send, start):
+        status, headers = start
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+
+    @staticmethod
+    def _environ(scope, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+
+wsgi_bridge = WSGIBridge(flask_app)
+
+
+async def shutdown():
+    """Finish queued webhook entries, flush writes and close the async clients"""
+    await async_ingest_pool.shutdown()
+    await asyncio.to_thread(write_batcher.flush)
+    await async_graph.aclose()
+    await close_async_supabase()
+
+
+async def application(scope, receive, send):
+    """The ASGI app"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await shutdown()
+                except Exception as e:
+                    log.warning('Error during ASGI shutdown', error=str(e))
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    handler, params = match_route(scope['method'], scope['path'])
+    if handler is None:
+        return await wsgi_bridge(scope, receive, send)
+
+    request = Request(scope, receive, params)
+    response = await handler(request)
+    await response.send(send, request)
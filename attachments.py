@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import messenger
+from log import get_logger
+
+# ============================================
+# OUTBOUND ATTACHMENT CACHE
+# ============================================
+# Facebook keeps reusable uploads, so an image only has to be uploaded
+# once per page. Uploads are spooled to a temp file and hashed on the way;
+# (page_id, sha256) -> attachment_id is kept in a local SQLite file shared
+# by all gunicorn workers. A repeat image is then sent by attachment_id:
+# a small JSON POST instead of a multi-MB multipart upload.
+#
+# Settings (env):
+#   ATTACHMENT_DB_PATH        SQLite file shared by workers (default attachments.sqlite3)
+#   ATTACHMENT_SPOOL_MEMORY   upload bytes kept in memory before spilling to disk (default 1 MB)
+# ============================================
+
+log = get_logger('attachments')
+
+ATTACHMENT_DB_PATH = os.getenv('ATTACHMENT_DB_PATH', 'attachments.sqlite3')
+ATTACHMENT_SPOOL_MEMORY = int(os.getenv('ATTACHMENT_SPOOL_MEMORY', str(1024 * 1024)))
+
+# Graph rejects a cached attachment_id Facebook no longer has with a generic
+# (#100) invalid-parameter error - only one whose message names the
+# attachment id counts as stale, not any other bad parameter
+STALE_ATTACHMENT_ERROR_CODES = {100}
+STALE_ATTACHMENT_MESSAGE = re.compile(r'attachment[ _]?id', re.IGNORECASE)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _stale_attachment(response_data):
+    """True if a send by attachment_id failed because the id itself is no longer valid"""
+    error_message, error_code = messenger.error_details(response_data)
+    return error_code in STALE_ATTACHMENT_ERROR_CODES and bool(STALE_ATTACHMENT_MESSAGE.search(error_message))
+
+
+class SpooledUpload:
+    """An uploaded file copied to a spooled temp file, with its sha256"""
+
+    def __init__(self, filename, content_type, file, sha256, size):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.sha256 = sha256
+        self.size = size
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+def spool_upload(file_storage, max_memory=ATTACHMENT_SPOOL_MEMORY):
+    """
+    Copy an uploaded file (werkzeug FileStorage) into a SpooledTemporaryFile,
+    hashing it in chunks so the image is never held in memory as one buffer.
+
+    Returns:
+        SpooledUpload: rewound and ready to stream to Graph
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = file_storage.stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return SpooledUpload(file_storage.filename, file_storage.content_type, spool, digest.hexdigest(), size)
+
+
+class AttachmentCache:
+    """Shared (page_id, sha256) -> attachment_id map"""
+
+    def __init__(self, path=ATTACHMENT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.store_errors = 0
+
+        if self.path:
+            try:
+                self._conn().execute('CREATE TABLE IF NOT EXISTS attachments ('
+                                     'page_id TEXT NOT NULL, sha256 TEXT NOT NULL, attachment_id TEXT NOT NULL, '
+                                     'created_at REAL NOT NULL, PRIMARY KEY (page_id, sha256))')
+            except sqlite3.Error as e:
+                log.warning('Attachment cache unavailable, uploads will not be reused', path=self.path, error=str(e))
+                self.path = ''
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, page_id, sha256):
+        if not self.path:
+            return None
+        try:
+            row = self._conn().execute('SELECT attachment_id FROM attachments WHERE page_id = ? AND sha256 = ?',
+                                       (str(page_id), sha256)).fetchone()
+        except sqlite3.Error as e:
+            self.store_errors += 1
+            log.warning('Attachment cache error', error=str(e))
+            return None
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def set(self, page_id, sha256, attachment_id):
+        if not self.path or not attachment_id:
+            return
+        try:
+            self._conn().execute('INSERT OR REPLACE INTO attachments (page_id, sha256, attachment_id, created_at) '
+                                 'VALUES (?, ?, ?, ?)', (str(page_id), sha256, str(attachment_id), time.time()))
+        except sqlite3.Error as e:
+            self.store_errors += 1
+            log.warning('Attachment cache error', error=str(e))
+
+    def forget(self, page_id, sha256):
+        if not self.path:
+            return
+        self.invalidated += 1
+        try:
+            self._conn().execute('DELETE FROM attachments WHERE page_id = ? AND sha256 = ?', (str(page_id), sha256))
+        except sqlite3.Error as e:
+            self.store_errors += 1
+            log.warning('Attachment cache error', error=str(e))
+
+    def upload(self, page_id, access_token, upload):
+        """
+        attachment_id for an upload - cached, or uploaded once via me/message_attachments.
+
+        Returns:
+            tuple: (HTTP status code, response JSON with 'attachment_id')
+        """
+        attachment_id = self.get(page_id, upload.sha256)
+        if attachment_id:
+            return 200, {'attachment_id': attachment_id, 'cached': True}
+        status_code, response_data = messenger.upload_attachment(page_id, access_token, upload.filename,
+                                                                 upload.rewind(), upload.content_type)
+        if status_code == 200:
+            self.set(page_id, upload.sha256, response_data.get('attachment_id'))
+        return status_code, response_data
+
+    def send_image(self, page_id, access_token, recipient_id, upload, use_human_agent_tag=False):
+        """
+        Send an image, by cached attachment_id when this page has sent it before.
+
+        A miss is a normal multipart send (is_reusable), whose attachment_id is
+        cached for next time. A cached id Facebook no longer accepts is dropped
+        and the image is uploaded again.
+
+        Returns:
+            tuple: (HTTP status code, response JSON)
+        """
+        attachment_id = self.get(page_id, upload.sha256)
+        if attachment_id:
+            status_code, response_data = messenger.send_attachment(
+                page_id, access_token, recipient_id, attachment_id, use_human_agent_tag=use_human_agent_tag)
+            if status_code == 200:
+                return status_code, dict(response_data, attachment_id=attachment_id, cached=True)
+            if not _stale_attachment(response_data):
+                return status_code, response_data
+            log.info('Cached attachment rejected, uploading again', page_id=page_id, attachment_id=attachment_id)
+            self.forget(page_id, upload.sha256)
+
+        status_code, response_data = messenger.send_image(page_id, access_token, recipient_id, upload.filename,
+                                                          upload.rewind(), upload.content_type, use_human_agent_tag)
+        if status_code == 200:
+            self.set(page_id, upload.sha256, response_data.get('attachment_id'))
+        return status_code, response_data
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+            'store_errors': self.store_errors,
+            'shared_store': bool(self.path)
+        }
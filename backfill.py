@@ -0,0 +1,287 @@
+import os
+import time
+import fcntl
+import threading
+import requests
+from graph_client import graph, GRAPH_BATCH_SIZE
+from name_cache import is_real_name
+from log import get_logger
+
+# ============================================
+# CUSTOMER NAME BACKFILL JOB
+# ============================================
+# Fetches real names for conversations that still show 'Unknown' /
+# 'Customer ...' in the background: POST /api/backfill-names returns a
+# job id right away and GET /api/jobs/<id> reports progress.
+#
+# The job walks active conversations in chunks (keyset on conversation_id)
+# and for each chunk:
+#   1. loads the first customer message of every unnamed conversation with
+#      paged messages queries (MESSAGES_PAGE_SIZE rows each, under the
+#      PostgREST row cap; conversations a full page left out are asked for
+#      again)
+#   2. looks the senders up per page with Graph batch requests
+#      (GRAPH_BATCH_SIZE messages per HTTP call)
+#   3. writes the names back (one update per distinct name, in_ on the
+#      conversation ids) and checkpoints cursor + counters in the job store
+#
+# A job picks up from its last checkpoint: a failed job is resumed by the
+# next POST, and a running job whose worker died (no checkpoint for
+# BACKFILL_LEASE seconds) is taken over by another worker's watcher.
+#
+# Settings (env):
+#   BACKFILL_CHUNK_SIZE   conversations per chunk / checkpoint (default 100)
+#   BACKFILL_LEASE        seconds without a checkpoint before a running job
+#                         is considered abandoned (default 120)
+# ============================================
+
+log = get_logger('backfill')
+
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '100'))
+BACKFILL_LEASE = float(os.getenv('BACKFILL_LEASE', '120'))
+
+JOB_KIND = 'backfill_names'
+
+# Rows per messages query - PostgREST returns at most 1000 by default
+MESSAGES_PAGE_SIZE = 1000
+
+
+class NameBackfill:
+    """
+    Resumable name backfill, run on a background thread.
+
+    Args:
+        supabase: sync Supabase client
+        store: JobStore shared by workers
+        get_page_config: fn(page_id) -> page config or None
+        on_name: fn(page_id, psid, name) for every name found (e.g. name_cache.set)
+        on_complete: fn() when a job finishes (e.g. name_cache.save)
+    """
+
+    def __init__(self, supabase, store, get_page_config, on_name=None, on_complete=None,
+                 chunk_size=BACKFILL_CHUNK_SIZE, lease=BACKFILL_LEASE):
+        self.supabase = supabase
+        self.store = store
+        self.get_page_config = get_page_config
+        self.on_name = on_name
+        self.on_complete = on_complete
+        self.chunk_size = max(1, chunk_size)
+        self.lease = lease
+        self._watcher = None
+        self._pid = None
+
+    def _owner(self):
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def start(self):
+        """
+        Start a backfill, or return the one already in progress. A failed or
+        abandoned job is resumed from its checkpoint rather than restarted.
+
+        Returns:
+            tuple: (job, created)
+        """
+        with open(f'{self.store.path}.backfill.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                active = self.store.find(JOB_KIND, ('queued', 'running'))
+                for job in active:
+                    claimed = self.store.claim(job['id'], self._owner(), stale_after=self.lease)
+                    if claimed:
+                        self._spawn(claimed)
+                        return claimed, False
+                if active:
+                    return active[0], False
+
+                failed = sorted(self.store.find(JOB_KIND, ('failed',)), key=lambda j: j.get('updated_at', 0))
+                if failed:
+                    claimed = self.store.claim(failed[-1]['id'], self._owner(), states=('failed',))
+                    if claimed:
+                        log.info('Resuming failed backfill', job_id=claimed['id'], cursor=claimed.get('cursor'))
+                        self._spawn(claimed)
+                        return claimed, False
+
+                job = self.store.create(JOB_KIND, cursor=None, total=None, scanned=0, updated=0, failed=0,
+                                        skipped=0, graph_batches=0, started_at=time.time(), finished_at=None,
+                                        error=None)
+                job = self.store.claim(job['id'], self._owner())
+                self._spawn(job)
+                return job, True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def watch(self):
+        """Take over abandoned jobs (their worker died) every lease / 2 seconds"""
+        if self._pid == os.getpid() and self._watcher:
+            return
+        self._pid = os.getpid()
+        self._watcher = threading.Thread(target=self._watch, name='backfill-watch', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(max(1.0, self.lease / 2))
+            try:
+                for job in self.store.find(JOB_KIND, ('running',)):
+                    claimed = self.store.claim(job['id'], self._owner(), states=(), stale_after=self.lease)
+                    if claimed:
+                        log.warning('Taking over abandoned backfill', job_id=claimed['id'],
+                                    cursor=claimed.get('cursor'))
+                        self._spawn(claimed)
+            except Exception as e:
+                log.warning('Backfill watch failed', error=str(e))
+
+    def _spawn(self, job):
+        threading.Thread(target=self._run, args=(job,), name=f'backfill-{job["id"][:8]}', daemon=True).start()
+
+    # ---------- the job ----------
+
+    def _run(self, job):
+        # The claim recorded the spawning thread; the job is now this thread's
+        job = self.store.update(job, owner=self._owner(), error=None)
+        log.info('Starting customer name backfill', job_id=job['id'], cursor=job.get('cursor'))
+        try:
+            if job.get('total') is None:
+                job['total'] = self._count()
+            while True:
+                current = self.store.get(job['id'])
+                if not current or current.get('owner') != job['owner']:
+                    log.warning('Backfill taken over by another worker', job_id=job['id'])
+                    return
+                conversations = self._next_chunk(job.get('cursor'))
+                if not conversations:
+                    break
+                self._backfill_chunk(conversations, job)
+                job['scanned'] += len(conversations)
+                job['cursor'] = conversations[-1]['conversation_id']
+                if job.get('total'):
+                    job['progress'] = round(min(1.0, job['scanned'] / job['total']), 4)
+                self.store.save(job)  # checkpoint
+            self.store.update(job, status='completed', progress=1.0, finished_at=time.time())
+            log.info('Backfill complete', job_id=job['id'], updated=job['updated'], failed=job['failed'],
+                     skipped=job['skipped'], graph_batches=job['graph_batches'])
+        except Exception as e:
+            log.exception('Backfill failed', job_id=job['id'], cursor=job.get('cursor'), error=str(e))
+            self.store.update(job, status='failed', error=str(e))
+        finally:
+            if self.on_complete:
+                try:
+                    self.on_complete()
+                except Exception as e:
+                    log.warning('Backfill completion hook failed', error=str(e))
+
+    def _count(self):
+        try:
+            result = self.supabase.table('conversations').select('conversation_id', count='exact') \
+                .eq('status', 'active').limit(1).execute()
+            return result.count
+        except Exception as e:
+            log.warning('Could not count conversations for backfill', error=str(e))
+            return None
+
+    def _next_chunk(self, cursor):
+        query = self.supabase.table('conversations').select('conversation_id,page_id,customer_psid,customer_name') \
+            .eq('status', 'active')
+        if cursor:
+            query = query.gt('conversation_id', cursor)
+        return query.order('conversation_id').limit(self.chunk_size).execute().data or []
+
+    def _first_customer_messages(self, conversation_ids):
+        """
+        {conversation_id: message_id} of each conversation's first customer message.
+
+        Rows come grouped by conversation (oldest first), so every conversation
+        a page reaches has its first message in it. A full page may have left
+        conversations out; those are requested again until a short page
+        shows the rest have no customer message.
+        """
+        first = {}
+        remaining = list(conversation_ids)
+        while remaining:
+            rows = self.supabase.table('messages').select('conversation_id,message_id,created_at') \
+                .in_('conversation_id', remaining).eq('sender_type', 'customer') \
+                .order('conversation_id').order('created_at').limit(MESSAGES_PAGE_SIZE).execute().data or []
+            for row in rows:
+                if row.get('message_id'):
+                    first.setdefault(row['conversation_id'], row['message_id'])
+            if len(rows) < MESSAGES_PAGE_SIZE:
+                break
+            seen = {row['conversation_id'] for row in rows}
+            remaining = [cid for cid in remaining if cid not in seen]
+        return first
+
+    def _backfill_chunk(self, conversations, job):
+        # Skip conversations that already have a real name (not auto-generated)
+        candidates = [conv for conv in conversations if not is_real_name(conv.get('customer_name'))]
+        job['skipped'] += len(conversations) - len(candidates)
+        if not candidates:
+            return
+
+        first = self._first_customer_messages([conv['conversation_id'] for conv in candidates])
+        by_page = {}
+        for conv in candidates:
+            message_id = first.get(conv['conversation_id'])
+            if not message_id:
+                log.warning('Backfill found no customer message', conversation_id=conv['conversation_id'])
+                job['failed'] += 1
+                continue
+            by_page.setdefault(conv.get('page_id'), []).append((conv, message_id))
+
+        found = []
+        for page_id, lookups in by_page.items():
+            page_config = self.get_page_config(page_id)
+            if not page_config:
+                log.warning('Page not configured', page_id=page_id)
+                job['failed'] += len(lookups)
+                continue
+            for start in range(0, len(lookups), GRAPH_BATCH_SIZE):
+                found.extend(self._backfill_batch(page_id, page_config.get('accessToken'),
+                                                  lookups[start:start + GRAPH_BATCH_SIZE], job))
+        self._save_names(found, job)
+
+    def _backfill_batch(self, page_id, access_token, lookups, job):
+        """
+        Returns:
+            list: (page_id, conversation, name) for every real name found
+        """
+        try:
+            results = graph.batch([{'method': 'GET', 'relative_url': f'{message_id}?fields=from'}
+                                   for _, message_id in lookups], access_token=access_token, page_id=page_id)
+            job['graph_batches'] += 1
+        except requests.exceptions.RequestException as e:
+            log.warning('Backfill batch lookup failed', page_id=page_id, count=len(lookups), error=str(e))
+            job['failed'] += len(lookups)
+            return []
+
+        found = []
+        for (conv, message_id), (code, body) in zip(lookups, results):
+            name = ((body or {}).get('from') or {}).get('name') if code == 200 else None
+            if not is_real_name(name):
+                log.warning('Backfill could not fetch name', conversation_id=conv['conversation_id'],
+                            message_id=message_id, code=code)
+                job['failed'] += 1
+                continue
+            found.append((page_id, conv, name))
+        return found
+
+    def _save_names(self, found, job):
+        """
+        Write a chunk's names - updates only, so a conversation deleted
+        meanwhile is not re-created. Conversations sharing a name get one
+        update between them.
+        """
+        by_name = {}
+        for _, conv, name in found:
+            by_name.setdefault(name, []).append(conv['conversation_id'])
+        for name, conversation_ids in by_name.items():
+            self.supabase.table('conversations').update({
+                'customer_name': name,
+                'customer_name_fetched': True
+            }).in_('conversation_id', conversation_ids).execute()
+
+        for page_id, conv, name in found:
+            if self.on_name:
+                self.on_name(page_id, conv.get('customer_psid'), name)
+            log.info('Backfill updated name', conversation_id=conv['conversation_id'],
+                     old_name=conv.get('customer_name'), new_name=name, sample=page_id)
+        job['updated'] += len(found)
@@ -0,0 +1,311 @@
+import os
+import time
+import threading
+import atexit
+from collections import OrderedDict
+from unreplied import mark_replied
+from receipts import mark_receipt, RECEIPT_STATUSES
+from log import get_logger
+
+# ============================================
+# WRITE-BEHIND BATCHER
+# ============================================
+# Collects conversation writes and message rows from the ingest workers
+# and flushes them to Supabase as bulk requests:
+#   1. new conversations  -> one insert-if-missing upsert
+#   2. conversation touches (last_message_time / name) -> one merge upsert
+#   3. messages           -> one bulk insert
+#   4. reply watermarks   -> one ranged replied=True update per conversation
+#   5. receipt watermarks -> one ranged delivered / read status update per
+#                            conversation (a read covers an older delivery;
+#                            watermarks already applied are dropped)
+#
+# A flush happens when BATCH_MAX_ROWS rows are pending or BATCH_MAX_DELAY_MS
+# has passed since the oldest pending row, and once more on shutdown.
+# The optional on_messages_written / on_messages_failed hooks get the
+# message ids of every flushed message row (the webhook journal acks or
+# replays them).
+#
+# Settings (env):
+#   BATCH_MAX_ROWS       pending rows that trigger a flush (default 100)
+#   BATCH_MAX_DELAY_MS   max time a row waits before a flush (default 50)
+# ============================================
+
+log = get_logger('batcher')
+
+BATCH_MAX_ROWS = int(os.getenv('BATCH_MAX_ROWS', '100'))
+BATCH_MAX_DELAY_MS = float(os.getenv('BATCH_MAX_DELAY_MS', '50'))
+
+# (conversation, status) receipt watermarks remembered after a flush, so
+# repeated receipts with the same watermark cost no write
+APPLIED_RECEIPTS_SIZE = 10000
+
+
+class WriteBatcher:
+    """
+    Size/time triggered write-behind buffer for conversations and messages.
+
+    Touches for the same conversation are coalesced (later values win), so a
+    burst from one customer becomes a single conversation row in the flush.
+    """
+
+    def __init__(self, supabase, max_rows=BATCH_MAX_ROWS, max_delay_ms=BATCH_MAX_DELAY_MS,
+                 on_messages_written=None, on_messages_failed=None):
+        self.supabase = supabase
+        self.on_messages_written = on_messages_written
+        self.on_messages_failed = on_messages_failed
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay_ms / 1000.0
+        self._cond = threading.Condition()
+        self._new_conversations = {}   # conversation_id -> full row
+        self._touches = {}             # conversation_id -> partial row
+        self._messages = []
+        self._watermarks = {}          # conversation_id -> latest agent reply time
+        self._receipts = {}            # (conversation_id, status) -> latest receipt watermark
+        self._applied_receipts = OrderedDict()
+        self._oldest = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+        # Stats
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.failed_rows = 0
+        self.receipts_coalesced = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    # ---------- producers ----------
+
+    def add_new_conversation(self, row):
+        """Queue an insert-if-missing for a conversation row"""
+        self._add(lambda: self._new_conversations.setdefault(row['conversation_id'], row))
+
+    def touch_conversation(self, row):
+        """Queue an update for an existing conversation (must include conversation_id)"""
+        def merge():
+            pending = self._touches.setdefault(row['conversation_id'], {})
+            pending.update(row)
+        self._add(merge)
+
+    def add_message(self, row):
+        """Queue a messages row for bulk insert"""
+        self._add(lambda: self._messages.append(row))
+
+    def add_reply_watermark(self, conversation_id, watermark):
+        """Queue marking a conversation's customer messages up to `watermark` as replied"""
+        def merge():
+            if watermark > self._watermarks.get(conversation_id, ''):
+                self._watermarks[conversation_id] = watermark
+        self._add(merge)
+
+    def add_receipt_watermark(self, conversation_id, status, watermark):
+        """Queue marking the page's messages up to `watermark` as delivered / read"""
+        def merge():
+            key = (conversation_id, status)
+            if key in self._receipts or watermark <= self._applied_receipts.get(key, ''):
+                self.receipts_coalesced += 1
+            if watermark > max(self._receipts.get(key, ''), self._applied_receipts.get(key, '')):
+                self._receipts[key] = watermark
+        self._add(merge)
+
+    def _add(self, mutate):
+        self._ensure_started()
+        with self._cond:
+            mutate()
+            if self._stopping:
+                # Flush thread is gone (late writes during shutdown) - write through
+                batch = self._take()
+            else:
+                batch = None
+                if self._oldest is None:
+                    # Wake the flush thread to start the delay timer
+                    self._oldest = time.monotonic()
+                    self._cond.notify()
+                elif self._pending() >= self.max_rows:
+                    self._cond.notify()
+        if batch:
+            self._flush(*batch)
+
+    def _pending(self):
+        return len(self._new_conversations) + len(self._touches) + len(self._messages) + len(self._watermarks) \
+            + len(self._receipts)
+
+    # ---------- flush thread ----------
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread:
+            return
+        with self._cond:
+            if self._pid == os.getpid() and self._thread:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-batcher', daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._oldest is not None:
+                        remaining = self.max_delay - (time.monotonic() - self._oldest)
+                        if remaining <= 0 or self._pending() >= self.max_rows:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                batch = self._take()
+                stopping = self._stopping
+            if batch:
+                self._flush(*batch)
+            if stopping:
+                return
+
+    def _take(self):
+        if not self._pending():
+            return None
+        batch = (list(self._new_conversations.values()), list(self._touches.values()), self._messages,
+                 list(self._watermarks.items()), self._receipts)
+        self._new_conversations = {}
+        self._touches = {}
+        self._messages = []
+        self._watermarks = {}
+        self._receipts = {}
+        self._oldest = None
+        return batch
+
+    def flush(self):
+        """Flush everything pending from the calling thread"""
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._flush(*batch)
+
+    def _flush(self, new_conversations, touches, messages, watermarks, receipts):
+        started = time.monotonic()
+        size = len(new_conversations) + len(touches) + len(messages) + len(watermarks) + len(receipts)
+
+        # Conversations first so messages never reference a missing conversation
+        if new_conversations:
+            self._write('conversations', new_conversations,
+                        lambda rows: self.supabase.table('conversations').upsert(
+                            rows, on_conflict='conversation_id', ignore_duplicates=True).execute())
+        for rows in _group_by_columns(touches):
+            self._write('conversations', rows,
+                        lambda rows: self.supabase.table('conversations').upsert(
+                            rows, on_conflict='conversation_id').execute())
+        for rows in _group_by_columns(messages):
+            failed = self._write('messages', rows,
+                                 lambda rows: self.supabase.table('messages').insert(rows).execute())
+            self._report_messages(rows, failed)
+        # After the messages insert so a reply never misses a message from the same flush
+        for conversation_id, watermark in watermarks:
+            self._write('messages', [conversation_id],
+                        lambda rows: mark_replied(self.supabase, rows[0], watermark))
+        # Receipt watermarks: deliveries first, then reads (which also cover older deliveries)
+        for status in RECEIPT_STATUSES:
+            for (conversation_id, receipt_status), watermark in receipts.items():
+                if receipt_status != status:
+                    continue
+                if status == 'delivered' and watermark <= receipts.get((conversation_id, 'read'), ''):
+                    # The read update covers these messages
+                    continue
+                failed = self._write('messages', [conversation_id],
+                                     lambda rows: mark_receipt(self.supabase, rows[0], status, watermark))
+                if not failed:
+                    self._remember_receipt((conversation_id, status), watermark)
+
+        elapsed = time.monotonic() - started
+        self.flushes += 1
+        self.rows_flushed += size
+        self.last_flush_size = size
+        self.max_flush_size = max(self.max_flush_size, size)
+        self.last_flush_ms = elapsed * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.total_flush_ms += self.last_flush_ms
+        log.debug('Flushed batch', rows=size, messages=len(messages), ms=round(self.last_flush_ms, 1))
+
+    def _write(self, table, rows, execute):
+        """
+        Bulk write; on failure retry row by row so one bad row doesn't drop the batch.
+
+        Returns:
+            list: the rows that could not be written
+        """
+        try:
+            execute(rows)
+            return []
+        except Exception as e:
+            if len(rows) == 1:
+                self.failed_rows += 1
+                log.error('Error writing row', table=table, error=str(e))
+                return list(rows)
+            log.warning('Bulk write failed, retrying row by row', table=table, rows=len(rows), error=str(e))
+        failed = []
+        for row in rows:
+            try:
+                execute([row])
+            except Exception as e:
+                self.failed_rows += 1
+                failed.append(row)
+                log.exception('Error writing row', table=table, error=str(e))
+        return failed
+
+    def _report_messages(self, rows, failed):
+        failed_keys = {id(row) for row in failed}
+        failed_ids = [row.get('message_id') for row in failed]
+        written_ids = [row.get('message_id') for row in rows if id(row) not in failed_keys]
+        for hook, ids in ((self.on_messages_written, written_ids), (self.on_messages_failed, failed_ids)):
+            if hook and ids:
+                try:
+                    hook(ids)
+                except Exception as e:
+                    log.warning('Message write hook failed', error=str(e))
+
+    def _remember_receipt(self, key, watermark):
+        with self._cond:
+            self._applied_receipts[key] = watermark
+            self._applied_receipts.move_to_end(key)
+            while len(self._applied_receipts) > APPLIED_RECEIPTS_SIZE:
+                self._applied_receipts.popitem(last=False)
+
+    def shutdown(self, timeout=10):
+        """Stop the flush thread after a final flush"""
+        if self._pid != os.getpid() or not self._thread:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            pending = self._pending()
+        return {
+            'pending_rows': pending,
+            'max_rows': self.max_rows,
+            'max_delay_ms': self.max_delay * 1000,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+            'failed_rows': self.failed_rows,
+            'receipts_coalesced': self.receipts_coalesced,
+            'last_flush_size': self.last_flush_size,
+            'max_flush_size': self.max_flush_size,
+            'avg_flush_size': round(self.rows_flushed / self.flushes, 1) if self.flushes else 0,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0
+        }
+
+
+def _group_by_columns(rows):
+    """PostgREST bulk writes need identical keys in every row - split by column set"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return list(groups.values())
@@ -0,0 +1,84 @@
+import random
+import time
+
+# ============================================
+# WEBHOOK PAYLOAD GENERATOR
+# ============================================
+# Builds Messenger webhook bodies like Facebook sends them: several
+# entries per POST across pages, text and attachment messages, and a
+# share of redeliveries (a body sent again with the same message ids).
+# Seeded, so two runs send the same traffic.
+# ============================================
+
+ATTACHMENT_TYPES = ('image', 'video', 'file', 'audio')
+
+
+class WebhookGenerator:
+    """
+    Args:
+        page_ids: pages to spread entries over
+        customers: distinct customer PSIDs per page
+        max_entries: entries per POST (1..max_entries)
+        max_messages: messages per entry (1..max_messages)
+        attachment_ratio: share of messages with an attachment
+        redelivery_ratio: share of POSTs that repeat an earlier body
+        cdn_base: URL prefix for attachment payload URLs
+        prefix: message id prefix - give each generator its own so ids never collide
+    """
+
+    def __init__(self, page_ids, customers=200, max_entries=3, max_messages=3, attachment_ratio=0.2,
+                 redelivery_ratio=0.05, cdn_base='http://127.0.0.1/cdn', seed=1, prefix='bench'):
+        self.page_ids = list(page_ids)
+        self.customers = customers
+        self.max_entries = max_entries
+        self.max_messages = max_messages
+        self.attachment_ratio = attachment_ratio
+        self.redelivery_ratio = redelivery_ratio
+        self.cdn_base = cdn_base.rstrip('/')
+        self.random = random.Random(seed)
+        self.prefix = prefix
+        self._sent = []
+        self._next_mid = 0
+        self.messages = 0
+        self.redeliveries = 0
+
+    def _message(self, page_id):
+        rnd = self.random
+        self._next_mid += 1
+        message = {'mid': f'm_{self.prefix}_{self._next_mid:010d}'}
+        if rnd.random() < self.attachment_ratio:
+            att_type = rnd.choice(ATTACHMENT_TYPES)
+            # A small pool of files, so the media mirror sees repeats
+            message['attachments'] = [{'type': att_type,
+                                       'payload': {'url': f'{self.cdn_base}/{att_type}{rnd.randrange(50)}'}}]
+        else:
+            message['text'] = rnd.choice(('hi', 'is this available?', 'price please', 'thanks!',
+                                          'what sizes do you have? ' * rnd.randint(1, 5)))
+        self.messages += 1
+        return {
+            'sender': {'id': f'{rnd.randrange(self.customers):016d}'},
+            'recipient': {'id': page_id},
+            'timestamp': int(time.time() * 1000),
+            'message': message
+        }
+
+    def body(self):
+        """One webhook POST body (a dict)"""
+        rnd = self.random
+        if self._sent and rnd.random() < self.redelivery_ratio:
+            self.redeliveries += 1
+            return rnd.choice(self._sent)
+
+        entries = []
+        for _ in range(rnd.randint(1, self.max_entries)):
+            page_id = rnd.choice(self.page_ids)
+            entries.append({
+                'id': page_id,
+                'time': int(time.time() * 1000),
+                'messaging': [self._message(page_id) for _ in range(rnd.randint(1, self.max_messages))]
+            })
+        body = {'object': 'page', 'entry': entries}
+        self._sent.append(body)
+        if len(self._sent) > 1000:
+            self._sent.pop(0)
+        return body
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import hmac
+import time
+import hashlib
+import random
+import logging
+import atexit
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+
+from bench import stubs
+from bench.payloads import WebhookGenerator
+
+# ============================================
+# LOAD TEST / BENCHMARK RUNNER
+# ============================================
+# Boots the app against the local Graph and Supabase stand-ins (bench/stubs.py)
+# with fixed, configurable latency, drives the hot endpoints from a pool of
+# client threads and reports throughput and latency percentiles. Nothing
+# leaves localhost and every run starts from empty state in a temp dir.
+#
+#   python -m bench.run                                   # werkzeug, in-process
+#   python -m bench.run --server gunicorn --workers 4     # real worker processes
+#   python -m bench.run --server uvicorn --workers 4      # asyncio mode (asgi.py)
+#   python -m bench.run --json > baseline.json            # save a baseline
+#   python -m bench.run --baseline baseline.json          # exit 1 on regression
+#
+# Scenarios:
+#   webhook      POST /webhook with generated multi-entry bodies (plus
+#                redeliveries); also reports how long the queued messages
+#                take to reach Supabase after the load stops
+#   send         POST /api/send
+#   send_async   POST /api/send with "async": true
+#   unreplied    GET /api/unreplied-counts
+# ============================================
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A JWT-shaped key - supabase-py checks the format, the stub ignores it
+SUPABASE_KEY = ('eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.'
+                'eyJyb2xlIjoic2VydmljZV9yb2xlIiwiaXNzIjoic3VwYWJhc2UifQ.'
+                'c2lnbmF0dXJlLWZvci1iZW5jaG1hcmtzLW9ubHk')
+
+# Webhook bodies are signed like Facebook's, so the signature check is measured too
+APP_SECRET = 'bench-app-secret'
+
+SCENARIOS = ('webhook', 'send', 'send_async', 'unreplied')
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Result:
+    """Latencies and outcomes for one scenario (thread-safe)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.status_codes = {}
+        self.elapsed = 0.0
+        self.extra = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency, status_code):
+        with self._lock:
+            self.latencies.append(latency)
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+            if status_code == 0 or status_code >= 500:
+                self.errors += 1
+
+    def summary(self):
+        values = sorted(self.latencies)
+        return dict({
+            'scenario': self.name,
+            'requests': len(values),
+            'errors': self.errors,
+            'status_codes': {str(k): v for k, v in sorted(self.status_codes.items())},
+            'rps': round(len(values) / self.elapsed, 1) if self.elapsed else 0.0,
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round((values[-1] if values else 0) * 1000, 2)
+        }, **self.extra)
+
+
+# ---------- Environment ----------
+
+def bench_env(graph, supabase, state_dir, page_ids, log_level):
+    """Env for the app under test: stubs for every external call, state in state_dir"""
+    env = {
+        'SUPABASE_URL': f'http://127.0.0.1:{supabase.server_port}',
+        'SUPABASE_KEY': SUPABASE_KEY,
+        'GRAPH_API_BASE': f'http://127.0.0.1:{graph.server_port}',
+        'FB_APP_SECRET': APP_SECRET,
+        'DEDUP_DB_PATH': os.path.join(state_dir, 'dedup.sqlite3'),
+        'JOB_DB_PATH': os.path.join(state_dir, 'jobs.sqlite3'),
+        'CACHE_DB_PATH': os.path.join(state_dir, 'cache.sqlite3'),
+        'JOURNAL_DIR': os.path.join(state_dir, 'journal'),
+        'ATTACHMENT_DB_PATH': os.path.join(state_dir, 'attachments.sqlite3'),
+        'MEDIA_DIR': os.path.join(state_dir, 'media'),
+        'MEDIA_DB_PATH': os.path.join(state_dir, 'media.sqlite3'),
+        'TOKEN_STATUS_FILE': os.path.join(state_dir, 'token_status.json'),
+        'NAME_CACHE_FILE': os.path.join(state_dir, 'name_cache.json'),
+        'METRICS_DIR': os.path.join(state_dir, 'metrics'),
+        'PAGES_FILE': '',
+        'LOG_LEVEL': log_level,
+        # Measure the app, not the per-page send rate limit
+        'SEND_RATE_PER_PAGE': os.getenv('SEND_RATE_PER_PAGE', '100000'),
+        'SEND_BURST_PER_PAGE': os.getenv('SEND_BURST_PER_PAGE', '100000')
+    }
+    for index, page_id in enumerate(page_ids, start=1):
+        env[f'FB_PAGE_{index}_ID'] = page_id
+        env[f'FB_PAGE_{index}_NAME'] = f'Bench Page {index}'
+        env[f'FB_PAGE_{index}_ACCESS_TOKEN'] = f'EAAB{page_id}' + 'x' * 40
+    return env
+
+
+def _wait_until_up(base_url, timeout=30, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'app server exited with code {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f'app did not come up at {base_url}')
+
+
+def start_werkzeug(env):
+    """Import the app in this process and serve it threaded, like `python app.py`"""
+    from werkzeug.serving import make_server
+
+    os.environ.update(env)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import app as app_module
+
+    # Per-request access lines would cost more than some of the requests
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    _wait_until_up(base_url)
+    return base_url, server.shutdown
+
+
+def start_gunicorn(env, workers, threads):
+    """Run the app under gunicorn in a subprocess, like production"""
+    return _start_subprocess(['gunicorn', '--workers', str(workers), '--threads', str(threads),
+                              '--bind', '127.0.0.1:{port}', '--log-level', 'warning', 'app:app'], env)
+
+
+def start_uvicorn(env, workers):
+    """Run the ASGI entry point (asgi.py) under uvicorn in a subprocess"""
+    return _start_subprocess(['uvicorn', '--workers', str(workers), '--host', '127.0.0.1', '--port', '{port}',
+                              '--log-level', 'warning', 'asgi:application'], env)
+
+
+def _start_subprocess(command, env):
+    port = stubs.free_port()
+    process = subprocess.Popen([sys.executable, '-m'] + [arg.format(port=port) for arg in command],
+                               cwd=REPO_ROOT, env=dict(os.environ, **env))
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_until_up(base_url, process=process)
+    except RuntimeError:
+        process.kill()
+        raise
+
+    def stop():
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return base_url, stop
+
+
+# ---------- Load ----------
+
+def drive(name, make_request, duration, concurrency):
+    """
+    Call make_request(session, worker_index, rnd) from `concurrency` threads for `duration` seconds.
+
+    make_request returns a requests.Response (or raises); its latency and status are recorded.
+    """
+    result = Result(name)
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        session = requests.Session()
+        rnd = random.Random(index)
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                status_code = make_request(session, index, rnd).status_code
+            except requests.exceptions.RequestException:
+                status_code = 0
+            result.record(time.perf_counter() - started, status_code)
+
+    threads = [threading.Thread(target=worker, args=(i,), name=f'bench-{name}-{i}') for i in range(concurrency)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def run_webhook(base_url, supabase, page_ids, args):
+    cdn_base = f'http://127.0.0.1:{args.graph_port}/cdn'
+    generators = [WebhookGenerator(page_ids, customers=args.customers, cdn_base=cdn_base,
+                                   seed=args.seed + i, prefix=f'bench{i}')
+                  for i in range(args.concurrency)]
+    accepted = [0] * args.concurrency
+
+    def before_count():
+        with supabase.lock:
+            return sum(1 for r in supabase.tables.get('messages', []) if r.get('sender_type') == 'customer')
+
+    initial = before_count()
+
+    def make_request(session, index, rnd):
+        generator = generators[index]
+        seen = generator.messages
+        body = json.dumps(generator.body()).encode()
+        signature = 'sha256=' + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        response = session.post(f'{base_url}/webhook', data=body, timeout=30, headers={
+            'Content-Type': 'application/json', 'X-Hub-Signature-256': signature})
+        if response.status_code == 200:
+            accepted[index] += generator.messages - seen
+        return response
+
+    result = drive('webhook', make_request, args.duration, args.concurrency)
+
+    # End to end: wait for every accepted message to be written
+    expected = sum(accepted)
+    drain_started = time.monotonic()
+    stored = before_count() - initial
+    while stored < expected and time.monotonic() - drain_started < args.drain_timeout:
+        time.sleep(0.05)
+        stored = before_count() - initial
+    drain = time.monotonic() - drain_started
+
+    result.extra = {
+        'messages_accepted': expected,
+        'messages_stored': stored,
+        'redeliveries': sum(g.redeliveries for g in generators),
+        'drain_seconds': round(drain, 3),
+        'ingest_msgs_per_sec': round(stored / (result.elapsed + drain), 1) if stored else 0.0
+    }
+    return result
+
+
+def run_send(base_url, page_ids, args, use_async=False):
+    def make_request(session, index, rnd):
+        return session.post(f'{base_url}/api/send', timeout=30, json={
+            'page_id': rnd.choice(page_ids),
+            'recipient_id': f'{rnd.randrange(args.customers):016d}',
+            'message_text': 'Thanks for your message!',
+            'async': use_async
+        })
+
+    return drive('send_async' if use_async else 'send', make_request, args.duration, args.concurrency)
+
+
+def run_unreplied(base_url, args):
+    def make_request(session, index, rnd):
+        return session.get(f'{base_url}/api/unreplied-counts', timeout=30)
+
+    return drive('unreplied', make_request, args.duration, args.concurrency)
+
+
+# ---------- Report ----------
+
+COLUMNS = ('scenario', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+
+def format_report(summaries, args):
+    lines = [f'server={args.server} workers={args.workers} concurrency={args.concurrency} '
+             f'duration={args.duration}s graph_latency={args.graph_latency_ms}ms '
+             f'supabase_latency={args.supabase_latency_ms}ms pages={args.pages}',
+             ''.join(f'{c:>12}' for c in COLUMNS)]
+    for summary in summaries:
+        lines.append(''.join(f'{summary[c]:>12}' for c in COLUMNS))
+    for summary in summaries:
+        if summary['scenario'] == 'webhook':
+            lines.append(f"webhook: {summary['messages_stored']}/{summary['messages_accepted']} messages stored, "
+                         f"drained {summary['drain_seconds']}s after load, "
+                         f"{summary['ingest_msgs_per_sec']} msgs/s end to end, "
+                         f"{summary['redeliveries']} redeliveries")
+        codes = {k: v for k, v in summary['status_codes'].items() if not k.startswith('2')}
+        if codes:
+            lines.append(f"{summary['scenario']}: non-2xx {codes}")
+    return '\n'.join(lines)
+
+
+def compare(summaries, baseline_path, tolerance):
+    """
+    Regressions against a saved --json run: p95 slower or req/s lower by more than tolerance.
+
+    Returns:
+        list: human readable regression lines (empty when none)
+    """
+    with open(baseline_path) as f:
+        baseline = {s['scenario']: s for s in json.load(f)['results']}
+    regressions = []
+    for summary in summaries:
+        before = baseline.get(summary['scenario'])
+        if not before:
+            continue
+        if before['p95_ms'] and summary['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{summary['scenario']}: p95 {before['p95_ms']}ms -> {summary['p95_ms']}ms")
+        if before['rps'] and summary['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append(f"{summary['scenario']}: req/s {before['rps']} -> {summary['rps']}")
+        if summary['errors'] > before['errors']:
+            regressions.append(f"{summary['scenario']}: errors {before['errors']} -> {summary['errors']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the app against local Graph/Supabase stubs')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'uvicorn'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn / uvicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--scenarios', default='webhook,send,unreplied',
+                        help=f'comma separated, from: {", ".join(SCENARIOS)}')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--customers', type=int, default=200, help='distinct PSIDs per page')
+    parser.add_argument('--graph-latency-ms', type=float, default=50)
+    parser.add_argument('--supabase-latency-ms', type=float, default=20)
+    parser.add_argument('--drain-timeout', type=float, default=60, help='max seconds to wait for ingest to drain')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING', help='LOG_LEVEL for the app under test')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--output', help='also append the report to this file')
+    parser.add_argument('--baseline', help='JSON from an earlier --json run; exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression vs baseline (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    graph = stubs.start_graph(args.graph_latency_ms / 1000)
+    supabase = stubs.start_supabase(args.supabase_latency_ms / 1000)
+    args.graph_port = graph.server_port
+    page_ids = [str(100000000000000 + i) for i in range(1, args.pages + 1)]
+    state_dir = tempfile.mkdtemp(prefix='chathub-bench-')
+    # Registered before the app is imported, so it runs after the app's own atexit flushes
+    atexit.register(shutil.rmtree, state_dir, ignore_errors=True)
+    env = bench_env(graph, supabase, state_dir, page_ids, args.log_level)
+
+    if args.server == 'gunicorn':
+        base_url, stop = start_gunicorn(env, args.workers, args.threads)
+    elif args.server == 'uvicorn':
+        base_url, stop = start_uvicorn(env, args.workers)
+    else:
+        base_url, stop = start_werkzeug(env)
+
+    summaries = []
+    try:
+        for name in args.scenarios.split(','):
+            if name == 'webhook':
+                result = run_webhook(base_url, supabase, page_ids, args)
+            elif name in ('send', 'send_async'):
+                result = run_send(base_url, page_ids, args, use_async=name == 'send_async')
+            else:
+                result = run_unreplied(base_url, args)
+            summaries.append(result.summary())
+    finally:
+        stop()
+
+    report = format_report(summaries, args)
+    if args.json:
+        print(json.dumps({'config': {k: v for k, v in vars(args).items() if k not in ('json', 'output', 'baseline', 'graph_port')},
+                          'results': summaries}, indent=2))
+    else:
+        print(report)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")}\n{report}\n\n')
+
+    if args.baseline:
+        regressions = compare(summaries, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import sys
+import json
+import time
+import socket
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, parse_qsl
+
+# ============================================
+# LOCAL GRAPH + SUPABASE STAND-INS
+# ============================================
+# Just enough of both APIs for the app to run end to end:
+#   Graph:     debug_token, {message_id}?fields=from, me/messages,
+#              me/message_attachments, batch (POST /vXX.X), CDN files (/cdn/...)
+#   Supabase:  PostgREST select / insert / upsert / update / delete on any
+#              table (eq, neq, lt(e), gt(e), in, is, or/and filters, order,
+#              limit, offset) and rpc/get_unreplied_counts
+# Every request sleeps `latency` seconds first, to stand in for the network.
+# ============================================
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body, content_type='application/json'):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _delay(self):
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+# ---------- Graph API ----------
+
+def _message_from(message_id):
+    """{message_id}?fields=from response with a made-up (but real-looking) sender name"""
+    return {'id': message_id, 'from': {'id': message_id[-6:], 'name': f'Bench Sender {message_id[-6:]}'}}
+
+
+class GraphHandler(_StubHandler):
+    def do_GET(self):
+        self._delay()
+        path = urlparse(self.path).path
+        if path.endswith('debug_token'):
+            return self._send(200, {'data': {'is_valid': True, 'expires_at': 0, 'type': 'PAGE', 'scopes': []}})
+        if path.startswith('/cdn/'):
+            # Deterministic content per URL, so repeated attachments dedupe
+            return self._send(200, (path[5:] * 2000).encode()[:256 * 1024], content_type='image/jpeg')
+        self._send(200, _message_from(path.rsplit('/', 1)[-1]))
+
+    def do_POST(self):
+        self._delay()
+        path = urlparse(self.path).path.rstrip('/')
+        body = self._body()
+        if path.endswith('message_attachments'):
+            return self._send(200, {'attachment_id': f'att_{next(self.server.ids)}'})
+        if path.endswith('messages'):
+            return self._send(200, {'recipient_id': '1', 'message_id': f'm_sent_{next(self.server.ids)}',
+                                    'attachment_id': f'att_{next(self.server.ids)}'})
+        if path.split('/')[-1].startswith('v'):
+            batch = json.loads(parse_qs(body.decode()).get('batch', ['[]'])[0])
+            return self._send(200, [{'code': 200, 'body': json.dumps(_message_from(
+                item.get('relative_url', '').split('?')[0]))} for item in batch])
+        self._send(404, {'error': {'message': 'Unknown path', 'code': 100}})
+
+
+# ---------- Supabase (PostgREST) ----------
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1].replace('\\"', '"')
+    return value
+
+
+def _match(row, column, expr):
+    op, _, value = expr.partition('.')
+    negate = op == 'not'
+    if negate:
+        op, _, value = value.partition('.')
+    current = row.get(column)
+    value = _unquote(value)
+    if op == 'eq':
+        result = str(current).lower() == value.lower() if isinstance(current, bool) else str(current) == value
+    elif op == 'neq':
+        result = str(current) != value
+    elif op in ('lt', 'lte', 'gt', 'gte'):
+        if current is None:
+            result = False
+        else:
+            left, right = (current, float(value)) if isinstance(current, (int, float)) \
+                and not isinstance(current, bool) else (str(current), value)
+            result = {'lt': left < right, 'lte': left <= right, 'gt': left > right, 'gte': left >= right}[op]
+    elif op == 'in':
+        result = str(current) in [_unquote(v) for v in _split(value.strip('()'))]
+    elif op == 'is':
+        result = current is None if value == 'null' else str(current).lower() == value
+    else:
+        result = True
+    return result != negate
+
+
+def _split(expr):
+    """Split on top-level commas (outside parentheses and quotes)"""
+    parts, depth, buf, quoted = [], 0, '', False
+    for ch in expr:
+        if ch == '"':
+            quoted = not quoted
+        if not quoted:
+            depth += (ch == '(') - (ch == ')')
+            if ch == ',' and depth == 0:
+                parts.append(buf)
+                buf = ''
+                continue
+        buf += ch
+    if buf:
+        parts.append(buf)
+    return parts
+
+
+def _match_logic(row, expr, mode):
+    results = []
+    for part in _split(expr):
+        if part.startswith(('and(', 'or(')):
+            inner = part[:part.index('(')]
+            results.append(_match_logic(row, part[len(inner) + 1:-1], inner))
+        else:
+            column, _, e = part.partition('.')
+            results.append(_match(row, column, e))
+    return all(results) if mode == 'and' else any(results)
+
+
+RESERVED_PARAMS = {'select', 'order', 'limit', 'offset', 'on_conflict', 'columns'}
+
+
+def _filter(rows, params):
+    out = []
+    for row in rows:
+        ok = True
+        for key, value in params:
+            if key in RESERVED_PARAMS:
+                continue
+            ok = _match_logic(row, value[1:-1], key) if key in ('or', 'and') else _match(row, key, value)
+            if not ok:
+                break
+        if ok:
+            out.append(row)
+    return out
+
+
+def _sort_key(column):
+    def key(row):
+        value = row.get(column)
+        return (value is None, value if isinstance(value, (int, float)) else str(value))
+    return key
+
+
+class SupabaseHandler(_StubHandler):
+    PRIMARY_KEYS = {'conversations': 'conversation_id', 'messages': 'message_id'}
+
+    def _parse(self):
+        self._delay()
+        url = urlparse(self.path)
+        body = self._body()
+        return url.path, url.path.rsplit('/', 1)[-1], parse_qsl(url.query, keep_blank_values=True), \
+            (json.loads(body) if body else None)
+
+    def do_GET(self):
+        _, table, params, _ = self._parse()
+        options = dict(params)
+        with self.server.lock:
+            rows = _filter(self.server.tables.get(table, []), params)
+            for order in reversed(options.get('order', '').split(',') if options.get('order') else []):
+                column, *flags = order.split('.')
+                rows = sorted(rows, key=_sort_key(column), reverse='desc' in flags)
+            rows = rows[int(options.get('offset', 0)):]
+            if 'limit' in options:
+                rows = rows[:int(options['limit'])]
+            select = options.get('select', '*')
+            if select != '*':
+                columns = [c.strip() for c in select.split(',')]
+                rows = [{c: r.get(c) for c in columns} for r in rows]
+            else:
+                rows = [dict(r) for r in rows]
+        self._send(200, rows)
+
+    def do_POST(self):
+        path, table, params, body = self._parse()
+        if '/rpc/' in path:
+            return self._rpc(table)
+        rows = body if isinstance(body, list) else [body]
+        prefer = self.headers.get('Prefer', '')
+        key = dict(params).get('on_conflict') or self.PRIMARY_KEYS.get(table)
+        out = []
+        with self.server.lock:
+            stored = self.server.tables.setdefault(table, [])
+            index = self.server.indexes.setdefault((table, key), {})
+            for row in rows:
+                existing = index.get(row.get(key)) if key else None
+                if existing is not None:
+                    if 'ignore-duplicates' in prefer:
+                        continue
+                    if 'merge-duplicates' in prefer:
+                        existing.update(row)
+                        out.append(dict(existing))
+                        continue
+                    return self._send(409, {'message': 'duplicate key value violates unique constraint',
+                                            'code': '23505'})
+                new = dict(row)
+                new.setdefault('id', next(self.server.ids))
+                stored.append(new)
+                if key and new.get(key) is not None:
+                    index[new[key]] = new
+                out.append(dict(new))
+        self._send(201, out)
+
+    def do_PATCH(self):
+        _, table, params, body = self._parse()
+        with self.server.lock:
+            rows = _filter(self.server.tables.get(table, []), params)
+            for row in rows:
+                row.update(body)
+            rows = [dict(r) for r in rows]
+        self._send(200, rows)
+
+    def do_DELETE(self):
+        _, table, params, _ = self._parse()
+        with self.server.lock:
+            rows = _filter(self.server.tables.get(table, []), params)
+            doomed = {id(r) for r in rows}
+            self.server.tables[table] = [r for r in self.server.tables.get(table, []) if id(r) not in doomed]
+        self._send(200, [dict(r) for r in rows])
+
+    def _rpc(self, name):
+        if name != 'get_unreplied_counts':
+            return self._send(404, {'message': f'function {name} not found', 'code': 'PGRST202'})
+        counts = {}
+        with self.server.lock:
+            for row in self.server.tables.get('messages', []):
+                if row.get('sender_type') == 'customer' and not row.get('replied'):
+                    _, page_id, psid = row['conversation_id'].split('_', 2)
+                    counts[(page_id, psid)] = counts.get((page_id, psid), 0) + 1
+        self._send(200, [{'page_id': p, 'customer_psid': s, 'unreplied_count': c} for (p, s), c in counts.items()])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive connections at shutdown are not errors
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start(handler, latency=0.0):
+    """
+    Serve a stub on a free localhost port (in a daemon thread).
+
+    Returns:
+        ThreadingHTTPServer: .server_port, .stats, and for Supabase .tables
+    """
+    server = _StubServer(('127.0.0.1', 0), handler)
+    server.latency = latency
+    server.stats = {'requests': 0}
+    server.ids = itertools.count(1)
+    server.lock = threading.Lock()
+    server.tables = {'conversations': [], 'messages': []}
+    server.indexes = {}
+    threading.Thread(target=server.serve_forever, name=f'{handler.__name__}-stub', daemon=True).start()
+    return server
+
+
+def start_graph(latency=0.0):
+    return start(GraphHandler, latency)
+
+
+def start_supabase(latency=0.0):
+    return start(SupabaseHandler, latency)
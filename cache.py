@@ -0,0 +1,540 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from log import get_logger
+
+# ============================================
+# SHARED CACHE
+# ============================================
+# Cached state (page config, sender names, known conversations) behind one
+# interface, with two backends:
+#   sqlite   one local SQLite file in WAL mode shared by every gunicorn
+#            worker on the host (default). A name one worker fetched from
+#            Graph is reused by all of them, and entries survive restarts.
+#            Each worker keeps short-lived in-process copies of the entries
+#            it reads (CACHE_LOCAL_TTL), so hot keys don't cost a SQLite
+#            query per message.
+#   memory   a plain in-process LRU per worker
+#
+# Entries carry their own TTL, and each namespace is bounded to
+# max_entries (least recently written entries are evicted first, checked
+# every SWEEP_EVERY writes).
+#
+# Invalidation: on the sqlite backend set(), delete() and clear() also
+# append to an invalidation log in the same file. Each worker reads the log
+# at most every CACHE_SYNC_INTERVAL seconds (on cache access) and drops its
+# in-process copies of the keys listed; namespaces can subscribe() to act
+# on changes made by other workers (config reloads its page registry this
+# way). A change made in one worker is seen by the others within the sync
+# interval.
+#
+# Settings (env):
+#   CACHE_BACKEND         sqlite | memory (default sqlite)
+#   CACHE_DB_PATH         SQLite file shared by workers (default cache.sqlite3)
+#   CACHE_LOCAL_TTL       seconds a worker reuses its copy of a shared entry (default 30)
+#   CACHE_LOCAL_SIZE      in-process copies kept per namespace (default 10000)
+#   CACHE_SYNC_INTERVAL   seconds between reads of the invalidation log (default 0.5)
+#   CACHE_WARM_INTERVAL   seconds after a worker warmed the shared cache from the
+#                         database during which other workers skip it (default 3600)
+# ============================================
+
+log = get_logger('cache')
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite').strip().lower()
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'cache.sqlite3')
+CACHE_LOCAL_TTL = float(os.getenv('CACHE_LOCAL_TTL', '30'))
+CACHE_LOCAL_SIZE = int(os.getenv('CACHE_LOCAL_SIZE', '10000'))
+CACHE_SYNC_INTERVAL = float(os.getenv('CACHE_SYNC_INTERVAL', '0.5'))
+CACHE_WARM_INTERVAL = int(os.getenv('CACHE_WARM_INTERVAL', '3600'))
+
+# Invalidations are kept well past CACHE_LOCAL_TTL - a worker that has not
+# synced for longer than that has no local copies left to drop anyway
+INVALIDATION_RETENTION = max(600.0, CACHE_LOCAL_TTL * 10)
+
+# Writes to a namespace between expiry / size sweeps
+SWEEP_EVERY = 500
+
+
+class MemoryBackend:
+    """In-process store: namespace -> LRU of key -> (value, expires_at)"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self):
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _entries(self, namespace):
+        entries = self._namespaces.get(namespace)
+        if entries is None:
+            entries = self._namespaces[namespace] = OrderedDict()
+        return entries
+
+    def get(self, namespace, key, now):
+        with self._lock:
+            entries = self._entries(namespace)
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= now:
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return entry
+
+    def _store(self, namespace, items, max_entries):
+        entries = self._entries(namespace)
+        for key, value, expires_at in items:
+            entries[key] = (value, expires_at)
+            entries.move_to_end(key)
+        while max_entries and len(entries) > max_entries:
+            entries.popitem(last=False)
+
+    def set_many(self, namespace, items, max_entries, broadcast=True):
+        with self._lock:
+            self._store(namespace, items, max_entries)
+
+    def add(self, namespace, key, value, expires_at, max_entries, now):
+        with self._lock:
+            entry = self._entries(namespace).get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return False
+            self._store(namespace, [(key, value, expires_at)], max_entries)
+            return True
+
+    def delete(self, namespace, key=None):
+        with self._lock:
+            if key is None:
+                self._namespaces.pop(namespace, None)
+            else:
+                self._entries(namespace).pop(key, None)
+
+    def size(self, namespace, now):
+        with self._lock:
+            return len(self._entries(namespace))
+
+    def items(self, namespace, now):
+        with self._lock:
+            return [(key, value, expires_at) for key, (value, expires_at) in self._entries(namespace).items()
+                    if expires_at is None or expires_at > now]
+
+    def sync(self, caches, now, force=False):
+        pass  # nothing is shared with other processes
+
+
+class SqliteBackend:
+    """Entries and the invalidation log in one SQLite (WAL) file shared by all workers"""
+
+    name = 'sqlite'
+    shared = True
+
+    def __init__(self, path=CACHE_DB_PATH, sync_interval=CACHE_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._local = threading.local()
+        self._writes = {}
+        self._pid = None
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                     'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                     'expires_at REAL, updated_at REAL NOT NULL, PRIMARY KEY (namespace, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_updated_idx ON entries (namespace, updated_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_expires_idx ON entries (namespace, expires_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS invalidations ('
+                     'id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT, '
+                     'pid INTEGER NOT NULL, at REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_started(self):
+        """Sync state is per process - start from the current end of the log"""
+        if self._pid == os.getpid():
+            return
+        row = self._conn().execute('SELECT MAX(id) FROM invalidations').fetchone()
+        self._last_id = row[0] or 0
+        self._synced_at = time.time()
+        self._sync_lock = threading.Lock()
+        self._writes = {}
+        self._pid = os.getpid()
+
+    def get(self, namespace, key, now):
+        row = self._conn().execute('SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?',
+                                   (namespace, key)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _invalidate(self, conn, namespace, keys, now):
+        conn.executemany('INSERT INTO invalidations (namespace, key, pid, at) VALUES (?, ?, ?, ?)',
+                         [(namespace, key, os.getpid(), now) for key in keys])
+
+    def set_many(self, namespace, items, max_entries, broadcast=True):
+        """Store (key, value, expires_at) items in one transaction"""
+        self._ensure_started()
+        now = time.time()
+        rows = [(namespace, key, json.dumps(value), expires_at, now) for key, value, expires_at in items]
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+            if broadcast:
+                self._invalidate(conn, namespace, [row[1] for row in rows], now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._wrote(namespace, len(rows), max_entries, now)
+
+    def add(self, namespace, key, value, expires_at, max_entries, now):
+        """Store only if the key is missing or expired (atomic across workers)"""
+        self._ensure_started()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT expires_at FROM entries WHERE namespace = ? AND key = ?',
+                               (namespace, key)).fetchone()
+            if row is not None and (row[0] is None or row[0] > now):
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (namespace, key, json.dumps(value), expires_at, now))
+            self._invalidate(conn, namespace, [key], now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._wrote(namespace, 1, max_entries, now)
+        return True
+
+    def delete(self, namespace, key=None):
+        """Delete one key, or the whole namespace when key is None"""
+        self._ensure_started()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if key is None:
+                conn.execute('DELETE FROM entries WHERE namespace = ?', (namespace,))
+            else:
+                conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+            self._invalidate(conn, namespace, [key], time.time())
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _wrote(self, namespace, count, max_entries, now):
+        before = self._writes.get(namespace, 0)
+        self._writes[namespace] = before + count
+        if before // SWEEP_EVERY != (before + count) // SWEEP_EVERY:
+            self._sweep(namespace, max_entries, now)
+
+    def _sweep(self, namespace, max_entries, now):
+        """Drop expired entries, the oldest ones above max_entries, and old invalidations"""
+        try:
+            conn = self._conn()
+            conn.execute('DELETE FROM entries WHERE namespace = ? AND expires_at <= ?', (namespace, now))
+            if max_entries:
+                count = conn.execute('SELECT COUNT(*) FROM entries WHERE namespace = ?', (namespace,)).fetchone()[0]
+                if count > max_entries:
+                    conn.execute('DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries WHERE namespace = ? '
+                                 'ORDER BY updated_at LIMIT ?)', (namespace, count - max_entries))
+            conn.execute('DELETE FROM invalidations WHERE at < ?', (now - INVALIDATION_RETENTION,))
+        except sqlite3.Error as e:
+            log.warning('Cache sweep failed', namespace=namespace, error=str(e))
+
+    def size(self, namespace, now):
+        return self._conn().execute('SELECT COUNT(*) FROM entries WHERE namespace = ? '
+                                    'AND (expires_at IS NULL OR expires_at > ?)', (namespace, now)).fetchone()[0]
+
+    def items(self, namespace, now):
+        return [(key, json.loads(value), expires_at) for key, value, expires_at in self._conn().execute(
+            'SELECT key, value, expires_at FROM entries WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, now))]
+
+    def sync(self, caches, now, force=False):
+        """
+        Apply invalidations other workers logged since the last sync.
+        Rate-limited to one read per sync_interval; a sync already running
+        in another thread is not waited for.
+        """
+        self._ensure_started()
+        if not force and now - self._synced_at < self.sync_interval:
+            return
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._synced_at = now
+            rows = self._conn().execute('SELECT id, namespace, key, pid FROM invalidations WHERE id > ? ORDER BY id',
+                                        (self._last_id,)).fetchall()
+            if not rows:
+                return
+            self._last_id = rows[-1][0]
+            pid = os.getpid()
+            for _, namespace, key, origin in rows:
+                cache = caches.get(namespace)
+                if cache is not None and origin != pid:
+                    cache._invalidated(key)
+        except sqlite3.Error as e:
+            log.warning('Cache sync failed', error=str(e), sample='sync')
+        finally:
+            self._sync_lock.release()
+
+
+class Cache:
+    """
+    One namespace of the cache (get one with get_cache()).
+
+    Keys are strings and values anything JSON-serialisable; get() returns
+    None on a miss, so None itself can't be cached. A failing backend is
+    logged and treated as a miss / skipped write - callers fall back to the
+    source of truth.
+    """
+
+    def __init__(self, backend, namespace, max_entries=0, local_ttl=CACHE_LOCAL_TTL, local_size=CACHE_LOCAL_SIZE):
+        self.backend = backend
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self._subscribers = []
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped_writes = 0
+        self.invalidations = 0
+        self.errors = 0
+        self._reset_local()
+
+    def _reset_local(self):
+        # key -> (value, expires_at, local_until); only used in front of a shared backend
+        self._pid = os.getpid()
+        self._copies = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset_local()
+
+    def _remember(self, key, value, expires_at, now):
+        local_until = now + self.local_ttl
+        if expires_at is not None:
+            local_until = min(local_until, expires_at)
+        with self._lock:
+            self._copies[key] = (value, expires_at, local_until)
+            self._copies.move_to_end(key)
+            while len(self._copies) > self.local_size:
+                self._copies.popitem(last=False)
+
+    def _forget(self, key=None):
+        with self._lock:
+            if key is None:
+                self._copies.clear()
+            else:
+                self._copies.pop(key, None)
+
+    def _failed(self, action, error):
+        self.errors += 1
+        log.warning('Cache backend error', namespace=self.namespace, action=action, error=str(error),
+                    sample=f'{self.namespace}:{action}')
+
+    def sync(self):
+        """Apply other workers' invalidations now if the sync interval has passed"""
+        try:
+            self.backend.sync(_caches, time.time())
+        except sqlite3.Error as e:
+            self._failed('sync', e)
+
+    def get(self, key):
+        now = time.time()
+        if self.shared:
+            self._check_pid()
+            self.sync()
+            with self._lock:
+                copy = self._copies.get(key)
+                if copy is not None:
+                    if copy[2] > now:
+                        self._copies.move_to_end(key)
+                        self.hits += 1
+                        self.local_hits += 1
+                        return copy[0]
+                    del self._copies[key]
+        try:
+            entry = self.backend.get(self.namespace, key, now)
+        except sqlite3.Error as e:
+            self._failed('get', e)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.shared:
+            self._remember(key, entry[0], entry[1], now)
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store a value for `ttl` seconds (None = until evicted or deleted)"""
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        if self.shared:
+            self._check_pid()
+            with self._lock:
+                copy = self._copies.get(key)
+            if copy is not None and copy[0] == value and copy[2] > now:
+                # Unchanged and written (or read) moments ago - don't rewrite it for every message
+                self.skipped_writes += 1
+                return
+        try:
+            self.backend.set_many(self.namespace, [(key, value, expires_at)], self.max_entries)
+        except sqlite3.Error as e:
+            self._failed('set', e)
+            self._forget(key)
+            return
+        self.writes += 1
+        if self.shared:
+            self._remember(key, value, expires_at, now)
+
+    def set_many(self, items, ttl=None):
+        """
+        Store (key, value) pairs in one write, e.g. when warming from the
+        database. Other workers are not sent invalidations for these keys.
+        """
+        expires_at = time.time() + ttl if ttl else None
+        items = [(key, value, expires_at) for key, value in items]
+        if not items:
+            return
+        try:
+            self.backend.set_many(self.namespace, items, self.max_entries, broadcast=False)
+        except sqlite3.Error as e:
+            self._failed('set_many', e)
+            return
+        self.writes += len(items)
+        if self.shared:
+            self._check_pid()
+            for key, _, _ in items:
+                self._forget(key)
+
+    def add(self, key, value, ttl=None):
+        """
+        Store a value only if the key has none (across all workers).
+
+        Returns:
+            bool: True if this call stored it
+        """
+        now = time.time()
+        try:
+            added = self.backend.add(self.namespace, key, value, now + ttl if ttl else None, self.max_entries, now)
+        except sqlite3.Error as e:
+            self._failed('add', e)
+            return False
+        if added:
+            self.writes += 1
+        return added
+
+    def delete(self, key):
+        """Remove a key here and in every worker's copies"""
+        self._check_pid()
+        self._forget(key)
+        try:
+            self.backend.delete(self.namespace, key)
+        except sqlite3.Error as e:
+            self._failed('delete', e)
+
+    def clear(self):
+        """Remove the whole namespace; subscribers in other workers are told with key None"""
+        self._check_pid()
+        self._forget()
+        try:
+            self.backend.delete(self.namespace)
+        except sqlite3.Error as e:
+            self._failed('clear', e)
+
+    def subscribe(self, fn):
+        """fn(key) runs in this worker when another worker changes `key` (None = whole namespace)"""
+        self._subscribers.append(fn)
+
+    def _invalidated(self, key):
+        self.invalidations += 1
+        self._forget(key)
+        for fn in self._subscribers:
+            try:
+                fn(key)
+            except Exception as e:
+                log.warning('Cache invalidation handler failed', namespace=self.namespace, key=key, error=str(e))
+
+    def size(self):
+        try:
+            return self.backend.size(self.namespace, time.time())
+        except sqlite3.Error as e:
+            self._failed('size', e)
+            return None
+
+    def items(self):
+        """[(key, value, expires_at)] of the live entries"""
+        return self.backend.items(self.namespace, time.time())
+
+    def stats(self):
+        with self._lock:
+            local = len(self._copies)
+        return {'backend': self.backend.name, 'size': self.size(), 'local_copies': local, 'hits': self.hits,
+                'local_hits': self.local_hits, 'misses': self.misses, 'writes': self.writes,
+                'skipped_writes': self.skipped_writes, 'invalidations': self.invalidations, 'errors': self.errors}
+
+
+_backend = None
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _create_backend():
+    if CACHE_BACKEND == 'sqlite':
+        try:
+            return SqliteBackend()
+        except sqlite3.Error as e:
+            log.warning('Shared cache unavailable, using per-worker memory cache', path=CACHE_DB_PATH, error=str(e))
+            return MemoryBackend()
+    if CACHE_BACKEND != 'memory':
+        log.warning('Unknown CACHE_BACKEND, using memory', backend=CACHE_BACKEND)
+    return MemoryBackend()
+
+
+def get_cache(namespace, max_entries=0):
+    """
+    The cache for a namespace (one instance per process and namespace).
+
+    Args:
+        namespace: e.g. 'names'
+        max_entries: size bound of the namespace (0 = unbounded)
+    """
+    global _backend
+    with _caches_lock:
+        if _backend is None:
+            _backend = _create_backend()
+        cache = _caches.get(namespace)
+        if cache is None:
+            cache = _caches[namespace] = Cache(_backend, namespace, max_entries)
+        elif max_entries:
+            cache.max_entries = max_entries
+        return cache
+
+
+def cache_stats():
+    """stats() of every namespace in use"""
+    return {namespace: cache.stats() for namespace, cache in list(_caches.items())}
@@ -1,57 +1,256 @@
 import os
-from supabase import create_client, Client
+import json
+import time
+import threading
+from types import MappingProxyType
+from supabase import create_client, acreate_client, Client
 from dotenv import load_dotenv
 import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from graph_client import graph
+from cache import get_cache
+from metrics import instrument_supabase
+from log import get_logger
 
 load_dotenv()
 
+log = get_logger('config')
+
 # Initialize Supabase
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+try:
+    instrument_supabase(supabase)
+except Exception as e:
+    log.warning('Supabase request metrics unavailable', error=str(e))
+
+# Async client for the ASGI entry point (asgi.py) - created on first use in
+# each worker, inside the serving event loop
+_async_supabase = None
+
+
+async def get_async_supabase():
+    """
+    Returns:
+        supabase AsyncClient for this worker (instrumented like `supabase`)
+    """
+    global _async_supabase
+    if _async_supabase is None or _async_supabase[0] != os.getpid():
+        client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+        try:
+            instrument_supabase(client)
+        except Exception as e:
+            log.warning('Supabase request metrics unavailable', error=str(e))
+        if _async_supabase is None or _async_supabase[0] != os.getpid():
+            _async_supabase = (os.getpid(), client)
+    return _async_supabase[1]
+
+
+async def close_async_supabase():
+    global _async_supabase
+    if _async_supabase is not None and _async_supabase[0] == os.getpid():
+        await _async_supabase[1].postgrest.aclose()
+    _async_supabase = None
+
 
 # Webhook verification token for Facebook
 WEBHOOK_VERIFY_TOKEN = os.getenv('WEBHOOK_VERIFY_TOKEN', 'your-webhook-token')
 
+# App secret Facebook signs webhook deliveries with (X-Hub-Signature-256).
+# Without it signatures are not checked - always set it in production.
+FB_APP_SECRET = os.getenv('FB_APP_SECRET', '')
+if not FB_APP_SECRET:
+    log.warning('FB_APP_SECRET not set, webhook signatures are not verified')
+
 # ============================================
-# PAGE CONFIGURATIONS - Load from .env
+# PAGE REGISTRY - Load from .env (+ optional pages file)
 # ============================================
-# Dynamically loads pages from environment variables
-# Pattern: FB_PAGE_1_*, FB_PAGE_2_*, etc.
+# Pages come from environment variables (FB_PAGE_1_*, FB_PAGE_2_*, etc.)
+# and, if PAGES_FILE is set, from a JSON file that overrides them:
+#   [{"id": "123", "name": "My Page", "accessToken": "EAA...", "weight": 2}, ...]
+#
+# `weight` (optional, default 1; env FB_PAGE_N_WEIGHT) is the page's share
+# of the ingest and send workers when several pages have work queued.
+#
+# Entries are validated once when the registry is built; lookups are a
+# plain dict get. reload_pages() builds a new registry and swaps the
+# reference in one assignment, so requests in flight keep the snapshot
+# they already looked up.
+#
+# A reload in one gunicorn worker (admin endpoint, SIGHUP, file watch) is
+# broadcast through the shared cache's 'pages' namespace (cache.py); the
+# other workers rebuild their registry on their next get_page_config()
+# after CACHE_SYNC_INTERVAL.
+#
+# Settings (env):
+#   PAGES_FILE   optional JSON pages file (reloaded on SIGHUP / admin endpoint)
 # ============================================
 
-PAGES_CONFIG = {}
+PAGES_FILE = os.getenv('PAGES_FILE', '')
 
-# Load all pages from environment variables
-page_index = 1
-while True:
-    page_id = os.getenv(f'FB_PAGE_{page_index}_ID')
-    
-    # Stop when no more pages found
-    if not page_id:
-        break
-    
-    page_name = os.getenv(f'FB_PAGE_{page_index}_NAME', f'Page {page_index}')
-    page_token = os.getenv(f'FB_PAGE_{page_index}_ACCESS_TOKEN')
-    
-    # Only add if token exists and is not a placeholder
-    if page_token and not page_token.startswith('YOUR_'):
-        PAGES_CONFIG[page_id] = {
-            'name': page_name,
-            'accessToken': page_token
-        }
-        print(f'✓ Loaded page: {page_name} (ID: {page_id})')
-    else:
-        print(f'⚠ Skipped page {page_id}: Invalid or missing token')
-    
-    page_index += 1
 
-# Print loaded configuration
-if PAGES_CONFIG:
-    print(f'\n✓ Total pages loaded: {len(PAGES_CONFIG)}')
-else:
-    print('\n⚠ WARNING: No pages configured! Please check your .env file')
+def _token_problem(access_token):
+    """Why a token can't be used, or None"""
+    if not access_token:
+        return 'missing token'
+    if access_token.startswith('YOUR_'):
+        return 'placeholder token'
+    if len(access_token) < 50:
+        return 'token too short'
+    return None
+
+
+def _env_pages():
+    pages = []
+    page_index = 1
+    while True:
+        page_id = os.getenv(f'FB_PAGE_{page_index}_ID')
+
+        # Stop when no more pages found
+        if not page_id:
+            break
+
+        pages.append({
+            'id': page_id,
+            'name': os.getenv(f'FB_PAGE_{page_index}_NAME', f'Page {page_index}'),
+            'accessToken': os.getenv(f'FB_PAGE_{page_index}_ACCESS_TOKEN'),
+            'weight': os.getenv(f'FB_PAGE_{page_index}_WEIGHT')
+        })
+        page_index += 1
+    return pages
+
+
+def _page_weight(value):
+    """Positive integer scheduling weight, 1 when missing or invalid"""
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _file_pages(path):
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('pages', [])
+    return data
+
+
+class PageRegistry:
+    """Immutable, prevalidated page_id -> config snapshot"""
+
+    def __init__(self, entries, source='env'):
+        pages = {}
+        rejected = {}
+        for entry in entries:
+            page_id = str(entry.get('id', '')).strip()
+            if not page_id:
+                continue
+            problem = _token_problem(entry.get('accessToken'))
+            if problem:
+                rejected[page_id] = problem
+                pages.pop(page_id, None)
+                continue
+            rejected.pop(page_id, None)
+            pages[page_id] = MappingProxyType({
+                'name': entry.get('name') or f'Page {page_id}',
+                'accessToken': entry['accessToken'],
+                'weight': _page_weight(entry.get('weight'))
+            })
+        self.pages = MappingProxyType(pages)
+        self.rejected = MappingProxyType(rejected)
+        self.source = source
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, pages_file=PAGES_FILE):
+        """Build from env vars, then the pages file (file entries win)"""
+        entries = _env_pages()
+        source = 'env'
+        if pages_file:
+            entries += _file_pages(pages_file)
+            source = f'env+{pages_file}'
+        return cls(entries, source)
+
+    def get(self, page_id):
+        config = self.pages.get(page_id)
+        if config is None and not isinstance(page_id, str):
+            config = self.pages.get(str(page_id))
+        return config
+
+    def report(self):
+        for page_id, config in self.pages.items():
+            log.info('Loaded page', page_id=page_id, page_name=config['name'])
+        for page_id, problem in self.rejected.items():
+            log.warning('Skipped page', page_id=page_id, reason=problem)
+        if self.pages:
+            log.info('Pages loaded', total=len(self.pages), source=self.source)
+        else:
+            log.warning('No pages configured - please check your .env file')
+
+
+_registry = PageRegistry.load()
+_registry.report()
+_reload_lock = threading.Lock()
+
+# Reload broadcasts between workers (no entries, only invalidations)
+_pages_cache = get_cache('pages')
+
+
+def get_registry():
+    return _registry
+
+
+def get_pages():
+    """Current page_id -> config mapping (read-only)"""
+    return _registry.pages
+
+
+def reload_pages(broadcast=True):
+    """
+    Rebuild the registry from env + PAGES_FILE and swap it in.
+    A broken pages file leaves the current registry in place.
+
+    Args:
+        broadcast: tell the other workers to reload too
+
+    Returns:
+        dict: {'added', 'removed', 'changed', 'rejected', 'total'}
+
+    Raises:
+        OSError / ValueError: the pages file could not be read or parsed
+    """
+    global _registry
+    with _reload_lock:
+        new_registry = PageRegistry.load()
+        old_pages = _registry.pages
+        _registry = new_registry
+    if broadcast:
+        _pages_cache.clear()
+
+    new_pages = new_registry.pages
+    summary = {
+        'added': sorted(set(new_pages) - set(old_pages)),
+        'removed': sorted(set(old_pages) - set(new_pages)),
+        'changed': sorted(p for p in set(new_pages) & set(old_pages) if new_pages[p] != old_pages[p]),
+        'rejected': dict(new_registry.rejected),
+        'total': len(new_pages)
+    }
+    log.info('Pages reloaded', total=summary['total'], added=summary['added'], removed=summary['removed'],
+             changed=summary['changed'])
+    return summary
+
+
+def _pages_reloaded_elsewhere(key):
+    try:
+        reload_pages(broadcast=False)
+    except (OSError, ValueError) as e:
+        log.warning('Could not follow page reload from another worker', error=str(e))
+
+
+_pages_cache.subscribe(_pages_reloaded_elsewhere)
 
 
 # ============================================
@@ -71,13 +270,12 @@ def validate_page_token(page_id, access_token):
     """
     try:
         # Use debug_token endpoint to check token validity
-        url = 'https://graph.facebook.com/v19.0/debug_token'
         params = {
-            'input_token': access_token,
-            'access_token': access_token  # Page token can validate itself
+            'input_token': access_token
         }
         
-        response = requests.get(url, params=params, timeout=10)
+        # Page token can validate itself
+        response = graph.get('debug_token', access_token=access_token, page_id=page_id, params=params, timeout=10)
         data = response.json()
         
         if response.status_code != 200:
@@ -130,69 +328,67 @@ def validate_page_token(page_id, access_token):
         }
 
 
-def validate_all_tokens():
+def validate_all_tokens(max_workers=8):
     """
-    Validate all configured page tokens on startup.
+    Validate all configured page tokens (concurrently).
     Prints detailed status for each page.
     """
-    print('\n' + '='*60)
-    print('VALIDATING FACEBOOK PAGE TOKENS')
-    print('='*60)
-    
+    pages = list(get_pages().items())
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pages)))) as executor:
+        results = list(executor.map(lambda item: validate_page_token(item[0], item[1].get('accessToken')), pages))
+    return log_token_report({page_id: result for (page_id, _), result in zip(pages, results)})
+
+
+def log_token_report(results):
+    """
+    Log the status of each page token.
+
+    Args:
+        results: {page_id: validate_page_token() result}
+
+    Returns:
+        bool: True if every token is valid
+    """
     all_valid = True
     
-    for page_id, config in PAGES_CONFIG.items():
-        page_name = config.get('name')
-        access_token = config.get('accessToken')
-        
-        print(f'\n📄 {page_name} (ID: {page_id})')
-        print(f'   Validating token...')
-        
-        result = validate_page_token(page_id, access_token)
+    for page_id, result in results.items():
+        page_name = (get_pages().get(page_id) or {}).get('name', 'Unknown Page')
         
         if result['valid']:
-            print(f'   ✅ Token is VALID')
-            if result['data']:
-                print(f'   📅 {result["data"]["expiry_message"]}')
-                print(f'   🔑 Type: {result["data"]["type"]}')
+            data = result['data'] or {}
+            log.info('Token is valid', page_id=page_id, page_name=page_name,
+                     expiry=data.get('expiry_message'), token_type=data.get('type'))
         else:
-            print(f'   ❌ Token is INVALID')
-            print(f'   ⚠️  Error: {result["error"]}')
-            print(f'   💡 Action: Generate a new token and update .env file')
+            log.error('Token is invalid - generate a new token and update .env', page_id=page_id,
+                      page_name=page_name, error=result['error'])
             all_valid = False
     
-    print('\n' + '='*60)
     if all_valid:
-        print('✅ ALL TOKENS VALID - Ready to receive messages!')
+        log.info('All tokens valid - ready to receive messages', pages=len(results))
     else:
-        print('⚠️  SOME TOKENS INVALID - Please fix before deployment!')
-    print('='*60 + '\n')
+        log.warning('Some tokens invalid - please fix before deployment', pages=len(results))
     
     return all_valid
 
 
+def get_page_weight(page_id):
+    """Fair scheduling weight of a page (1 for unknown pages)"""
+    config = _registry.get(page_id)
+    return config['weight'] if config else 1
+
+
 def get_page_config(page_id):
     """
     Get configuration for a specific page.
+    Tokens were validated when the registry was built, so this is a dict lookup
+    (plus, every CACHE_SYNC_INTERVAL, a check for reloads in other workers).
     
     Args:
         page_id: Facebook Page ID
         
     Returns:
-        Dictionary with page config including 'name' and 'accessToken'
+        Read-only mapping with 'name', 'accessToken' and 'weight'
         or None if page not found
     """
-    config = PAGES_CONFIG.get(str(page_id))
-    
-    if not config:
-        print(f'Page {page_id} not found in configuration')
-        return None
-    
-    # Validate that accessToken exists and is not a placeholder
-    access_token = config.get('accessToken')
-    if not access_token or access_token.startswith('YOUR_') or len(access_token) < 50:
-        print(f'ERROR: Page {page_id} ({config.get("name")}) has invalid or missing accessToken!')
-        print('Please update the accessToken in your .env file')
-        return None
-    
-    return config
+    _pages_cache.sync()
+    return _registry.get(page_id)
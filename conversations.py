@@ -0,0 +1,119 @@
+import os
+from datetime import datetime
+from cache import get_cache
+from name_cache import is_real_name
+from log import get_logger
+
+# ============================================
+# CONVERSATION STORE
+# ============================================
+# Index of conversations that already exist in Supabase, so repeat
+# senders skip the existence check. Kept in the 'conversations' namespace
+# of the shared cache (cache.py), so a conversation one worker created is
+# known to all of them. Writes go through the write-behind batcher
+# (batcher.py).
+#
+# Settings (env):
+#   KNOWN_CONVERSATIONS_SIZE   max indexed conversations (default 100000)
+# ============================================
+
+log = get_logger('conversations')
+
+KNOWN_CONVERSATIONS_SIZE = int(os.getenv('KNOWN_CONVERSATIONS_SIZE', '100000'))
+
+
+def iter_conversations(supabase, columns, page_size=1000):
+    """
+    Page through the whole conversations table.
+
+    Args:
+        supabase: Supabase client
+        columns: select() column list
+        page_size: rows per request
+
+    Yields:
+        dict rows
+    """
+    offset = 0
+    while True:
+        result = supabase.table('conversations').select(columns).range(offset, offset + page_size - 1).execute()
+        rows = result.data or []
+        yield from rows
+        if len(rows) < page_size:
+            break
+        offset += page_size
+
+
+class ConversationIndex:
+    """Size-bounded index of conversation_id -> stored customer_name"""
+
+    def __init__(self, max_size=KNOWN_CONVERSATIONS_SIZE):
+        self.max_size = max_size
+        self._cache = get_cache('conversations', max_size)
+
+    def __contains__(self, conversation_id):
+        return self._cache.get(conversation_id) is not None
+
+    def __len__(self):
+        return self._cache.size() or 0
+
+    def get_name(self, conversation_id):
+        # '' marks a known conversation without a name
+        return self._cache.get(conversation_id) or None
+
+    def add(self, conversation_id, customer_name=None):
+        self._cache.set(conversation_id, customer_name or '')
+
+    def add_many(self, rows):
+        """Index conversation rows (conversation_id, customer_name) in one cache write"""
+        self._cache.set_many((row['conversation_id'], row.get('customer_name') or '') for row in rows)
+
+    def discard(self, conversation_id):
+        self._cache.delete(conversation_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def upsert_inbound_conversation(batcher, index, conversation_id, page_id, page_name, sender_id, sender_name):
+    """
+    Queue the conversation write for an inbound message on the write batcher.
+
+    Known conversations get a touch (last_message_time, plus the name when
+    we have a real one). Unknown conversations are queued as an
+    insert-if-missing on conversation_id, which is race-free when two first
+    messages from the same customer arrive together, followed by the same
+    touch in case the row already existed before this process saw it.
+
+    Returns:
+        bool: True if the conversation was not in the index yet
+    """
+    now = datetime.now().isoformat()
+    row = {
+        'conversation_id': conversation_id,
+        'platform': 'facebook',
+        'page_id': page_id,
+        'page_name': page_name,
+        'customer_psid': sender_id,
+        'last_message_time': now
+    }
+    is_new = conversation_id not in index
+
+    if is_new:
+        batcher.add_new_conversation(dict(row, customer_name=sender_name, customer_name_fetched=True,
+                                          status='active'))
+        index.add(conversation_id, sender_name)
+        log.info('New conversation queued', conversation_id=conversation_id, sender_name=sender_name)
+
+    # Update conversation - always update name if we got a real one
+    existing_name = index.get_name(conversation_id)
+    if is_real_name(sender_name):
+        row['customer_name'] = sender_name
+        row['customer_name_fetched'] = True
+        if existing_name and existing_name != sender_name:
+            log.info('Updated conversation name', conversation_id=conversation_id, old_name=existing_name,
+                     new_name=sender_name)
+        index.add(conversation_id, sender_name)
+
+    batcher.touch_conversation(row)
+    return is_new
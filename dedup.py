@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from log import get_logger
+
+# ============================================
+# WEBHOOK DEDUP STORE
+# ============================================
+# Facebook redelivers webhook batches when we answer slowly. Every message
+# id (message.mid) is checked here before any other work:
+#   1. in-memory LRU      - repeats within this worker, microseconds
+#   2. local SQLite file  - shared by all gunicorn workers and restarts
+#
+# Settings (env):
+#   DEDUP_MEMORY_SIZE   ids kept in the in-memory LRU (default 100000)
+#   DEDUP_DB_PATH       SQLite file shared by workers (default dedup.sqlite3, empty = memory only)
+#   DEDUP_TTL           seconds an id is remembered in SQLite (default 2 days)
+# ============================================
+
+log = get_logger('dedup')
+
+DEDUP_MEMORY_SIZE = int(os.getenv('DEDUP_MEMORY_SIZE', '100000'))
+DEDUP_DB_PATH = os.getenv('DEDUP_DB_PATH', 'dedup.sqlite3')
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', str(2 * 24 * 3600)))
+
+# Prune expired ids about once per this many inserts
+PRUNE_EVERY = 5000
+
+
+class DedupStore:
+    """Two-level seen-set of webhook message ids"""
+
+    def __init__(self, path=DEDUP_DB_PATH, memory_size=DEDUP_MEMORY_SIZE, ttl=DEDUP_TTL):
+        self.path = path
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+
+        # Stats
+        self.checked = 0
+        self.duplicates_memory = 0
+        self.duplicates_store = 0
+        self.store_errors = 0
+
+        if self.path:
+            try:
+                conn = self._conn()
+                conn.execute('CREATE TABLE IF NOT EXISTS seen (mid TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS seen_at_idx ON seen (seen_at)')
+            except sqlite3.Error as e:
+                log.warning('Dedup store unavailable, using memory only', path=self.path, error=str(e))
+                self.path = ''
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _remember(self, mid):
+        self._memory[mid] = None
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def seen(self, mid):
+        """
+        Record a message id.
+
+        Returns:
+            bool: True if the id was already seen (duplicate), False if it is new
+        """
+        with self._lock:
+            self.checked += 1
+            if mid in self._memory:
+                self._memory.move_to_end(mid)
+                self.duplicates_memory += 1
+                return True
+            self._remember(mid)
+
+        if not self.path:
+            return False
+
+        try:
+            now = time.time()
+            cursor = self._conn().execute('INSERT OR IGNORE INTO seen (mid, seen_at) VALUES (?, ?)', (mid, now))
+            if cursor.rowcount == 0:
+                self.duplicates_store += 1
+                return True
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                self._conn().execute('DELETE FROM seen WHERE seen_at < ?', (now - self.ttl,))
+        except sqlite3.Error as e:
+            # Never block ingestion on the dedup store
+            self.store_errors += 1
+            log.warning('Dedup store error', error=str(e))
+        return False
+
+    def forget(self, mid):
+        """Drop an id so a redelivery is processed again (e.g. after a failed ingest)"""
+        with self._lock:
+            self._memory.pop(mid, None)
+        if self.path:
+            try:
+                self._conn().execute('DELETE FROM seen WHERE mid = ?', (mid,))
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                log.warning('Dedup store error', error=str(e))
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates_memory + self.duplicates_store,
+            'duplicates_memory': self.duplicates_memory,
+            'duplicates_store': self.duplicates_store,
+            'memory_size': len(self._memory),
+            'store_errors': self.store_errors,
+            'shared_store': bool(self.path)
+        }
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from collections import deque
+from cache import CACHE_DB_PATH
+from log import get_logger
+
+# ============================================
+# LIVE INBOX EVENTS (Server-Sent Events)
+# ============================================
+# The webhook path and the send endpoints publish compact deltas;
+# /api/events streams them to dashboard tabs.
+#
+#   message.new           a customer or agent message was stored
+#   message.media         a message's attachment was mirrored
+#   conversation.touched  last_message_time / customer_name changed
+#   unreplied.changed     a conversation's unreplied counter changed
+#   message.status        agent messages up to a watermark were delivered / read
+#   resync                the client missed events and should refetch
+#
+# Events go through an append-only log in a SQLite file shared by every
+# gunicorn worker (next to the cache.py tables): publish() hands them to a
+# writer thread that appends each burst in one transaction, and a reader
+# thread in each worker tails the log and fans new rows out to that
+# worker's clients. A client therefore sees events published by any
+# worker, and the event id is the log's row id, so a Last-Event-ID resume
+# works whichever worker the reconnect lands on.
+#
+# Each open stream holds a thread for its lifetime: serve /api/events from
+# threaded workers (gunicorn --threads N / -k gthread) or through asgi.py.
+# A single-threaded sync worker refuses the stream with 503.
+#
+# Settings (env):
+#   EVENTS_DB_PATH        SQLite file shared by workers (default CACHE_DB_PATH)
+#   EVENTS_BUFFER_SIZE    recent events kept for Last-Event-ID resume (default 1000)
+#   EVENTS_CLIENT_BUFFER  events queued per client before it is resynced (default 256)
+#   EVENTS_HEARTBEAT      seconds between heartbeat comments (default 15)
+#   EVENTS_POLL_INTERVAL  seconds between reads of other workers' events (default 0.1)
+# ============================================
+
+log = get_logger('events')
+
+EVENTS_DB_PATH = os.getenv('EVENTS_DB_PATH', CACHE_DB_PATH)
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', '1000'))
+EVENTS_CLIENT_BUFFER = int(os.getenv('EVENTS_CLIENT_BUFFER', '256'))
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '0.1'))
+
+# Log rows read per poll
+READ_BATCH = 1000
+
+
+def format_sse(event_id, event_type, data):
+    """Serialize one event in text/event-stream format"""
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+
+class _Client:
+    def __init__(self, max_size):
+        self.queue = deque()
+        self.max_size = max_size
+        self.overflowed = False
+        self.cond = threading.Condition()
+
+    def push(self, item):
+        with self.cond:
+            if self.overflowed:
+                return
+            if len(self.queue) >= self.max_size:
+                # Slow client - drop its backlog and ask it to refetch
+                self.queue.clear()
+                self.overflowed = True
+            else:
+                self.queue.append(item)
+            self.cond.notify()
+
+
+class EventBroadcaster:
+    """
+    Fan-out of inbox deltas to SSE clients, across workers.
+
+    Event ids are the shared log's row ids; an id older than the kept log
+    (or not issued by it, e.g. from before an upgrade) triggers a resync.
+    """
+
+    def __init__(self, path=EVENTS_DB_PATH, buffer_size=EVENTS_BUFFER_SIZE, client_buffer=EVENTS_CLIENT_BUFFER,
+                 heartbeat=EVENTS_HEARTBEAT, poll_interval=EVENTS_POLL_INTERVAL):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.client_buffer = client_buffer
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._clients = set()
+        self._lock = threading.Lock()         # clients and the read position
+        self._cond = threading.Condition()    # pending events for the writer
+        self._pending = []
+        self._wake = threading.Event()
+        self._pid = None
+        self._read_id = 0
+        self._stopping = False
+        self.published = 0
+        self.write_errors = 0
+        self._conn().execute('CREATE TABLE IF NOT EXISTS events ('
+                             'id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, data TEXT NOT NULL, '
+                             'at REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            with self._lock:
+                self._read_id = self._last_id()
+            self._pending = []
+            self._stopping = False
+            self._pid = os.getpid()
+            threading.Thread(target=self._write_loop, name='events-writer', daemon=True).start()
+            threading.Thread(target=self._read_loop, name='events-reader', daemon=True).start()
+            atexit.register(self.shutdown)
+
+    def _last_id(self):
+        return self._conn().execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+
+    def publish(self, event_type, data):
+        """
+        Send an event to every connected client (of every worker).
+
+        Args:
+            event_type: e.g. 'message.new'
+            data: JSON-serializable payload
+        """
+        payload = json.dumps(data, separators=(',', ':'), default=str)
+        self._ensure_started()
+        with self._cond:
+            self._pending.append((event_type, payload, time.time()))
+            self.published += 1
+            self._cond.notify()
+        if self._stopping:
+            self._write()
+
+    # ---------- writer / reader threads ----------
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._pending:
+                    return
+            self._write()
+
+    def _write(self):
+        with self._cond:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT INTO events (type, data, at) VALUES (?, ?, ?)', batch)
+                last_id = conn.execute('SELECT MAX(id) FROM events').fetchone()[0]
+                if last_id % 100 < len(batch):
+                    # Trim the log to buffer_size about every 100 events
+                    conn.execute('DELETE FROM events WHERE id <= ?', (last_id - self.buffer_size,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            self.write_errors += len(batch)
+            log.warning('Could not write events', count=len(batch), error=str(e), sample='write')
+            return
+        self._wake.set()  # this worker's clients get them without waiting for the poll
+
+    def _read_loop(self):
+        while not self._stopping:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self._poll()
+            except sqlite3.Error as e:
+                log.warning('Could not read events', error=str(e), sample='read')
+
+    def _poll(self):
+        with self._lock:
+            if not self._clients:
+                self._read_id = self._last_id()
+                return
+            rows = self._conn().execute('SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?',
+                                        (self._read_id, READ_BATCH)).fetchall()
+            if not rows:
+                return
+            self._read_id = rows[-1][0]
+            clients = list(self._clients)
+        for client in clients:
+            for item in rows:
+                client.push(item)
+        if len(rows) == READ_BATCH:
+            self._wake.set()
+
+    def shutdown(self):
+        """Write events still pending (atexit)"""
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._write()
+
+    # ---------- clients ----------
+
+    def subscribe(self, last_event_id=None):
+        """
+        Register a client, replaying logged events after `last_event_id`.
+
+        Returns:
+            _Client
+        """
+        self._ensure_started()
+        client = _Client(self.client_buffer)
+        with self._lock:
+            if last_event_id is not None:
+                conn = self._conn()
+                oldest = conn.execute('SELECT MIN(id) FROM events').fetchone()[0] or self._read_id + 1
+                if last_event_id < oldest - 1 or last_event_id > self._read_id:
+                    client.overflowed = True
+                else:
+                    rows = conn.execute('SELECT id, type, data FROM events WHERE id > ? AND id <= ? ORDER BY id '
+                                        'LIMIT ?', (last_event_id, self._read_id, self.client_buffer + 1)).fetchall()
+                    for item in rows:
+                        client.push(item)
+            self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def stream(self, client):
+        """
+        Generator of SSE text for one client; ends when the client disconnects.
+        """
+        try:
+            yield 'retry: 3000\n: connected\n\n'
+            while True:
+                with client.cond:
+                    if not client.queue and not client.overflowed:
+                        client.cond.wait(self.heartbeat)
+                    items = list(client.queue)
+                    client.queue.clear()
+                    overflowed = client.overflowed
+                    client.overflowed = False
+                if overflowed:
+                    with self._lock:
+                        current_id = self._read_id
+                    yield format_sse(current_id, 'resync', '{}')
+                    continue
+                if not items:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield ''.join(format_sse(*item) for item in items)
+        finally:
+            self.unsubscribe(client)
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._clients)
+            read_id = self._read_id
+        with self._cond:
+            pending = len(self._pending)
+        return {'clients': clients, 'published': self.published, 'pending': pending,
+                'write_errors': self.write_errors, 'last_event_id': read_id}
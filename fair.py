@@ -0,0 +1,231 @@
+import time
+import queue
+import threading
+from collections import deque
+from metrics import registry
+
+# ============================================
+# PER-PAGE FAIR SCHEDULING
+# ============================================
+# Work queued by the ingest pool and the send queue is kept in one FIFO per
+# page and served deficit round robin: each page in turn gets `weight`
+# items (page config 'weight', default 1) before the next page is served.
+# A page at its concurrency cap - or one the caller's claim() hook refuses,
+# e.g. out of send tokens - is skipped for that turn instead of blocking
+# the others. A campaign flooding one page therefore only lengthens that
+# page's own queue; quiet pages wait for at most one round.
+#
+# Per-page depth, in-flight count and queue wait are in stats(), and the
+# wait is exported as chathub_queue_wait_seconds{queue, page}.
+# ============================================
+
+QUEUE_WAIT_SECONDS = registry.histogram(
+    'chathub_queue_wait_seconds', 'Time work waits in a per-page fair queue', ('queue', 'page'))
+
+# Longest get() sleeps before re-checking pages its claim() hook refused
+CLAIM_RETRY_INTERVAL = 0.05
+
+
+class _PageState:
+    __slots__ = ('items', 'credits', 'in_flight', 'enqueued', 'served', 'total_wait', 'max_wait', 'last_wait',
+                 'max_depth')
+
+    def __init__(self):
+        self.items = deque()
+        self.credits = 0
+        self.in_flight = 0
+        self.enqueued = 0
+        self.served = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.max_depth = 0
+
+
+class FairScheduler:
+    """
+    Not thread-safe core of the fair queue (the asyncio pool uses it directly).
+
+    Args:
+        name: queue label for metrics, e.g. 'ingest'
+        concurrency: items of one page in flight at once (0 = no cap)
+        weight: fn(key) -> items served per round (default 1)
+        claim: fn(key) -> bool, called for the page about to be served; False skips it this round
+    """
+
+    def __init__(self, name, concurrency=0, weight=None, claim=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.weight = weight
+        self.claim = claim
+        self._pages = {}
+        self._ring = deque()     # pages with queued items, in service order
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key, item):
+        page = self._pages.get(key)
+        if page is None:
+            page = self._pages[key] = _PageState()
+        if not page.items:
+            self._ring.append(key)
+        page.items.append((time.monotonic(), item))
+        page.enqueued += 1
+        page.max_depth = max(page.max_depth, len(page.items))
+        self._size += 1
+
+    def pop(self):
+        """
+        Next (key, item) in fair order, or None if every page with work is
+        at its cap or refused by claim().
+        """
+        for _ in range(len(self._ring)):
+            key = self._ring[0]
+            page = self._pages[key]
+            if (self.concurrency and page.in_flight >= self.concurrency) or (self.claim and not self.claim(key)):
+                self._ring.rotate(-1)
+                continue
+            if page.credits <= 0:
+                page.credits += max(1, int(self._weight(key)))
+            page.credits -= 1
+            enqueued_at, item = page.items.popleft()
+            self._size -= 1
+            page.in_flight += 1
+            page.served += 1
+            wait = time.monotonic() - enqueued_at
+            page.last_wait = wait
+            page.total_wait += wait
+            page.max_wait = max(page.max_wait, wait)
+            QUEUE_WAIT_SECONDS.observe(wait, queue=self.name, page=str(key))
+            if not page.items:
+                self._ring.popleft()
+                page.credits = 0
+            elif page.credits <= 0:
+                self._ring.rotate(-1)
+            return key, item
+        return None
+
+    def done(self, key):
+        """The item popped for `key` finished (frees a concurrency slot)"""
+        page = self._pages.get(key)
+        if page and page.in_flight:
+            page.in_flight -= 1
+
+    def _weight(self, key):
+        if not self.weight:
+            return 1
+        try:
+            return self.weight(key) or 1
+        except Exception:
+            return 1
+
+    def stats(self):
+        """Per-page depth, in-flight count and queue wait"""
+        return {
+            str(key): {
+                'depth': len(page.items),
+                'max_depth': page.max_depth,
+                'in_flight': page.in_flight,
+                'enqueued': page.enqueued,
+                'served': page.served,
+                'weight': self._weight(key),
+                'last_wait_ms': round(page.last_wait * 1000, 2),
+                'avg_wait_ms': round(page.total_wait / page.served * 1000, 2) if page.served else 0,
+                'max_wait_ms': round(page.max_wait * 1000, 2)
+            }
+            for key, page in list(self._pages.items())
+        }
+
+
+class FairQueue:
+    """
+    Thread-safe FairScheduler with a queue.Queue-like interface.
+
+    get() returns (key, item); call done(key) once the item is processed.
+    After close(), get() drains what is queued and then raises queue.Empty.
+    """
+
+    def __init__(self, name, maxsize=0, concurrency=0, weight=None, claim=None):
+        self.maxsize = maxsize
+        self._scheduler = FairScheduler(name, concurrency, weight, claim)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def qsize(self):
+        with self._cond:
+            return len(self._scheduler)
+
+    def put(self, key, item, timeout=None):
+        """Raises queue.Full if the queue stays full for `timeout` seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.maxsize and len(self._scheduler) >= self.maxsize:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self._cond.wait(remaining)
+            self._scheduler.push(key, item)
+            self._cond.notify_all()
+
+    def put_nowait(self, key, item):
+        self.put(key, item, timeout=0)
+
+    def get(self, timeout=None):
+        """Raises queue.Empty if nothing is servable within `timeout` seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                popped = self._scheduler.pop()
+                if popped is not None:
+                    self._cond.notify_all()
+                    return popped
+                if self._closed and not len(self._scheduler):
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                if len(self._scheduler) and self._scheduler.claim:
+                    # Work is waiting on claim() (e.g. a token bucket) - look again shortly
+                    remaining = CLAIM_RETRY_INTERVAL if remaining is None else min(remaining, CLAIM_RETRY_INTERVAL)
+                self._cond.wait(remaining)
+
+    def done(self, key):
+        with self._cond:
+            self._scheduler.done(key)
+            self._cond.notify_all()
+
+    def close(self):
+        """Let get() callers exit once the queue is drained"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def wake(self):
+        """Re-check pages that were skipped (a shared limit was released elsewhere)"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return self._scheduler.stats()
+
+
+def merge_stats(stats_list):
+    """Per-page stats of several fair queues (e.g. send shards) combined"""
+    merged = {}
+    for stats in stats_list:
+        for key, page in stats.items():
+            into = merged.get(key)
+            if into is None:
+                merged[key] = dict(page)
+                continue
+            served = into['served'] + page['served']
+            into['avg_wait_ms'] = round((into['avg_wait_ms'] * into['served'] + page['avg_wait_ms'] * page['served'])
+                                        / served, 2) if served else 0
+            for field in ('depth', 'max_depth', 'in_flight', 'enqueued', 'served'):
+                into[field] += page[field]
+            into['max_wait_ms'] = max(into['max_wait_ms'], page['max_wait_ms'])
+            into['last_wait_ms'] = page['last_wait_ms']
+    return merged
@@ -0,0 +1,504 @@
+import os
+import json
+import time
+import random
+import hashlib
+import asyncio
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from metrics import graph_endpoint, GRAPH_REQUEST_SECONDS, GRAPH_REQUESTS_TOTAL
+
+# ============================================
+# GRAPH API CLIENT
+# ============================================
+# One shared client for every Facebook Graph API call:
+#   - keep-alive connection pool per host (requests.Session)
+#   - retries with jittered exponential backoff on transient errors
+#   - per-page usage budgets from X-App-Usage / X-Business-Use-Case-Usage
+#     so we slow down before Facebook answers with error 4/17/32/613
+#   - circuit breaker per page token
+#   - batch requests: up to GRAPH_BATCH_SIZE lookups in one HTTP call
+#
+# `async_graph` is the asyncio twin used by the ASGI entry point (asgi.py):
+# the same retry / budget / breaker rules on an httpx.AsyncClient, sharing
+# usage and breaker state with `graph` so both modes see the same limits.
+#
+# Settings (env):
+#   GRAPH_API_BASE              base URL (default https://graph.facebook.com),
+#                               point it at a local stub server for testing
+#   GRAPH_API_VERSION           API version (default v19.0)
+#   GRAPH_POOL_SIZE             connections kept per host (default 20)
+#   GRAPH_MAX_RETRIES           retries on transient errors (default 3)
+#   GRAPH_USAGE_SOFT_LIMIT      usage % where we start spacing out calls (default 75)
+#   GRAPH_USAGE_HARD_LIMIT      usage % where calls are refused locally (default 95)
+#   GRAPH_BREAKER_THRESHOLD     consecutive failures that open a breaker (default 5)
+#   GRAPH_BREAKER_COOLDOWN      seconds a breaker stays open, and the longest its
+#                               half-open trial call may hold it (default 30)
+#   ASYNC_GRAPH_MAX_CONNECTIONS connections in flight per worker in async mode (default 100)
+# ============================================
+
+GRAPH_API_BASE = os.getenv('GRAPH_API_BASE', 'https://graph.facebook.com').rstrip('/')
+GRAPH_API_VERSION = os.getenv('GRAPH_API_VERSION', 'v19.0')
+GRAPH_POOL_SIZE = int(os.getenv('GRAPH_POOL_SIZE', '20'))
+GRAPH_MAX_RETRIES = int(os.getenv('GRAPH_MAX_RETRIES', '3'))
+GRAPH_USAGE_SOFT_LIMIT = float(os.getenv('GRAPH_USAGE_SOFT_LIMIT', '75'))
+GRAPH_USAGE_HARD_LIMIT = float(os.getenv('GRAPH_USAGE_HARD_LIMIT', '95'))
+GRAPH_BREAKER_THRESHOLD = int(os.getenv('GRAPH_BREAKER_THRESHOLD', '5'))
+GRAPH_BREAKER_COOLDOWN = float(os.getenv('GRAPH_BREAKER_COOLDOWN', '30'))
+ASYNC_GRAPH_MAX_CONNECTIONS = int(os.getenv('ASYNC_GRAPH_MAX_CONNECTIONS', '100'))
+
+# Facebook error codes that mean "slow down" (app / page / business rate limits)
+THROTTLE_ERROR_CODES = {4, 17, 32, 613, 80001, 80006}
+# Facebook error codes that are safe to retry
+TRANSIENT_ERROR_CODES = {1, 2}
+# Token errors - open the breaker immediately, retrying won't help
+TOKEN_ERROR_CODES = {190}
+
+# Longest we sleep before a call when usage is between the soft and hard limits
+MAX_THROTTLE_DELAY = 0.5
+
+# Most requests Facebook accepts in one batch call
+GRAPH_BATCH_SIZE = 50
+
+
+class GraphThrottled(requests.exceptions.RequestException):
+    """Call refused locally because the page is over its usage budget"""
+
+
+class GraphCircuitOpen(requests.exceptions.RequestException):
+    """Call refused locally because the token's circuit breaker is open"""
+
+
+class GraphNotConnected(requests.exceptions.ConnectionError):
+    """No connection to Graph could be made - the request was never sent"""
+
+
+def _connect_failed(error):
+    """True for a requests ConnectionError raised while connecting (before anything was sent)"""
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _error_code(response):
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    if isinstance(data, dict) and isinstance(data.get('error'), dict):
+        return data['error'].get('code')
+    return None
+
+
+class _Breaker:
+    """
+    Consecutive-failure circuit breaker with a single half-open trial call.
+
+    The trial is released when its call finishes without an outcome (e.g.
+    refused by the usage budget, cancelled) and expires after `cooldown`
+    seconds, so a lost trial can't keep the breaker closed to every call.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_until = 0.0
+        self.half_open = False
+        self.trial_until = 0.0
+
+    def allow(self, now, cooldown):
+        """
+        Returns:
+            tuple: (allowed, trial) - trial identifies the half-open trial call, or is None
+        """
+        if self.opened_until <= 0:
+            return True, None
+        if now < self.opened_until:
+            return False, None
+        if self.half_open and now < self.trial_until:
+            return False, None
+        self.half_open = True
+        self.trial_until = now + cooldown
+        return True, self.trial_until
+
+    def end_trial(self, trial):
+        # A newer trial (this one expired) is left alone
+        if self.half_open and self.trial_until == trial:
+            self.half_open = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_until = 0.0
+        self.half_open = False
+
+    def failure(self, now, threshold, cooldown, force=False):
+        self.failures += 1
+        self.half_open = False
+        if force or self.failures >= threshold:
+            self.opened_until = now + cooldown
+
+
+class GraphClient:
+    """
+    Pooled, rate-limit-aware Graph API client.
+
+    Methods return the `requests.Response` so callers keep their existing
+    status / error handling. Local refusals (budget, breaker) and network
+    failures raise `requests.exceptions.RequestException` subclasses.
+    """
+
+    def __init__(self, base_url=GRAPH_API_BASE, version=GRAPH_API_VERSION,
+                 pool_size=GRAPH_POOL_SIZE, max_retries=GRAPH_MAX_RETRIES):
+        self.base_url = base_url
+        self.version = version
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._usage = {}      # page key -> {'pct': float, 'regain_at': float, 'updated': float}
+        self._breakers = {}   # token hash -> _Breaker
+
+    def url(self, path):
+        """Build a versioned Graph URL for a path like 'me/messages'"""
+        return f'{self.base_url}/{self.version}/{path.lstrip("/")}'
+
+    def get(self, path, access_token=None, page_id=None, **kwargs):
+        return self.request('GET', path, access_token=access_token, page_id=page_id, **kwargs)
+
+    def post(self, path, access_token=None, page_id=None, **kwargs):
+        return self.request('POST', path, access_token=access_token, page_id=page_id, **kwargs)
+
+    def batch(self, requests_, access_token=None, page_id=None, timeout=30):
+        """
+        Run up to GRAPH_BATCH_SIZE Graph requests in one HTTP call.
+
+        Args:
+            requests_: [{'method': 'GET', 'relative_url': '{message_id}?fields=from'}, ...]
+
+        Returns:
+            list: (status code, parsed body) per request, in order; (None, None)
+                  for a request Facebook did not run (e.g. it timed out)
+
+        Raises:
+            ValueError: more than GRAPH_BATCH_SIZE requests
+            requests.exceptions.RequestException: the batch call itself failed
+        """
+        if len(requests_) > GRAPH_BATCH_SIZE:
+            raise ValueError(f'At most {GRAPH_BATCH_SIZE} requests per batch, got {len(requests_)}')
+        response = self.post('', access_token=access_token, page_id=page_id, timeout=timeout,
+                             data={'batch': json.dumps(requests_), 'include_headers': 'false'})
+        if response.status_code != 200:
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            return [(response.status_code, body)] * len(requests_)
+
+        results = []
+        for item in response.json():
+            if not item:
+                results.append((None, None))
+                continue
+            try:
+                body = json.loads(item.get('body') or 'null')
+            except ValueError:
+                body = None
+            results.append((item.get('code'), body))
+        return results
+
+    def request(self, method, path, access_token=None, page_id=None, params=None, **kwargs):
+        """
+        Send a Graph API request.
+
+        Args:
+            method: HTTP method
+            path: Graph path relative to the version, e.g. 'me/messages'
+            access_token: Page Access Token (added to params)
+            page_id: Facebook Page ID used for usage budgets (defaults to the token)
+            params / kwargs: passed through to requests
+
+        Returns:
+            requests.Response
+        """
+        call = self._call(method, path, access_token, page_id, params)
+        attempt = 0
+        while True:
+            trial = self._check_breaker(call['token_key'])
+            try:
+                delay = self._budget_delay(call['budget_key'])
+                if delay:
+                    time.sleep(delay)
+                if attempt and hasattr(kwargs.get('data'), 'seek'):
+                    # A streamed body was (partly) read by the failed attempt
+                    kwargs['data'].seek(0)
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, call['url'], params=call['params'], **kwargs)
+                except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout) as e:
+                    if self._retry_after_error(call, isinstance(e, requests.exceptions.ConnectTimeout), attempt):
+                        time.sleep(self._backoff_delay(attempt))
+                        attempt += 1
+                        continue
+                    if not isinstance(e, requests.exceptions.ConnectTimeout) and _connect_failed(e):
+                        raise GraphNotConnected(str(e)) from e
+                    raise
+
+                if self._retry_after_response(call, response, time.perf_counter() - started, attempt):
+                    time.sleep(self._backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                return response
+            finally:
+                if trial:
+                    self._end_trial(call['token_key'], trial)
+
+    # ---------- retry decisions (shared with AsyncGraphClient) ----------
+
+    def _call(self, method, path, access_token, page_id, params):
+        params = dict(params or {})
+        if access_token:
+            params['access_token'] = access_token
+        token_key = hashlib.sha256(access_token.encode()).hexdigest()[:16] if access_token else 'anonymous'
+        return {
+            'params': params,
+            'url': self.url(path),
+            'token_key': token_key,
+            'budget_key': str(page_id) if page_id else token_key,
+            'endpoint': graph_endpoint(path),
+            'page_label': str(page_id) if page_id else 'unknown',
+            # POST to the Send API is not idempotent - only retry when Facebook
+            # clearly rejected the call (throttled / connect failure)
+            'idempotent': method.upper() == 'GET'
+        }
+
+    def _retry_after_error(self, call, connect_timeout, attempt):
+        """Record a network failure; True if the call should be retried"""
+        GRAPH_REQUESTS_TOTAL.inc(endpoint=call['endpoint'], page=call['page_label'], status='error')
+        self._record_failure(call['token_key'])
+        return (call['idempotent'] or connect_timeout) and attempt < self.max_retries
+
+    def _retry_after_response(self, call, response, elapsed, attempt):
+        """Record a response (usage, breaker, metrics); True if the call should be retried"""
+        GRAPH_REQUEST_SECONDS.observe(elapsed, endpoint=call['endpoint'], page=call['page_label'])
+        GRAPH_REQUESTS_TOTAL.inc(endpoint=call['endpoint'], page=call['page_label'], status=response.status_code)
+        self._record_usage(call['budget_key'], response)
+        code = _error_code(response) if response.status_code >= 400 else None
+
+        if code in TOKEN_ERROR_CODES:
+            self._record_failure(call['token_key'], force=True)
+            return False
+        if code in THROTTLE_ERROR_CODES or response.status_code == 429:
+            # Rate limits last minutes - retrying now only burns more budget
+            self._mark_throttled(call['budget_key'])
+            return False
+        if response.status_code >= 500 or code in TRANSIENT_ERROR_CODES:
+            self._record_failure(call['token_key'])
+            return (call['idempotent'] or response.status_code == 503) and attempt < self.max_retries
+
+        self._record_success(call['token_key'])
+        return False
+
+    # ---------- backoff ----------
+
+    def _backoff_delay(self, attempt, base=0.2):
+        # Full jitter: a random amount up to base * 2^attempt
+        return random.uniform(0, base * (2 ** attempt))
+
+    # ---------- circuit breaker ----------
+
+    def _check_breaker(self, token_key):
+        """
+        Raises GraphCircuitOpen if the token's breaker refuses the call.
+
+        Returns:
+            the half-open trial to pass to _end_trial, or None
+        """
+        with self._lock:
+            breaker = self._breakers.get(token_key)
+            if not breaker:
+                return None
+            allowed, trial = breaker.allow(time.monotonic(), GRAPH_BREAKER_COOLDOWN)
+            if not allowed:
+                raise GraphCircuitOpen('Graph API circuit open for this page token')
+            return trial
+
+    def _end_trial(self, token_key, trial):
+        """Release a half-open trial whose call ended without success() / failure()"""
+        with self._lock:
+            breaker = self._breakers.get(token_key)
+            if breaker:
+                breaker.end_trial(trial)
+
+    def _record_failure(self, token_key, force=False):
+        with self._lock:
+            breaker = self._breakers.setdefault(token_key, _Breaker())
+            breaker.failure(time.monotonic(), GRAPH_BREAKER_THRESHOLD, GRAPH_BREAKER_COOLDOWN, force=force)
+
+    def _record_success(self, token_key):
+        with self._lock:
+            breaker = self._breakers.get(token_key)
+            if breaker:
+                breaker.success()
+
+    # ---------- usage budgets ----------
+
+    def _record_usage(self, budget_key, response):
+        pct = 0.0
+        regain_minutes = 0.0
+        for header in ('X-App-Usage', 'X-Page-Usage'):
+            raw = response.headers.get(header)
+            if raw:
+                try:
+                    usage = json.loads(raw)
+                    pct = max(pct, *(float(usage.get(k, 0) or 0) for k in ('call_count', 'total_cputime', 'total_time')))
+                except (ValueError, TypeError, AttributeError):
+                    pass
+        raw = response.headers.get('X-Business-Use-Case-Usage')
+        if raw:
+            try:
+                for entries in json.loads(raw).values():
+                    for usage in entries:
+                        pct = max(pct, *(float(usage.get(k, 0) or 0) for k in ('call_count', 'total_cputime', 'total_time')))
+                        regain_minutes = max(regain_minutes, float(usage.get('estimated_time_to_regain_access', 0) or 0))
+            except (ValueError, TypeError, AttributeError):
+                pass
+        if not pct and not regain_minutes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._usage[budget_key] = {
+                'pct': pct,
+                'regain_at': now + regain_minutes * 60 if regain_minutes else 0.0,
+                'updated': now
+            }
+
+    def _mark_throttled(self, budget_key):
+        now = time.monotonic()
+        with self._lock:
+            usage = self._usage.setdefault(budget_key, {'pct': 100.0, 'regain_at': 0.0, 'updated': now})
+            usage['pct'] = max(usage['pct'], 100.0)
+            usage['updated'] = now
+
+    def _budget_delay(self, budget_key):
+        """Seconds to wait before the next call on this budget (raises GraphThrottled over the hard limit)"""
+        with self._lock:
+            usage = self._usage.get(budget_key)
+            if not usage:
+                return 0.0
+            usage = dict(usage)
+        now = time.monotonic()
+        if usage['regain_at'] > now:
+            raise GraphThrottled(f'Graph API budget exhausted, retry in {int(usage["regain_at"] - now)}s')
+        # Usage percentages are over a rolling hour - let stale readings decay
+        pct = usage['pct'] - (now - usage['updated']) / 36.0
+        if pct >= GRAPH_USAGE_HARD_LIMIT:
+            raise GraphThrottled(f'Graph API usage at {pct:.0f}%')
+        if pct >= GRAPH_USAGE_SOFT_LIMIT:
+            # Spread calls out as we approach the limit
+            return (pct - GRAPH_USAGE_SOFT_LIMIT) / (GRAPH_USAGE_HARD_LIMIT - GRAPH_USAGE_SOFT_LIMIT) * MAX_THROTTLE_DELAY
+        return 0.0
+
+    def stats(self):
+        """Usage budgets and open breakers, for health endpoints"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'usage': {k: {'pct': round(v['pct'], 1),
+                              'regain_in_s': max(0, int(v['regain_at'] - now)) if v['regain_at'] else 0}
+                          for k, v in self._usage.items()},
+                'open_breakers': sum(1 for b in self._breakers.values() if b.opened_until > now)
+            }
+
+
+def _httpx_timeout(timeout):
+    # requests style: seconds, or a (connect, read) tuple
+    if isinstance(timeout, tuple):
+        return httpx.Timeout(timeout[1], connect=timeout[0])
+    return timeout
+
+
+class AsyncGraphClient:
+    """
+    asyncio Graph API client for the ASGI entry point.
+
+    Same interface as GraphClient (`await async_graph.get(...)`), returning an
+    httpx.Response. Network failures are raised as the matching
+    `requests.exceptions` types so callers share their error handling with
+    the sync code. The httpx client is created on first use in each worker,
+    inside the serving event loop.
+
+    Args:
+        shared: GraphClient whose usage budgets and breakers are shared
+    """
+
+    def __init__(self, shared, max_connections=ASYNC_GRAPH_MAX_CONNECTIONS):
+        self.shared = shared
+        self.max_connections = max_connections
+        self._client = None
+        self._pid = None
+
+    def _session(self):
+        if self._client is None or self._pid != os.getpid():
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.max_connections, max_keepalive_connections=GRAPH_POOL_SIZE))
+            self._pid = os.getpid()
+        return self._client
+
+    async def get(self, path, access_token=None, page_id=None, **kwargs):
+        return await self.request('GET', path, access_token=access_token, page_id=page_id, **kwargs)
+
+    async def post(self, path, access_token=None, page_id=None, **kwargs):
+        return await self.request('POST', path, access_token=access_token, page_id=page_id, **kwargs)
+
+    async def request(self, method, path, access_token=None, page_id=None, params=None, timeout=10, **kwargs):
+        """Send a Graph API request without blocking the event loop (see GraphClient.request)"""
+        shared = self.shared
+        call = shared._call(method, path, access_token, page_id, params)
+        attempt = 0
+        while True:
+            trial = shared._check_breaker(call['token_key'])
+            try:
+                delay = shared._budget_delay(call['budget_key'])
+                if delay:
+                    await asyncio.sleep(delay)
+                started = time.perf_counter()
+                try:
+                    response = await self._session().request(method, call['url'], params=call['params'],
+                                                             timeout=_httpx_timeout(timeout), **kwargs)
+                except httpx.TransportError as e:
+                    if isinstance(e, httpx.ConnectTimeout):
+                        error = requests.exceptions.ConnectTimeout(str(e))
+                    elif isinstance(e, httpx.TimeoutException):
+                        error = requests.exceptions.Timeout(str(e))
+                    elif isinstance(e, httpx.ConnectError):
+                        error = GraphNotConnected(str(e))
+                    else:
+                        error = requests.exceptions.ConnectionError(str(e))
+                    if shared._retry_after_error(call, isinstance(e, httpx.ConnectTimeout), attempt):
+                        await asyncio.sleep(shared._backoff_delay(attempt))
+                        attempt += 1
+                        continue
+                    raise error from e
+
+                if shared._retry_after_response(call, response, time.perf_counter() - started, attempt):
+                    await asyncio.sleep(shared._backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                return response
+            finally:
+                if trial:
+                    shared._end_trial(call['token_key'], trial)
+
+    async def aclose(self):
+        if self._client is not None and self._pid == os.getpid():
+            await self._client.aclose()
+        self._client = None
+
+
+# Shared clients - use these everywhere instead of calling requests / httpx directly
+graph = GraphClient()
+async_graph = AsyncGraphClient(graph)
@@ -0,0 +1,67 @@
+import gzip
+import json
+import hashlib
+from flask import request, Response
+
+# ============================================
+# CONDITIONAL + COMPRESSED JSON RESPONSES
+# ============================================
+# List endpoints return a weak ETag of the body. A poll that sends the
+# same If-None-Match gets an empty 304, and larger bodies are gzipped
+# when the client accepts it.
+# ============================================
+
+GZIP_MIN_BYTES = 1024
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # Weak comparison - the same ETag covers the gzipped and plain variants
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith('W/') else tag) == opaque:
+            return True
+    return False
+
+
+def conditional_json(payload, status=200):
+    """
+    Build a JSON response with ETag / If-None-Match and gzip support.
+
+    Args:
+        payload: JSON-serializable body
+        status: HTTP status for a fresh response
+
+    Returns:
+        flask.Response
+    """
+    status, headers, body = conditional_json_parts(payload, request.headers.get('If-None-Match'),
+                                                   request.headers.get('Accept-Encoding', ''), status)
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+
+def conditional_json_parts(payload, if_none_match, accept_encoding, status=200):
+    """
+    Framework-free core of conditional_json (also used by the ASGI routes).
+
+    Returns:
+        tuple: (status, headers dict, body bytes) - an empty body for 304
+    """
+    body = json.dumps(payload, separators=(',', ':'), default=str).encode()
+    etag = 'W/"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+
+    if status == 200 and _etag_matches(if_none_match, etag):
+        return 304, headers, b''
+
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in (accept_encoding or ''):
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+
+    return status, headers, body
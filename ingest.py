@@ -0,0 +1,276 @@
+import os
+import asyncio
+import queue
+import threading
+import time
+import atexit
+from fair import FairQueue, FairScheduler
+from log import get_logger
+
+# ============================================
+# INGEST WORKER POOL
+# ============================================
+# The webhook only enqueues entries and returns EVENT_RECEIVED.
+# A bounded pool of worker threads drains the queue and runs the
+# (slow) message handling: Graph API lookups and Supabase writes.
+#
+# Settings (env):
+#   INGEST_WORKERS           number of worker threads (default 4)
+#   INGEST_QUEUE_SIZE        max queued entries (default 1000)
+#   INGEST_ENQUEUE_TIMEOUT   seconds to wait for a free slot before
+#                            processing inline in the request (default 0.5)
+#   ASYNC_INGEST_CONCURRENCY entries handled at once per worker in async
+#                            mode (default 100)
+#   INGEST_PAGE_CONCURRENCY  entries of one page handled at once (default
+#                            INGEST_WORKERS - 1, so another page always
+#                            has a worker; 0 = no cap)
+#   ASYNC_INGEST_PAGE_CONCURRENCY  the same in async mode (default 3/4 of
+#                            ASYNC_INGEST_CONCURRENCY)
+#
+# Queued entries are served per page, weighted fair (fair.py), so a burst
+# on one page doesn't delay the others.
+#
+# Under the ASGI entry point (asgi.py) entries run as asyncio tasks on the
+# serving event loop instead (AsyncIngestPool): no threads, so one worker
+# keeps many Graph / Supabase calls in flight. INGEST_QUEUE_SIZE still
+# bounds the backlog.
+# ============================================
+
+log = get_logger('ingest')
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '4'))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '1000'))
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv('INGEST_ENQUEUE_TIMEOUT', '0.5'))
+ASYNC_INGEST_CONCURRENCY = int(os.getenv('ASYNC_INGEST_CONCURRENCY', '100'))
+INGEST_PAGE_CONCURRENCY = int(os.getenv('INGEST_PAGE_CONCURRENCY', str(max(1, INGEST_WORKERS - 1))))
+ASYNC_INGEST_PAGE_CONCURRENCY = int(os.getenv('ASYNC_INGEST_PAGE_CONCURRENCY',
+                                              str(max(1, ASYNC_INGEST_CONCURRENCY * 3 // 4))))
+
+
+class IngestPool:
+    """
+    Bounded queue + worker threads for webhook entries.
+
+    Workers are started lazily on the first submit so that the threads
+    belong to the gunicorn worker process, not the preloading master.
+
+    Backpressure: when the queue stays full for `enqueue_timeout` seconds
+    the entry is processed inline by the caller, which slows down the
+    webhook response instead of dropping events.
+
+    Args:
+        key: fn(*args) -> page id the work belongs to (fair scheduling)
+        weight: fn(page_id) -> the page's share per round
+    """
+
+    def __init__(self, handler, workers=INGEST_WORKERS, max_size=INGEST_QUEUE_SIZE,
+                 enqueue_timeout=INGEST_ENQUEUE_TIMEOUT, key=None, weight=None,
+                 page_concurrency=INGEST_PAGE_CONCURRENCY):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.enqueue_timeout = enqueue_timeout
+        self.key = key
+        self._queue = FairQueue('ingest', maxsize=max_size, concurrency=page_concurrency, weight=weight)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopping = False
+
+        # Stats
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.inline = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'ingest-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            atexit.register(self.shutdown)
+            log.info('Ingest pool started', workers=self.workers, queue_size=self._queue.maxsize)
+
+    def submit(self, *args):
+        """
+        Queue one unit of work for the handler.
+
+        Returns:
+            bool: True if queued, False if it was processed inline (queue full)
+        """
+        self._ensure_started()
+        try:
+            self._queue.put(self.key(*args) if self.key else None, (time.monotonic(), args),
+                            timeout=self.enqueue_timeout)
+            self.enqueued += 1
+            return True
+        except queue.Full:
+            log.warning('Ingest queue full, processing inline', queue_depth=self._queue.qsize())
+            self.inline += 1
+            self._process(args)
+            return False
+
+    def _run(self):
+        while True:
+            try:
+                key, (enqueued_at, args) = self._queue.get()
+            except queue.Empty:
+                # Closed and drained
+                break
+            lag = time.monotonic() - enqueued_at
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            try:
+                self._process(args)
+            finally:
+                self._queue.done(key)
+
+    def _process(self, args):
+        try:
+            self.handler(*args)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            log.exception('Ingest worker error', error=str(e))
+
+    def shutdown(self, timeout=10):
+        """Drain the queue and stop the workers."""
+        if self._stopping or self._pid != os.getpid():
+            return
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        self._queue.close()
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        """Queue depth, lag and counters for health endpoints."""
+        return {
+            'workers': self.workers,
+            'queue_depth': self._queue.qsize(),
+            'queue_capacity': self._queue.maxsize,
+            'pages': self._queue.stats(),
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'inline': self.inline,
+            'last_lag_ms': round(self.last_lag * 1000, 2),
+            'max_lag_ms': round(self.max_lag * 1000, 2)
+        }
+
+
+class AsyncIngestPool:
+    """
+    Webhook entries as asyncio tasks, for the ASGI entry point.
+
+    Args:
+        handler: async fn(*args) run for each submitted entry
+        key / weight: as for IngestPool
+
+    Entries wait in a per-page fair scheduler and at most `concurrency`
+    run at once. Backpressure mirrors IngestPool: once `max_size` entries
+    are pending the next one is handled inline, so the webhook response
+    slows down instead of events being dropped.
+    """
+
+    def __init__(self, handler, concurrency=ASYNC_INGEST_CONCURRENCY, max_size=INGEST_QUEUE_SIZE, key=None,
+                 weight=None, page_concurrency=ASYNC_INGEST_PAGE_CONCURRENCY):
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.max_size = max_size
+        self.key = key
+        self._scheduler = FairScheduler('ingest_async', concurrency=page_concurrency, weight=weight)
+        self._running = 0
+        self._tasks = set()
+
+        # Stats
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.inline = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _pending(self):
+        return len(self._tasks) + len(self._scheduler)
+
+    async def submit(self, *args):
+        """
+        Schedule one unit of work on the running event loop.
+
+        Returns:
+            bool: True if scheduled, False if it was processed inline (backlog full)
+        """
+        if self._pending() >= self.max_size:
+            log.warning('Async ingest backlog full, processing inline', pending=self._pending())
+            self.inline += 1
+            await self._handle(time.monotonic(), args)
+            return False
+        self._scheduler.push(self.key(*args) if self.key else None, (time.monotonic(), args))
+        self.enqueued += 1
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        """Start queued entries, in fair order, while below the concurrency limit"""
+        loop = asyncio.get_running_loop()
+        while self._running < self.concurrency:
+            popped = self._scheduler.pop()
+            if popped is None:
+                return
+            key, (enqueued_at, args) = popped
+            self._running += 1
+            task = loop.create_task(self._process(key, enqueued_at, args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, key, enqueued_at, args):
+        try:
+            await self._handle(enqueued_at, args)
+        finally:
+            self._running -= 1
+            self._scheduler.done(key)
+            self._dispatch()
+
+    async def _handle(self, enqueued_at, args):
+        lag = time.monotonic() - enqueued_at
+        self.last_lag = lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        try:
+            await self.handler(*args)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            log.exception('Async ingest error', error=str(e))
+
+    async def shutdown(self, timeout=10):
+        """Wait for pending entries (called on ASGI lifespan shutdown)"""
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline:
+            await asyncio.wait(set(self._tasks), timeout=max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        """Pending entries, lag and counters for health endpoints."""
+        return {
+            'concurrency': self.concurrency,
+            'pending': self._pending(),
+            'running': self._running,
+            'capacity': self.max_size,
+            'pages': self._scheduler.stats(),
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'inline': self.inline,
+            'last_lag_ms': round(self.last_lag * 1000, 2),
+            'max_lag_ms': round(self.max_lag * 1000, 2)
+        }
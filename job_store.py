@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+# ============================================
+# JOB STORE
+# ============================================
+# Status of background jobs (queued sends, backfills, ...) in a local
+# SQLite file, so any gunicorn worker can answer a status request for a
+# job that another worker is running.
+#
+# Settings (env):
+#   JOB_DB_PATH     SQLite file shared by workers (default jobs.sqlite3)
+#   JOB_RETENTION   seconds finished jobs are kept (default 7 days)
+# ============================================
+
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'jobs.sqlite3')
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', str(7 * 24 * 3600)))
+
+FINISHED_STATES = ('sent', 'failed', 'unknown', 'completed', 'cancelled')
+
+
+class JobStore:
+    """Shared key/value store of job dicts, keyed by job id"""
+
+    def __init__(self, path=JOB_DB_PATH, retention=JOB_RETENTION):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                     'id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, '
+                     'data TEXT NOT NULL, updated_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_kind_status_idx ON jobs (kind, status)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, kind, **fields):
+        """
+        Create a job in 'queued' state.
+
+        Returns:
+            dict: the job, including its new 'id'
+        """
+        job = dict(fields, id=uuid.uuid4().hex, kind=kind, status='queued', created_at=time.time())
+        self.save(job)
+        return job
+
+    def save(self, job):
+        job['updated_at'] = time.time()
+        self._conn().execute('INSERT OR REPLACE INTO jobs (id, kind, status, data, updated_at) VALUES (?, ?, ?, ?, ?)',
+                             (job['id'], job['kind'], job['status'], json.dumps(job, default=str), job['updated_at']))
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.prune()
+
+    def update(self, job, **fields):
+        job.update(fields)
+        self.save(job)
+        return job
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, job_id, owner, states=('queued',), stale_after=None):
+        """
+        Atomically take a job over to run it: one in any of `states`, or a
+        'running' one its owner has not saved for `stale_after` seconds
+        (the worker running it died).
+
+        Returns:
+            dict: the job, now 'running' and owned by `owner`, or None if it is not claimable
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data, status, updated_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            now = time.time()
+            stale = bool(row) and row[1] == 'running' and stale_after is not None and now - row[2] > stale_after
+            if not row or (row[1] not in states and not stale):
+                conn.execute('ROLLBACK')
+                return None
+            job = dict(json.loads(row[0]), status='running', owner=owner, updated_at=now)
+            conn.execute('UPDATE jobs SET status = ?, data = ?, updated_at = ? WHERE id = ?',
+                         (job['status'], json.dumps(job, default=str), now, job_id))
+            conn.execute('COMMIT')
+            return job
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def find(self, kind, statuses):
+        """Jobs of a kind in any of the given states (e.g. to resume after a restart)"""
+        placeholders = ','.join('?' * len(statuses))
+        rows = self._conn().execute(f'SELECT data FROM jobs WHERE kind = ? AND status IN ({placeholders})',
+                                    (kind, *statuses)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def prune(self):
+        placeholders = ','.join('?' * len(FINISHED_STATES))
+        self._conn().execute(f'DELETE FROM jobs WHERE updated_at < ? AND status IN ({placeholders})',
+                             (time.time() - self.retention, *FINISHED_STATES))
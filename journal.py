@@ -0,0 +1,525 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+from collections import deque
+from log import get_logger
+
+# ============================================
+# WEBHOOK WRITE-AHEAD JOURNAL
+# ============================================
+# Every accepted message event is appended to a local journal and fsynced
+# before the webhook answers EVENT_RECEIVED, so a crash or a Supabase
+# outage can't lose a message Facebook will never redeliver:
+#   - one append-only segment (JSON lines) per worker process, rotated at
+#     JOURNAL_SEGMENT_BYTES; the owner holds a flock on its segments
+#   - group commit: concurrent webhook requests share one fsync (the sync
+#     thread waits JOURNAL_FSYNC_INTERVAL_MS to collect appends)
+#   - a failed fsync is not trusted or retried on the same file (the kernel
+#     may have dropped the dirty pages): the segment's events are rewritten
+#     from memory into a new segment and that one is fsynced. If that fails
+#     too, wait() raises JournalSyncError and the webhook answers 503 so
+#     Facebook redelivers (as it does when an append fails or wait() times
+#     out); discard() drops the events of such a request
+#   - an event is acked once the write batcher has stored its message row;
+#     a segment is deleted when it is rotated and all its events are acked
+#   - the replayer re-applies, every JOURNAL_REPLAY_INTERVAL seconds,
+#       1. events whose handling or message write failed (Supabase down)
+#       2. segments left behind by dead processes (their flock is free)
+#     in batches of JOURNAL_REPLAY_BATCH. The message id is the idempotency
+#     key: ids Supabase already has are skipped, so each event is applied
+#     once. Replayed events bypass the dedup store.
+#
+# Events without a message id (delivery / read receipts) are not journaled.
+#
+# Settings (env):
+#   JOURNAL_DIR                directory for segments (default journal, empty = off)
+#   JOURNAL_SEGMENT_BYTES      segment size that triggers rotation (default 16 MB)
+#   JOURNAL_FSYNC_INTERVAL_MS  max wait to batch appends into one fsync (default 2)
+#   JOURNAL_REPLAY_INTERVAL    seconds between replay passes (default 10)
+#   JOURNAL_REPLAY_BATCH       events per existence check / replay batch (default 500)
+# ============================================
+
+log = get_logger('journal')
+
+JOURNAL_DIR = os.getenv('JOURNAL_DIR', 'journal')
+JOURNAL_SEGMENT_BYTES = int(os.getenv('JOURNAL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+JOURNAL_FSYNC_INTERVAL_MS = float(os.getenv('JOURNAL_FSYNC_INTERVAL_MS', '2'))
+JOURNAL_REPLAY_INTERVAL = float(os.getenv('JOURNAL_REPLAY_INTERVAL', '10'))
+JOURNAL_REPLAY_BATCH = int(os.getenv('JOURNAL_REPLAY_BATCH', '500'))
+
+# Longest a webhook request waits for its fsync before answering 503
+SYNC_TIMEOUT = 5.0
+# Longest wait before replaying an event that keeps failing (backoff doubles per attempt)
+MAX_REPLAY_BACKOFF = 300.0
+
+SEGMENT_SUFFIX = '.wal'
+
+# Failed fsync ranges remembered for wait() (appends are waited on right away)
+FAILED_SYNCS_KEPT = 64
+
+
+class JournalSyncError(OSError):
+    """The journal could not make an append durable"""
+
+
+def event_mid(event):
+    return (event.get('message') or {}).get('mid')
+
+
+class _Segment:
+    """An open segment file and the events in it that are not acked yet"""
+
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.pending = set()
+        self.closed = False
+
+
+class EventJournal:
+    """
+    Durable journal of webhook message events with a background replayer.
+
+    Args:
+        replay: fn(entry) that processes a rebuilt webhook entry (e.g. ingest_pool.submit)
+        stored_ids: fn(message_ids) -> set of the ids already stored in Supabase
+    """
+
+    def __init__(self, replay, stored_ids, path=JOURNAL_DIR, segment_bytes=JOURNAL_SEGMENT_BYTES,
+                 fsync_interval_ms=JOURNAL_FSYNC_INTERVAL_MS, replay_interval=JOURNAL_REPLAY_INTERVAL,
+                 replay_batch=JOURNAL_REPLAY_BATCH):
+        self.replay = replay
+        self.stored_ids = stored_ids
+        self.path = path
+        self.segment_bytes = max(4096, segment_bytes)
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.replay_interval = replay_interval
+        self.replay_batch = max(1, replay_batch)
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._pid = None
+
+        # Stats
+        self.appended = 0
+        self.fsyncs = 0
+        self.acked = 0
+        self.replayed = 0
+        self.replay_skipped = 0
+        self.segments_adopted = 0
+        self.segments_deleted = 0
+        self.append_errors = 0
+        self.sync_errors = 0
+        self.segments_rewritten = 0
+        self.max_sync_ms = 0.0
+
+        if self.path:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+            except OSError as e:
+                log.warning('Journal unavailable, webhook events are not journaled', path=self.path, error=str(e))
+                self.path = ''
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self):
+        """Start the sync and replay threads (replays orphaned segments without waiting for traffic)"""
+        if self.enabled:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._active = None
+            self._segments = []       # segments with events not acked yet (incl. active)
+            self._events = {}         # mid -> {'segment', 'page_id', 'event', 'failed'}
+            self._written = 0
+            self._synced = 0
+            self._resolved = 0        # appends whose fsync succeeded or failed
+            self._failed_syncs = deque(maxlen=FAILED_SYNCS_KEPT)   # (after, through) sequence ranges
+            self._stopping = False
+            threading.Thread(target=self._sync_loop, name='journal-sync', daemon=True).start()
+            threading.Thread(target=self._replay_loop, name='journal-replay', daemon=True).start()
+            atexit.register(self.shutdown)
+
+    # ---------- append + group commit ----------
+
+    def _open_segment(self):
+        path = os.path.join(self.path, f'{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        segment = _Segment(path, fd)
+        self._segments.append(segment)
+        return segment
+
+    def append(self, entry):
+        """
+        Journal the message events of a webhook entry (not durable until wait()).
+
+        Returns:
+            int: sequence number to pass to wait()
+
+        Raises:
+            JournalSyncError: the events could not be written
+        """
+        if not self.enabled:
+            return 0
+        self._ensure_started()
+        page_id = entry.get('id')
+        events = [e for e in entry.get('messaging', []) if event_mid(e)]
+        if not events:
+            return 0
+        data = ''.join(json.dumps({'t': time.time(), 'page_id': page_id, 'event': e}, separators=(',', ':')) + '\n'
+                       for e in events).encode()
+        try:
+            with self._cond:
+                segment = self._active
+                if segment is None or segment.size >= self.segment_bytes:
+                    segment = self._rotate()
+                os.write(segment.fd, data)
+                segment.size += len(data)
+                for event in events:
+                    mid = event_mid(event)
+                    segment.pending.add(mid)
+                    self._events[mid] = {'segment': segment, 'page_id': page_id, 'event': event, 'failed': False}
+                self._written += 1
+                self.appended += len(events)
+                self._cond.notify_all()
+                return self._written
+        except OSError as e:
+            self.append_errors += 1
+            log.error('Journal append failed', error=str(e))
+            raise JournalSyncError(f'journal append failed: {e}') from e
+
+    def _rotate(self):
+        """Close the active segment (fsynced) and open a new one - caller holds _cond"""
+        old = self._active
+        if old is not None:
+            with self._sync_lock:
+                os.fsync(old.fd)
+                self.fsyncs += 1
+            self._synced = self._resolved = self._written
+            old.closed = True
+            self._cond.notify_all()
+            self._maybe_delete(old)
+        self._active = self._open_segment()
+        return self._active
+
+    def wait(self, seq, timeout=SYNC_TIMEOUT):
+        """
+        Block until the append with this sequence number is fsynced.
+
+        Returns:
+            bool: False if it timed out (the append may still become durable)
+
+        Raises:
+            JournalSyncError: the append could not be made durable
+        """
+        if not seq:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if any(after < seq <= through for after, through in self._failed_syncs):
+                    raise JournalSyncError('journal fsync failed')
+                if self._synced >= seq:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning('Journal fsync wait timed out', seq=seq)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while self._resolved >= self._written and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+            if self.fsync_interval > 0:
+                # Let concurrent requests add their appends to this fsync
+                time.sleep(self.fsync_interval)
+            with self._cond:
+                target = self._written
+                segment = self._active
+            started = time.perf_counter()
+            synced = True
+            try:
+                with self._sync_lock:
+                    if segment is not None and not segment.closed:
+                        os.fsync(segment.fd)
+                        self.fsyncs += 1
+            except OSError as e:
+                self.sync_errors += 1
+                log.error('Journal fsync failed, rewriting segment', path=segment.path, error=str(e))
+                synced = self._rewrite(segment)
+            self.max_sync_ms = max(self.max_sync_ms, (time.perf_counter() - started) * 1000)
+            with self._cond:
+                if synced:
+                    self._synced = max(self._synced, target)
+                elif target > self._resolved:
+                    self._failed_syncs.append((self._resolved, target))
+                self._resolved = max(self._resolved, target)
+                self._cond.notify_all()
+
+    def _rewrite(self, segment):
+        """
+        Copy a segment's unacked events into a fresh, fsynced segment and drop
+        the old file (its fsync failed).
+
+        Returns:
+            bool: True if the events are durable in the new segment
+        """
+        with self._cond:
+            records = [(mid, r) for mid, r in self._events.items() if r['segment'] is segment]
+            try:
+                new = self._open_segment()
+            except OSError as e:
+                self.sync_errors += 1
+                log.error('Journal segment rewrite failed', error=str(e))
+                return False
+            try:
+                data = ''.join(json.dumps({'t': time.time(), 'page_id': r['page_id'], 'event': r['event']},
+                                          separators=(',', ':')) + '\n' for _, r in records).encode()
+                os.write(new.fd, data)
+                new.size += len(data)
+                with self._sync_lock:
+                    os.fsync(new.fd)
+                    self.fsyncs += 1
+            except OSError as e:
+                self.sync_errors += 1
+                log.error('Journal segment rewrite failed', path=new.path, error=str(e))
+                new.closed = True
+                self._maybe_delete(new)
+                return False
+
+            for mid, record in records:
+                record['segment'] = new
+                new.pending.add(mid)
+            segment.pending.clear()
+            if self._active is segment:
+                self._active = new
+            else:
+                new.closed = True
+            segment.closed = True
+            self._maybe_delete(segment)
+            self._maybe_delete(new)
+            self.segments_rewritten += 1
+            return True
+
+    # ---------- acks ----------
+
+    def ack(self, mids):
+        """Events whose message rows are stored - drop them from the journal"""
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._cond:
+            for mid in mids:
+                record = self._events.pop(mid, None)
+                if record:
+                    record['segment'].pending.discard(mid)
+                    self.acked += 1
+                    self._maybe_delete(record['segment'])
+
+    def discard(self, mids):
+        """Events of a webhook request that was not acknowledged - Facebook redelivers them"""
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._cond:
+            for mid in mids:
+                record = self._events.pop(mid, None)
+                if record:
+                    record['segment'].pending.discard(mid)
+                    self._maybe_delete(record['segment'])
+
+    def fail(self, mids):
+        """Events whose handling or message write failed - replayed on the next pass"""
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._cond:
+            for mid in mids:
+                record = self._events.get(mid)
+                if record:
+                    record['failed'] = True
+
+    def _maybe_delete(self, segment):
+        """Delete a closed segment once all its events are acked - caller holds _cond"""
+        if not segment.closed or segment.pending:
+            return
+        try:
+            os.unlink(segment.path)
+            self.segments_deleted += 1
+        except OSError as e:
+            log.warning('Could not delete journal segment', path=segment.path, error=str(e))
+        os.close(segment.fd)
+        if segment in self._segments:
+            self._segments.remove(segment)
+
+    # ---------- replay ----------
+
+    def _replay_loop(self):
+        while True:
+            time.sleep(self.replay_interval)
+            if self._stopping:
+                return
+            try:
+                self.replay_failed()
+                self.adopt_orphans()
+            except Exception as e:
+                log.warning('Journal replay pass failed', error=str(e))
+
+    def replay_failed(self):
+        """Re-apply this process's events whose handling or write failed"""
+        now = time.time()
+        with self._cond:
+            failed = [(mid, r) for mid, r in self._events.items()
+                      if r['failed'] and r.get('retry_at', 0) <= now]
+        for start in range(0, len(failed), self.replay_batch):
+            self._replay_batch(failed[start:start + self.replay_batch])
+
+    def adopt_orphans(self):
+        """Replay and remove segments whose owner process is gone"""
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            with self._cond:
+                if any(s.path == path for s in self._segments):
+                    continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Its owner is alive (or another worker is adopting it)
+                os.close(fd)
+                continue
+            if not os.path.exists(path):
+                # Deleted by the worker that adopted it before us
+                os.close(fd)
+                continue
+            segment = _Segment(path, fd)
+            with self._cond:
+                self._segments.append(segment)
+            try:
+                self._adopt(segment)
+            except Exception:
+                # Release it so the next pass (here or in another worker) tries again
+                with self._cond:
+                    self._segments.remove(segment)
+                os.close(fd)
+                raise
+
+    def _adopt(self, segment):
+        path = segment.path
+        self.segments_adopted += 1
+        log.info('Replaying orphaned journal segment', path=path, bytes=segment.size)
+
+        batch = []
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of a crashed segment
+                    continue
+                mid = event_mid(record.get('event') or {})
+                if not mid:
+                    continue
+                batch.append((mid, {'segment': segment, 'page_id': record.get('page_id'),
+                                    'event': record['event'], 'failed': False}))
+                if len(batch) >= self.replay_batch:
+                    self._replay_batch(batch)
+                    batch = []
+        if batch:
+            self._replay_batch(batch)
+        with self._cond:
+            segment.closed = True
+            self._maybe_delete(segment)
+
+    def _replay_batch(self, records):
+        """Skip events Supabase already has, re-submit the rest (grouped into entries by page)"""
+        stored = self.stored_ids([mid for mid, _ in records])
+        entries = {}
+        with self._cond:
+            for mid, record in records:
+                current = self._events.get(mid)
+                if current is not None and current is not record and not current['failed']:
+                    # Already re-submitted from an earlier pass and still in flight
+                    continue
+                if mid in stored:
+                    self._events.pop(mid, None)
+                    record['segment'].pending.discard(mid)
+                    self.replay_skipped += 1
+                    continue
+                # Back off on events that fail again (Supabase still down)
+                attempts = record.get('attempts', 0) + 1
+                record.update(failed=False, attempts=attempts,
+                              retry_at=time.time() + min(MAX_REPLAY_BACKOFF, self.replay_interval * 2 ** (attempts - 1)))
+                record['segment'].pending.add(mid)
+                self._events[mid] = record
+                entries.setdefault(record['page_id'], []).append(record['event'])
+            for mid, record in records:
+                self._maybe_delete(record['segment'])
+        for page_id, events in entries.items():
+            self.replay({'id': page_id, 'time': int(time.time() * 1000), 'messaging': events})
+            self.replayed += len(events)
+        if entries:
+            log.info('Replayed journaled events', events=sum(len(e) for e in entries.values()),
+                     skipped=len(stored))
+
+    # ---------- shutdown / stats ----------
+
+    def shutdown(self):
+        """Fsync and close; the active segment is deleted if everything in it is acked"""
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            if self._active is not None:
+                with self._sync_lock:
+                    os.fsync(self._active.fd)
+                self._active.closed = True
+                self._maybe_delete(self._active)
+                self._active = None
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with self._cond:
+            pending = len(self._events) if self._pid == os.getpid() else 0
+            failed = sum(1 for r in self._events.values() if r['failed']) if self._pid == os.getpid() else 0
+            segments = len(self._segments) if self._pid == os.getpid() else 0
+        return {
+            'enabled': True,
+            'pending_events': pending,
+            'failed_events': failed,
+            'open_segments': segments,
+            'appended': self.appended,
+            'acked': self.acked,
+            'fsyncs': self.fsyncs,
+            'appends_per_fsync': round(self._written / self.fsyncs, 1) if self._pid == os.getpid()
+            and self.fsyncs else 0,
+            'max_sync_ms': round(self.max_sync_ms, 2),
+            'replayed': self.replayed,
+            'replay_skipped': self.replay_skipped,
+            'segments_adopted': self.segments_adopted,
+            'segments_deleted': self.segments_deleted,
+            'append_errors': self.append_errors,
+            'sync_errors': self.sync_errors,
+            'segments_rewritten': self.segments_rewritten
+        }
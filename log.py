@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# ============================================
+# STRUCTURED LOGGING
+# ============================================
+# Log calls only put a record on a bounded queue; a listener thread
+# formats it (JSON by default, tracebacks included) and writes stdout.
+# A full queue drops the record instead of blocking the caller.
+#
+#   log = get_logger(__name__)
+#   log.info('Message queued', conversation_id=cid, sample=page_id)
+#   log.exception('Error handling message', error=str(e))
+#
+# Messages are fixed strings; variable data goes in keyword fields.
+# - sample=<key>: noisy success lines, only 1 in LOG_SAMPLE_EVERY is
+#   logged per key and message (e.g. per page)
+# - errors: at most LOG_ERROR_BURST of the same message per
+#   LOG_ERROR_WINDOW seconds; the next one logged carries `suppressed`
+#
+# Settings (env):
+#   LOG_LEVEL          DEBUG / INFO / WARNING / ERROR (default INFO)
+#   LOG_FORMAT         json or text (default json)
+#   LOG_QUEUE_SIZE     records buffered for the writer thread (default 10000)
+#   LOG_SAMPLE_EVERY   keep 1 in N sampled lines per key (default 10, 1 = all)
+#   LOG_ERROR_BURST    same error logged at most this often ... (default 10)
+#   LOG_ERROR_WINDOW   ... per this many seconds (default 60)
+# ============================================
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_EVERY = max(1, int(os.getenv('LOG_SAMPLE_EVERY', '10')))
+LOG_ERROR_BURST = int(os.getenv('LOG_ERROR_BURST', '10'))
+LOG_ERROR_WINDOW = float(os.getenv('LOG_ERROR_WINDOW', '60'))
+
+ROOT_LOGGER = 'chathub'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        line = f'{record.levelname:<7} {record.name}: {record.getMessage()}'
+        if fields:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Never blocks the caller; formatting (and tracebacks) happen on the listener thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Keep exc_info - the listener formats the traceback, not the caller
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked - the parent's queue lock may be held by its (absent) listener
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(TextFormatter() if LOG_FORMAT == 'text' else JsonFormatter())
+            self._listener = QueueListener(self.queue, stream)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+
+_handler = _NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+_root = logging.getLogger(ROOT_LOGGER)
+_root.addHandler(_handler)
+_root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+_root.propagate = False
+
+
+class _Limits:
+    """Sampling counters and error rate limits shared by all loggers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}   # (logger, msg, key) -> count
+        self.errors = {}    # (logger, msg) -> [window start, logged, suppressed]
+        self.sampled_out = 0
+        self.suppressed = 0
+
+    def keep_sample(self, key):
+        with self.lock:
+            count = self.samples.get(key, 0)
+            if len(self.samples) > 10000:
+                self.samples.clear()
+            self.samples[key] = count + 1
+            if count % LOG_SAMPLE_EVERY == 0:
+                return True
+            self.sampled_out += 1
+            return False
+
+    def allow_error(self, key):
+        """
+        Returns:
+            int or None: count of suppressed repeats to report, None to drop this one
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.errors.get(key)
+            if state is None or now - state[0] >= LOG_ERROR_WINDOW:
+                suppressed = state[2] if state else 0
+                self.errors[key] = [now, 1, 0]
+                return suppressed
+            if state[1] < LOG_ERROR_BURST:
+                state[1] += 1
+                suppressed, state[2] = state[2], 0
+                return suppressed
+            state[2] += 1
+            self.suppressed += 1
+            return None
+
+
+_limits = _Limits()
+
+
+class StructuredLogger:
+    """logging.Logger wrapper taking keyword fields, sampling and error rate limits"""
+
+    def __init__(self, name):
+        self.name = name
+        self._logger = logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+    def _log(self, level, msg, exc_info=False, sample=None, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        if sample is not None and LOG_SAMPLE_EVERY > 1:
+            if not _limits.keep_sample((self.name, msg, sample)):
+                return
+            fields['sampled_1_in'] = LOG_SAMPLE_EVERY
+        if level >= logging.ERROR and LOG_ERROR_BURST > 0:
+            suppressed = _limits.allow_error((self.name, msg))
+            if suppressed is None:
+                return
+            if suppressed:
+                fields['suppressed'] = suppressed
+        self._logger.log(level, msg, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, msg, **fields):
+        self._log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg, **fields):
+        self._log(logging.INFO, msg, **fields)
+
+    def warning(self, msg, **fields):
+        self._log(logging.WARNING, msg, **fields)
+
+    def error(self, msg, **fields):
+        self._log(logging.ERROR, msg, **fields)
+
+    def exception(self, msg, **fields):
+        """Error with the current exception's traceback"""
+        self._log(logging.ERROR, msg, exc_info=True, **fields)
+
+
+def get_logger(name):
+    return StructuredLogger(name)
+
+
+def stats():
+    return {
+        'queue_depth': _handler.queue.qsize(),
+        'dropped': _handler.dropped,
+        'sampled_out': _limits.sampled_out,
+        'suppressed_errors': _limits.suppressed,
+        'sample_every': LOG_SAMPLE_EVERY
+    }
@@ -0,0 +1,292 @@
+import os
+import time
+import queue
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import atexit
+from urllib.parse import urlsplit
+import requests
+from log import get_logger
+
+try:
+    from PIL import Image
+except ImportError:  # in requirements.txt - without it attachments are mirrored with no thumbnails
+    Image = None
+
+# ============================================
+# INBOUND MEDIA MIRROR
+# ============================================
+# Facebook CDN URLs for customer attachments expire and are slow to load
+# from the dashboard. After a message is ingested its attachment is
+# queued here; a small pool of downloader threads fetches it, stores it
+# once under its sha256 in MEDIA_DIR and (with Pillow) writes a
+# downscaled JPEG thumbnail for images. Files are served by /api/media/<hash>.
+#
+# The queue is bounded and never blocks the caller - when it is full the
+# attachment is skipped and the message keeps its CDN URL. Only https URLs
+# on the Facebook CDN hosts are fetched (redirects are not followed), so a
+# forged webhook payload cannot make the server request internal URLs.
+#
+# Settings (env):
+#   MEDIA_DIR            content-addressed store (default media)
+#   MEDIA_DB_PATH        SQLite index shared by workers (default media.sqlite3)
+#   MEDIA_WORKERS        downloader threads (default 2)
+#   MEDIA_QUEUE_SIZE     queued downloads (default 1000)
+#   MEDIA_MAX_BYTES      largest attachment mirrored (default 25 MB)
+#   MEDIA_THUMB_SIZE     thumbnail bounding box in px (default 320)
+#   MEDIA_ALLOWED_HOSTS  domains attachments are fetched from, subdomains
+#                        included (default fbcdn.net,fbsbx.com)
+# ============================================
+
+log = get_logger('media')
+
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MEDIA_DB_PATH = os.getenv('MEDIA_DB_PATH', 'media.sqlite3')
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '2'))
+MEDIA_QUEUE_SIZE = int(os.getenv('MEDIA_QUEUE_SIZE', '1000'))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(25 * 1024 * 1024)))
+MEDIA_THUMB_SIZE = int(os.getenv('MEDIA_THUMB_SIZE', '320'))
+MEDIA_ALLOWED_HOSTS = [h.strip().lower().lstrip('.')
+                       for h in os.getenv('MEDIA_ALLOWED_HOSTS', 'fbcdn.net,fbsbx.com').split(',') if h.strip()]
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def allowed_media_url(url, hosts=MEDIA_ALLOWED_HOSTS):
+    """True for an https URL on one of `hosts` (or a subdomain of one)"""
+    try:
+        parts = urlsplit(url or '')
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return False
+    if parts.scheme != 'https' or port not in (None, 443) or parts.username or parts.password:
+        return False
+    return any(host == allowed or host.endswith('.' + allowed) for allowed in hosts)
+
+
+class MediaStore:
+    """Content-addressed files on disk plus a SQLite index of their metadata"""
+
+    def __init__(self, root=MEDIA_DIR, db_path=MEDIA_DB_PATH, thumb_size=MEDIA_THUMB_SIZE):
+        self.root = root
+        self.db_path = db_path
+        self.thumb_size = thumb_size
+        self._local = threading.local()
+        os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+        if Image is None:
+            log.warning('Pillow not installed, mirrored images get no thumbnails')
+        self._conn().execute('CREATE TABLE IF NOT EXISTS media ('
+                             'sha256 TEXT PRIMARY KEY, content_type TEXT, size INTEGER NOT NULL, '
+                             'thumbnail INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def path(self, sha256, thumbnail=False):
+        name = f'{sha256}.thumb.jpg' if thumbnail else sha256
+        return os.path.join(self.root, sha256[:2], name)
+
+    def get(self, sha256):
+        """
+        Returns:
+            dict: {sha256, content_type, size, thumbnail} or None
+        """
+        row = self._conn().execute('SELECT content_type, size, thumbnail FROM media WHERE sha256 = ?',
+                                   (sha256,)).fetchone()
+        if not row:
+            return None
+        return {'sha256': sha256, 'content_type': row[0], 'size': row[1], 'thumbnail': bool(row[2])}
+
+    def put(self, chunks, content_type=None, max_bytes=MEDIA_MAX_BYTES):
+        """
+        Store a file from an iterable of byte chunks.
+
+        Returns:
+            tuple: (info dict, bool created) - created is False when the content was already stored
+
+        Raises:
+            MediaTooLarge: more than max_bytes
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise MediaTooLarge(f'attachment larger than {max_bytes} bytes')
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            sha256 = digest.hexdigest()
+            existing = self.get(sha256)
+            if existing:
+                return existing, False
+
+            final_path = self.path(sha256)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+            tmp_path = None
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        thumbnail = self._thumbnail(sha256) if (content_type or '').startswith('image/') else False
+        self._conn().execute('INSERT OR IGNORE INTO media (sha256, content_type, size, thumbnail, created_at) '
+                             'VALUES (?, ?, ?, ?, ?)', (sha256, content_type, size, int(thumbnail), time.time()))
+        return self.get(sha256), True
+
+    def _thumbnail(self, sha256):
+        if Image is None:
+            return False
+        try:
+            with Image.open(self.path(sha256)) as img:
+                img.thumbnail((self.thumb_size, self.thumb_size))
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                tmp_path = self.path(sha256, thumbnail=True) + '.tmp'
+                img.save(tmp_path, 'JPEG', quality=80, optimize=True)
+            os.replace(tmp_path, self.path(sha256, thumbnail=True))
+            return True
+        except Exception as e:
+            log.warning('Thumbnail failed', sha256=sha256, error=str(e))
+            return False
+
+
+class MediaMirror:
+    """
+    Bounded background downloader into a MediaStore.
+
+    Args:
+        store: MediaStore
+        on_stored: fn(message_id, info) called after a successful download
+    """
+
+    def __init__(self, store, on_stored, workers=MEDIA_WORKERS, max_size=MEDIA_QUEUE_SIZE):
+        self.store = store
+        self.on_stored = on_stored
+        self.workers = max(1, workers)
+        self._queue = queue.Queue(maxsize=max_size)
+        self._session = requests.Session()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+        # Stats
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed = 0
+        self.bytes_downloaded = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'media-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            atexit.register(self.shutdown)
+            log.info('Media mirror started', workers=self.workers)
+
+    def submit(self, message_id, url):
+        """
+        Queue an attachment download; never blocks.
+
+        Returns:
+            bool: False if the URL is not on an allowed CDN host or the queue
+            was full, and the attachment was skipped
+        """
+        if not allowed_media_url(url):
+            self.rejected += 1
+            log.warning('Attachment URL not on an allowed host, not mirrored', message_id=message_id)
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((message_id, url))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self._mirror(*item)
+            except Exception as e:
+                self.failed += 1
+                log.exception('Media mirror error', message_id=item[0], error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def _mirror(self, message_id, url):
+        try:
+            with self._session.get(url, stream=True, timeout=(5, 60), allow_redirects=False) as response:
+                response.raise_for_status()
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(f'unexpected status {response.status_code}',
+                                                        response=response)
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip() or None
+                info, created = self.store.put(response.iter_content(CHUNK_SIZE), content_type)
+        except (requests.exceptions.RequestException, MediaTooLarge) as e:
+            self.failed += 1
+            log.warning('Could not mirror attachment', message_id=message_id, error=str(e))
+            return
+
+        if created:
+            self.downloaded += 1
+            self.bytes_downloaded += info['size']
+        else:
+            self.deduplicated += 1
+        self.on_stored(message_id, info)
+
+    def shutdown(self, timeout=5):
+        """Stop the downloaders; whatever is still queued keeps its CDN URL"""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self._queue.qsize(),
+            'downloaded': self.downloaded,
+            'deduplicated': self.deduplicated,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'bytes_downloaded': self.bytes_downloaded,
+            'thumbnails': Image is not None
+        }
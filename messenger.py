@@ -0,0 +1,220 @@
+import io
+import json
+import uuid
+from graph_client import graph, async_graph
+from metrics import SEND_TOTAL
+
+# ============================================
+# SEND API HELPERS
+# ============================================
+# Builds Messenger Send API requests (me/messages) and posts them through
+# the shared Graph client. Used by the sync endpoints and the send queue;
+# the *_async variants go through async_graph for the ASGI entry point.
+# ============================================
+
+
+def _count(kind, page_id, status_code):
+    SEND_TOTAL.inc(kind=kind, page=page_id, outcome='sent' if status_code == 200 else 'failed')
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body that reads the file part in chunks as
+    requests sends it, instead of building the whole body in memory the way
+    `files=` does. It has a length (so requests sends Content-Length rather
+    than chunked encoding) and rewinds with seek(0) for a retried POST.
+    """
+
+    def __init__(self, fields, name, filename, file_obj, content_type):
+        boundary = uuid.uuid4().hex
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+                       for key, value in fields.items())
+        filename = (filename or 'upload').replace('"', '%22').replace('\r', '').replace('\n', '')
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n')
+        if isinstance(file_obj, (bytes, bytearray)):
+            file_obj = io.BytesIO(file_obj)
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._parts = [head.encode(), file_obj, f'\r\n--{boundary}--\r\n'.encode()]
+        self._file_start = file_obj.tell()
+        file_size = file_obj.seek(0, io.SEEK_END) - self._file_start
+        file_obj.seek(self._file_start)
+        self.len = len(self._parts[0]) + file_size + len(self._parts[2])
+        self.seek(0)
+
+    def __len__(self):
+        return self.len
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('MultipartBody can only be rewound to the start')
+        self._part = 0
+        self._offset = 0
+        self._position = 0
+        self._parts[1].seek(self._file_start)
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        chunks = []
+        while size > 0 and self._part < len(self._parts):
+            part = self._parts[self._part]
+            if self._part == 1:
+                chunk = part.read(size)
+            else:
+                chunk = part[self._offset:self._offset + size]
+                self._offset += len(chunk)
+            if not chunk:
+                self._part += 1
+                self._offset = 0
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        self._position += len(data)
+        return data
+
+
+def _post_multipart(path, access_token, page_id, fields, filename, file_obj, content_type, timeout):
+    body = MultipartBody(fields, 'filedata', filename, file_obj, content_type or 'image/jpeg')
+    return graph.post(path, access_token=access_token, page_id=page_id, data=body,
+                      headers={'Content-Type': body.content_type}, timeout=timeout)
+
+
+def _messaging_type(payload, use_human_agent_tag):
+    if use_human_agent_tag:
+        payload['messaging_type'] = 'MESSAGE_TAG'
+        payload['tag'] = 'HUMAN_AGENT'
+    else:
+        payload['messaging_type'] = 'RESPONSE'
+    return payload
+
+
+def send_text(page_id, access_token, recipient_id, message_text, use_human_agent_tag=False):
+    """
+    Send a text message.
+
+    Returns:
+        tuple: (HTTP status code, response JSON)
+    """
+    response = graph.post('me/messages', access_token=access_token, page_id=page_id,
+                          headers={'Content-Type': 'application/json'},
+                          json=_text_payload(recipient_id, message_text, use_human_agent_tag), timeout=10)
+    _count('text', page_id, response.status_code)
+    return response.status_code, response.json()
+
+
+async def send_text_async(page_id, access_token, recipient_id, message_text, use_human_agent_tag=False):
+    """
+    send_text on the event loop.
+
+    Returns:
+        tuple: (HTTP status code, response JSON)
+    """
+    response = await async_graph.post('me/messages', access_token=access_token, page_id=page_id,
+                                      headers={'Content-Type': 'application/json'},
+                                      json=_text_payload(recipient_id, message_text, use_human_agent_tag),
+                                      timeout=10)
+    _count('text', page_id, response.status_code)
+    return response.status_code, response.json()
+
+
+def _text_payload(recipient_id, message_text, use_human_agent_tag):
+    # Build payload with optional HUMAN_AGENT tag
+    return _messaging_type({
+        'recipient': {'id': recipient_id},
+        'message': {'text': message_text}
+    }, use_human_agent_tag)
+
+
+def send_image(page_id, access_token, recipient_id, filename, image_bytes, content_type,
+               use_human_agent_tag=False):
+    """
+    Upload and send an image as multipart/form-data.
+
+    Args:
+        image_bytes: bytes or a seekable file object (read in chunks while sending)
+
+    Returns:
+        tuple: (HTTP status code, response JSON)
+    """
+    # Build message payload as JSON strings for multipart/form-data
+    message_data = {
+        'attachment': {
+            'type': 'image',
+            'payload': {
+                'is_reusable': True
+            }
+        }
+    }
+    payload = _messaging_type({
+        'recipient': json.dumps({'id': recipient_id}),
+        'message': json.dumps(message_data)
+    }, use_human_agent_tag)
+
+    response = _post_multipart('me/messages', access_token, page_id, payload, filename, image_bytes,
+                               content_type, timeout=30)
+    _count('image', page_id, response.status_code)
+    return response.status_code, response.json()
+
+
+def upload_attachment(page_id, access_token, filename, file_obj, content_type, attachment_type='image'):
+    """
+    Upload a reusable attachment once (me/message_attachments).
+
+    Args:
+        file_obj: bytes or a seekable file object (read in chunks while sending)
+
+    Returns:
+        tuple: (HTTP status code, response JSON with 'attachment_id')
+    """
+    message_data = {
+        'attachment': {
+            'type': attachment_type,
+            'payload': {
+                'is_reusable': True
+            }
+        }
+    }
+    response = _post_multipart('me/message_attachments', access_token, page_id,
+                               {'message': json.dumps(message_data)}, filename, file_obj, content_type,
+                               timeout=60)
+    _count('upload', page_id, response.status_code)
+    return response.status_code, response.json()
+
+
+def send_attachment(page_id, access_token, recipient_id, attachment_id, attachment_type='image',
+                    use_human_agent_tag=False):
+    """
+    Send a previously uploaded attachment by id - a small JSON POST, no upload.
+
+    Returns:
+        tuple: (HTTP status code, response JSON)
+    """
+    payload = _messaging_type({
+        'recipient': {'id': recipient_id},
+        'message': {
+            'attachment': {
+                'type': attachment_type,
+                'payload': {'attachment_id': attachment_id}
+            }
+        }
+    }, use_human_agent_tag)
+
+    response = graph.post('me/messages', access_token=access_token, page_id=page_id,
+                          headers={'Content-Type': 'application/json'}, json=payload, timeout=10)
+    _count('attachment', page_id, response.status_code)
+    return response.status_code, response.json()
+
+
+def error_details(response_data):
+    """
+    Returns:
+        tuple: (error message, error code) from a Graph error response
+    """
+    error = response_data.get('error', {}) if isinstance(response_data, dict) else {}
+    return error.get('message', 'Unknown Facebook error'), error.get('code', 'N/A')
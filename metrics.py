@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import threading
+import atexit
+from contextlib import contextmanager
+import httpx
+from log import get_logger
+
+# ============================================
+# METRICS (Prometheus text format)
+# ============================================
+# Counters and latency histograms kept in memory per worker; recording is
+# a dict update under a lock. Each gunicorn worker writes a snapshot to
+# METRICS_DIR every few seconds, and /metrics merges the snapshots of all
+# workers (counters and histogram buckets are summed). Snapshots of
+# workers that have exited are folded into an archive file so totals
+# never go backwards.
+#
+# Settings (env):
+#   METRICS_DIR              per-worker snapshot directory (default metrics, empty = this worker only)
+#   METRICS_FLUSH_INTERVAL   seconds between snapshots (default 5)
+# ============================================
+
+log = get_logger('metrics')
+
+METRICS_DIR = os.getenv('METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Seconds - from a cache hit (~1ms) to a slow Graph call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ARCHIVE_FILE = 'archived.json'
+
+
+class _Metric:
+    def __init__(self, registry, name, help_text, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.registry._ensure_started()
+        with self.registry.lock:
+            values = self.registry.values[self.name]
+            values[key] = values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        self.registry._ensure_started()
+        with self.registry.lock:
+            values = self.registry.values[self.name]
+            entry = values.get(key)
+            if entry is None:
+                # [per-bucket counts..., +Inf count, sum]
+                entry = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.values = {}
+        self._thread = None
+        self._pid = None
+        self._started_at = time.time()
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help_text, labels, buckets))
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+            self.values.setdefault(metric.name, {})
+        self._ensure_started()
+        return metric
+
+    # ---------- per-worker snapshots ----------
+
+    def _ensure_started(self):
+        """
+        Start this process's flush thread. Called on every record too: with
+        gunicorn --preload the metrics are registered in the master, and each
+        forked worker starts its own thread on its first update.
+        """
+        if self._pid == os.getpid() and self._thread:
+            return
+        if not self.directory or self.flush_interval <= 0:
+            return
+        with self.lock:
+            if self._pid == os.getpid() and self._thread:
+                return
+            if self._pid != os.getpid():
+                # Forked - values so far belong to the parent
+                for values in self.values.values():
+                    values.clear()
+                self._started_at = time.time()
+            self._pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.write_snapshot)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                log.warning('Could not write metrics snapshot', error=str(e))
+
+    def _snapshot_path(self):
+        # Start time in the name: a reused pid never overwrites a dead worker's totals
+        return os.path.join(self.directory, f'{os.getpid()}_{int(self._started_at * 1000)}.json')
+
+    def snapshot(self):
+        """This worker's values: {name: {label values: value}}"""
+        with self.lock:
+            return _merge({}, self.values)
+
+    def write_snapshot(self):
+        if not self.directory:
+            return
+        _write_json(self._snapshot_path(), self.snapshot())
+
+    def _collect(self):
+        """Merged values of all workers (live + archived)"""
+        if not self.directory:
+            return self.snapshot()
+        self._ensure_started()
+        self.write_snapshot()
+
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+                archive = _read_json(archive_path)
+                merged = _merge({}, archive)
+                archived_any = False
+                for name in os.listdir(self.directory):
+                    if not name.endswith('.json') or name == ARCHIVE_FILE:
+                        continue
+                    path = os.path.join(self.directory, name)
+                    data = _read_json(path)
+                    merged = _merge(merged, data)
+                    if not _pid_alive(int(name.split('_', 1)[0])):
+                        # Exited worker - fold its totals into the archive
+                        archive = _merge(archive, data)
+                        archived_any = True
+                        os.remove(path)
+                if archived_any:
+                    _write_json(archive_path, archive)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return merged
+
+    # ---------- exposition ----------
+
+    def render(self):
+        """All metrics, merged across workers, in the Prometheus text format"""
+        merged = self._collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in sorted(merged.get(name, {}).items()):
+                labels = list(zip(metric.labels, key))
+                if metric.type == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _write_json(path, data):
+    # Per-thread temp name: the flush thread and a /metrics scrape can write at once
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({name: [[list(key), value] for key, value in entries.items()] for name, entries in data.items()}, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return {name: {tuple(key): value for key, value in entries} for name, entries in data.items()}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def _merge(into, data):
+    for name, entries in data.items():
+        target = into.setdefault(name, {})
+        for key, value in entries.items():
+            key = tuple(key)
+            current = target.get(key)
+            if current is None:
+                target[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                target[key] = [a + b for a, b in zip(current, value)]
+            else:
+                target[key] = current + value
+    return into
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+# ---------- application metrics ----------
+
+HANDLE_MESSAGE_STAGE_SECONDS = registry.histogram(
+    'chathub_handle_message_stage_seconds', 'Time spent in each stage of handle_message()', ('stage',))
+HANDLE_MESSAGE_TOTAL = registry.counter(
+    'chathub_handle_message_total', 'Webhook messages handled, by outcome', ('outcome',))
+GRAPH_REQUEST_SECONDS = registry.histogram(
+    'chathub_graph_request_seconds', 'Graph API call latency per attempt', ('endpoint', 'page'))
+GRAPH_REQUESTS_TOTAL = registry.counter(
+    'chathub_graph_requests_total', 'Graph API call attempts, by HTTP status', ('endpoint', 'page', 'status'))
+SUPABASE_REQUEST_SECONDS = registry.histogram(
+    'chathub_supabase_request_seconds', 'Supabase (PostgREST) request latency', ('table', 'operation'))
+SUPABASE_REQUESTS_TOTAL = registry.counter(
+    'chathub_supabase_requests_total', 'Supabase (PostgREST) requests, by HTTP status',
+    ('table', 'operation', 'status'))
+SEND_TOTAL = registry.counter(
+    'chathub_send_total', 'Outbound Send API calls, by outcome', ('kind', 'page', 'outcome'))
+
+
+def graph_endpoint(path):
+    """Graph path with ids collapsed, e.g. 'm_AbC123' -> ':id' (keeps label cardinality low)"""
+    parts = []
+    for part in path.strip('/').split('/'):
+        if part.startswith('m_') or len(part) > 40 or any(c.isdigit() for c in part):
+            part = ':id'
+        parts.append(part)
+    return '/'.join(parts) or '/'
+
+
+def _supabase_operation(request):
+    path = request.url.path
+    table = path.split('/rest/v1/', 1)[-1].strip('/') or '/'
+    if table.startswith('rpc/'):
+        return table, 'rpc'
+    method = request.method.upper()
+    if method == 'POST':
+        return table, 'upsert' if 'resolution=' in request.headers.get('Prefer', '') else 'insert'
+    return table, {'GET': 'select', 'HEAD': 'count', 'PATCH': 'update', 'DELETE': 'delete'}.get(method, method.lower())
+
+
+def instrument_supabase(client):
+    """
+    Time every PostgREST request made by a supabase client through httpx event hooks.
+    Latency is measured to the response headers. Works for the sync client
+    and the async one (whose httpx.AsyncClient needs coroutine hooks).
+    """
+    session = client.postgrest.session
+
+    def on_request(request):
+        request.extensions['metrics_started'] = time.perf_counter()
+
+    def on_response(response):
+        started = response.request.extensions.get('metrics_started')
+        if started is None:
+            return
+        table, operation = _supabase_operation(response.request)
+        SUPABASE_REQUEST_SECONDS.observe(time.perf_counter() - started, table=table, operation=operation)
+        SUPABASE_REQUESTS_TOTAL.inc(table=table, operation=operation, status=response.status_code)
+
+    if isinstance(session, httpx.AsyncClient):
+        sync_request, sync_response = on_request, on_response
+
+        async def on_request(request):
+            sync_request(request)
+
+        async def on_response(response):
+            sync_response(response)
+
+    hooks = session.event_hooks
+    session.event_hooks = {
+        'request': list(hooks.get('request', [])) + [on_request],
+        'response': list(hooks.get('response', [])) + [on_response]
+    }
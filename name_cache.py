@@ -0,0 +1,123 @@
+import os
+import json
+import time
+from cache import get_cache
+from log import get_logger
+
+# ============================================
+# SENDER NAME CACHE
+# ============================================
+# Customer names keyed by (page_id, psid) so returning customers don't
+# cost a Graph API round trip per message. Kept in the 'names' namespace
+# of the shared cache (cache.py): a name one worker fetched is reused by
+# every worker.
+#
+# Settings (env):
+#   NAME_CACHE_SIZE          max entries (default 50000)
+#   NAME_CACHE_TTL           seconds a real name stays fresh (default 7 days)
+#   NAME_CACHE_NEGATIVE_TTL  seconds an 'Unknown' result is cached (default 1 hour)
+#   NAME_CACHE_FILE          optional JSON file to persist the cache across restarts
+#                            (memory cache backend only - the sqlite backend persists itself)
+# ============================================
+
+log = get_logger('name_cache')
+
+NAME_CACHE_SIZE = int(os.getenv('NAME_CACHE_SIZE', '50000'))
+NAME_CACHE_TTL = int(os.getenv('NAME_CACHE_TTL', str(7 * 24 * 3600)))
+NAME_CACHE_NEGATIVE_TTL = int(os.getenv('NAME_CACHE_NEGATIVE_TTL', '3600'))
+NAME_CACHE_FILE = os.getenv('NAME_CACHE_FILE', '')
+
+UNKNOWN = 'Unknown'
+
+
+def is_real_name(name):
+    """True for names fetched from Facebook (not 'Unknown' or auto-generated display names)"""
+    return bool(name) and name != UNKNOWN and not name.startswith('Customer ') and not name.startswith('User #')
+
+
+class NameCache:
+    """
+    (page_id, psid) -> name with per-entry expiry.
+
+    'Unknown' results are cached with a shorter TTL (negative caching)
+    so a customer with a private profile isn't looked up on every message.
+    """
+
+    def __init__(self, max_size=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL,
+                 negative_ttl=NAME_CACHE_NEGATIVE_TTL, path=NAME_CACHE_FILE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self._cache = get_cache('names', max_size)
+
+    @staticmethod
+    def _key(page_id, psid):
+        return f'{page_id}:{psid}'
+
+    def get(self, page_id, psid):
+        """
+        Look up a cached name.
+
+        Returns:
+            str or None: cached name ('Unknown' for a negative entry), or None on miss/expiry
+        """
+        return self._cache.get(self._key(page_id, psid))
+
+    def set(self, page_id, psid, name, ttl=None):
+        """Store a name; anything that isn't a real name is stored as a negative entry"""
+        if not is_real_name(name):
+            name = UNKNOWN
+        if ttl is None:
+            ttl = self.ttl if name != UNKNOWN else self.negative_ttl
+        self._cache.set(self._key(page_id, psid), name, ttl)
+
+    def warm(self, rows):
+        """
+        Pre-load real names from conversation rows (one cache write).
+
+        Args:
+            rows: iterable of dicts with page_id, customer_psid, customer_name
+
+        Returns:
+            int: number of names loaded
+        """
+        names = [(self._key(row.get('page_id'), row['customer_psid']), row['customer_name']) for row in rows
+                 if is_real_name(row.get('customer_name')) and row.get('customer_psid')]
+        self._cache.set_many(names, self.ttl)
+        return len(names)
+
+    def load(self):
+        """Load persisted entries from NAME_CACHE_FILE (expired entries are skipped)"""
+        if self._cache.shared or not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            now = time.time()
+            loaded = 0
+            for page_id, psid, name, expires_at in data:
+                if expires_at > now:
+                    self._cache.set(self._key(page_id, psid), name, expires_at - now)
+                    loaded += 1
+            log.info('Name cache loaded', entries=loaded, path=self.path)
+            return loaded
+        except Exception as e:
+            log.warning('Could not load name cache file', path=self.path, error=str(e))
+            return 0
+
+    def save(self):
+        """Persist the cache to NAME_CACHE_FILE (atomic replace)"""
+        if self._cache.shared or not self.path:
+            return
+        try:
+            data = [key.split(':', 1) + [name, expires_at] for key, name, expires_at in self._cache.items()]
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.warning('Could not save name cache file', path=self.path, error=str(e))
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,369 @@
+import os
+import time
+import queue
+import random
+import zlib
+import atexit
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from graph_client import (THROTTLE_ERROR_CODES, TRANSIENT_ERROR_CODES, GraphThrottled, GraphCircuitOpen,
+                          GraphNotConnected)
+from fair import FairQueue, merge_stats
+from log import get_logger
+
+# ============================================
+# OUTBOUND SEND QUEUE
+# ============================================
+# Opt-in async mode for /api/send and /api/send-image: the endpoint
+# validates, enqueues and returns a job id; a pool of sender threads
+# delivers the message.
+#   - per-page token bucket keeps us under the Send API rate limits
+#   - messages to the same recipient always go through the same sender
+#     thread, so they are delivered in order
+#   - each sender serves its queue per page, weighted fair: a page that is
+#     out of tokens or at SEND_PAGE_CONCURRENCY is skipped, not waited on,
+#     so a campaign on one page doesn't hold up the others
+#   - a send Facebook refused for rate limits (429, throttle codes) or that
+#     never reached it (connect error, refused locally) is retried with
+#     backoff. The Send API is not idempotent: after a read timeout or a
+#     5xx the message may already be delivered, so the job ends as
+#     'unknown' instead of being sent again
+#   - job status is kept in the shared JobStore for /api/send/<job_id>
+#   - the queue owns a job's payload: anything in it with a close() (a
+#     spooled upload) is closed once the job is finished, or right away if
+#     it could not be queued
+#
+# Settings (env):
+#   SEND_WORKERS          sender threads (default 4)
+#   SEND_QUEUE_SIZE       queued messages per sender thread (default 1000)
+#   SEND_RATE_PER_PAGE    sustained sends per second per page (default 10)
+#   SEND_BURST_PER_PAGE   burst size per page (default 20)
+#   SEND_MAX_ATTEMPTS     delivery attempts per message (default 5)
+#   SEND_BULK_CONCURRENCY concurrent bulk sends per page (default 8)
+#   SEND_PAGE_CONCURRENCY queued sends of one page in flight across senders
+#                         (default SEND_WORKERS - 1; 0 = no cap)
+# ============================================
+
+log = get_logger('outbound')
+
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '4'))
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', '1000'))
+SEND_RATE_PER_PAGE = float(os.getenv('SEND_RATE_PER_PAGE', '10'))
+SEND_BURST_PER_PAGE = float(os.getenv('SEND_BURST_PER_PAGE', '20'))
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', '5'))
+SEND_BULK_CONCURRENCY = int(os.getenv('SEND_BULK_CONCURRENCY', '8'))
+SEND_PAGE_CONCURRENCY = int(os.getenv('SEND_PAGE_CONCURRENCY', str(max(1, SEND_WORKERS - 1))))
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, up to `burst` saved"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available now (never blocks)"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Failures where Facebook never got the request - sending again can't duplicate the message
+NOT_SENT_ERRORS = (requests.exceptions.ConnectTimeout, GraphNotConnected, GraphThrottled, GraphCircuitOpen)
+
+
+def _error_code(response_data):
+    return response_data.get('error', {}).get('code') if isinstance(response_data, dict) else None
+
+
+def is_retryable(status_code, response_data):
+    """True for Send API rejections worth retrying (rate limits - the message was not accepted)"""
+    return status_code == 429 or _error_code(response_data) in THROTTLE_ERROR_CODES
+
+
+def is_ambiguous(status_code, response_data):
+    """True for failures after which the message may still have been delivered (server errors)"""
+    return status_code >= 500 or _error_code(response_data) in TRANSIENT_ERROR_CODES
+
+
+class SendQueue:
+    """
+    Sharded sender pool with per-page rate limits.
+
+    Args:
+        deliver: fn(job, payload) -> (status_code, response_data); may raise RequestException
+        on_done: fn(job, response_data) called after the final attempt (sent or failed)
+        store: JobStore for job status
+        weight: fn(page_id) -> the page's share per round
+    """
+
+    def __init__(self, deliver, on_done, store, workers=SEND_WORKERS, max_size=SEND_QUEUE_SIZE,
+                 rate=SEND_RATE_PER_PAGE, burst=SEND_BURST_PER_PAGE, max_attempts=SEND_MAX_ATTEMPTS,
+                 weight=None, page_concurrency=SEND_PAGE_CONCURRENCY):
+        self.deliver = deliver
+        self.on_done = on_done
+        self.store = store
+        self.workers = max(1, workers)
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max(1, max_attempts)
+        self.page_concurrency = page_concurrency
+        self._queues = [FairQueue('send', maxsize=max_size, weight=weight, claim=self._claim)
+                        for _ in range(self.workers)]
+        self._in_flight = {}           # page_id -> sends in progress across senders
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+        # Stats
+        self.sent = 0
+        self.failed = 0
+        self.unknown = 0
+        self.retries = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f'sender-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            atexit.register(self.shutdown)
+            log.info('Send queue started', workers=self.workers, rate_per_page=self.rate)
+
+    def bucket(self, page_id):
+        """The page's token bucket (shared by queued and bulk sends)"""
+        with self._lock:
+            bucket = self._buckets.get(page_id)
+            if bucket is None:
+                bucket = self._buckets[page_id] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def _claim(self, page_id):
+        """Called by a sender's fair queue: may this page send now?"""
+        with self._lock:
+            if self.page_concurrency and self._in_flight.get(page_id, 0) >= self.page_concurrency:
+                return False
+        if not self.bucket(page_id).try_acquire():
+            return False
+        with self._lock:
+            self._in_flight[page_id] = self._in_flight.get(page_id, 0) + 1
+        return True
+
+    def _release(self, page_id):
+        with self._lock:
+            count = self._in_flight.get(page_id, 0) - 1
+            if count > 0:
+                self._in_flight[page_id] = count
+            else:
+                self._in_flight.pop(page_id, None)
+        # A slot is free - senders that skipped this page can look again
+        for q in self._queues:
+            q.wake()
+
+    def submit(self, kind, page_id, recipient_id, payload, **fields):
+        """
+        Queue a message for delivery.
+
+        Args:
+            kind: job kind, e.g. 'send_text' / 'send_image'
+            page_id / recipient_id: routing (recipient picks the sender thread)
+            payload: dict of delivery data kept in memory only (text, a spooled
+                upload, ...) - closed by the queue (see _close_payload)
+            fields: extra job fields stored with the status
+
+        Returns:
+            dict: the queued job
+
+        Raises:
+            queue.Full: the recipient's sender is backed up
+        """
+        self._ensure_started()
+        try:
+            job = self.store.create(kind, page_id=page_id, recipient_id=recipient_id, attempts=0, **fields)
+            shard = zlib.crc32(f'{page_id}:{recipient_id}'.encode()) % self.workers
+            try:
+                self._queues[shard].put_nowait(page_id, (job, payload))
+            except queue.Full:
+                self.store.update(job, status='failed', error='Send queue full')
+                raise
+        except BaseException:
+            _close_payload(payload)
+            raise
+        return job
+
+    def _run(self, q):
+        while True:
+            try:
+                page_id, (job, payload) = q.get()
+            except queue.Empty:
+                # Closed and drained
+                break
+            try:
+                self._process(job, payload)
+            except Exception as e:
+                log.exception('Sender error', job_id=job['id'], error=str(e))
+            finally:
+                _close_payload(payload)
+                q.done(page_id)
+                self._release(page_id)
+
+    def _process(self, job, payload):
+        bucket = self.bucket(job['page_id'])
+        response_data = {}
+        error = None
+        outcome = 'failed'
+
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                # The first attempt's token was taken when the fair queue picked this page
+                bucket.acquire()
+            self.store.update(job, status='sending', attempts=attempt)
+            try:
+                status_code, response_data = self.deliver(job, payload)
+            except NOT_SENT_ERRORS as e:
+                status_code, response_data, error = 0, {}, str(e)
+                retry = True
+            except requests.exceptions.RequestException as e:
+                # Read timeout / dropped connection after the request went out
+                response_data, error, outcome = {}, str(e), 'unknown'
+                break
+            else:
+                if status_code == 200:
+                    error = None
+                    break
+                error = response_data.get('error', {}).get('message', 'Unknown Facebook error')
+                if is_ambiguous(status_code, response_data):
+                    outcome = 'unknown'
+                    break
+                retry = is_retryable(status_code, response_data)
+
+            if not retry or attempt == self.max_attempts:
+                break
+            self.retries += 1
+            time.sleep(random.uniform(0, min(30.0, 2 ** (attempt - 1))))
+
+        if error is None:
+            self.sent += 1
+            self.store.update(job, status='sent', message_id=response_data.get('message_id'),
+                              response=response_data, finished_at=time.time())
+        elif outcome == 'unknown':
+            self.unknown += 1
+            self.store.update(job, status='unknown', error=error, response=response_data, finished_at=time.time())
+            log.warning('Send job outcome unknown, not sent again', job_id=job['id'], page_id=job['page_id'],
+                        attempts=job['attempts'], error=error)
+        else:
+            self.failed += 1
+            self.store.update(job, status='failed', error=error, response=response_data, finished_at=time.time())
+            log.error('Send job failed', job_id=job['id'], page_id=job['page_id'], attempts=job['attempts'],
+                      error=error)
+        self.on_done(job, response_data)
+
+    def shutdown(self, timeout=10):
+        """Deliver what is queued, then stop the senders"""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            q.close()
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': sum(q.qsize() for q in self._queues),
+            'pages': merge_stats([q.stats() for q in self._queues]),
+            'sent': self.sent,
+            'failed': self.failed,
+            'unknown': self.unknown,
+            'retries': self.retries,
+            'rate_per_page': self.rate
+        }
+
+
+def _close_payload(payload):
+    """Close the closable values of a job payload (e.g. a SpooledUpload's temp file)"""
+    for value in (payload or {}).values():
+        close = getattr(value, 'close', None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                log.warning('Could not close send payload', error=str(e))
+
+
+# Per-page caps on concurrent bulk sends, shared by all bulk requests
+_page_slots = {}
+_page_slots_lock = threading.Lock()
+
+
+def _page_slot(page_id):
+    with _page_slots_lock:
+        slot = _page_slots.get(page_id)
+        if slot is None:
+            slot = _page_slots[page_id] = threading.BoundedSemaphore(SEND_BULK_CONCURRENCY)
+        return slot
+
+
+def fan_out(page_id, recipients, send_one, bucket=None, concurrency=SEND_BULK_CONCURRENCY):
+    """
+    Send to many recipients with bounded per-page concurrency.
+
+    Args:
+        page_id: Facebook Page ID (concurrency and rate are capped per page)
+        recipients: recipient PSIDs
+        send_one: fn(recipient_id) -> result dict
+        bucket: optional TokenBucket to respect the page's send rate
+
+    Yields:
+        result dicts in completion order
+    """
+    slot = _page_slot(page_id)
+
+    def run(recipient_id):
+        with slot:
+            if bucket:
+                bucket.acquire()
+            try:
+                return send_one(recipient_id)
+            except Exception as e:
+                return {'recipient_id': recipient_id, 'success': False, 'error': str(e)}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(recipients))),
+                                  thread_name_prefix=f'bulk-{page_id}')
+    try:
+        futures = [executor.submit(run, r) for r in recipients]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Client went away - don't start the sends that haven't begun
+        executor.shutdown(wait=False, cancel_futures=True)
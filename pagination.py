@@ -0,0 +1,210 @@
+import os
+import json
+import base64
+from datetime import datetime, timedelta
+
+# ============================================
+# KEYSET PAGINATION + SPARSE FIELDSETS
+# ============================================
+# Cursors are opaque base64 strings of (sort value, id) so a page is
+# fetched with an index range instead of OFFSET, and stays stable while
+# new rows arrive.
+#
+# Delta sync (changes_since) is keyed on created_at / last_message_time,
+# which the app stamps before the write batcher stores the row - maybe
+# from another worker, a moment later. A row can therefore show up after a
+# client's cursor has passed its timestamp. So a delta cursor never moves
+# past now - CHANGES_SETTLE_SECONDS: newer rows are returned, but read
+# again on the next call (clients dedupe by id), and a row stored within
+# that window of its timestamp is never skipped.
+#
+# Settings (env):
+#   CHANGES_SETTLE_SECONDS   how far behind now a delta cursor stays (default 30)
+# ============================================
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+CHANGES_SETTLE_SECONDS = float(os.getenv('CHANGES_SETTLE_SECONDS', '30'))
+
+CONVERSATION_FIELDS = {
+    'id', 'conversation_id', 'platform', 'page_id', 'page_name', 'customer_psid', 'customer_name',
+    'customer_name_fetched', 'last_message_time', 'status'
+}
+MESSAGE_FIELDS = {
+    'id', 'conversation_id', 'platform', 'message_id', 'sender_type', 'sender_psid', 'message_text',
+    'message_type', 'image_url', 'attachment_type', 'replied', 'created_at', 'status'
+}
+
+
+class PaginationError(ValueError):
+    """Bad cursor, limit or fields parameter"""
+
+
+def encode_cursor(value, row_id):
+    raw = json.dumps([value, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (sort value, id)
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return value, row_id
+    except Exception:
+        raise PaginationError('Invalid cursor')
+
+
+def parse_limit(raw):
+    if raw is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def parse_fields(raw, allowed, required=()):
+    """
+    Build a select() column list from a `fields=` parameter.
+
+    Args:
+        raw: comma separated field names, or None for all columns
+        allowed: whitelist of column names
+        required: columns always included (cursor keys)
+
+    Returns:
+        str: column list for select()
+    """
+    if not raw:
+        return '*'
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise PaginationError(f'Unknown fields: {", ".join(unknown)}')
+    for column in required:
+        if column not in fields:
+            fields.append(column)
+    return ','.join(fields)
+
+
+def _quote(value):
+    # PostgREST logic trees need reserved characters (.,:()) quoted
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def keyset_filter(sort_column, id_column, cursor, direction):
+    """
+    PostgREST or() expression for rows strictly before/after a cursor.
+
+    Args:
+        direction: 'lt' for older rows, 'gt' for newer rows
+
+    Returns:
+        str: argument for query.or_()
+    """
+    value, row_id = decode_cursor(cursor)
+    return (f'{sort_column}.{direction}.{_quote(value)},'
+            f'and({sort_column}.eq.{_quote(value)},{id_column}.{direction}.{_quote(row_id)})')
+
+
+def changes_since(query, sort_column, id_column, since, limit):
+    """
+    Rows after a sync cursor, oldest first. Rows from the last
+    CHANGES_SETTLE_SECONDS are returned again by the next call.
+
+    Args:
+        since: cursor from a previous call, or None to start from the beginning
+
+    Returns:
+        dict: {'items': rows, 'cursor': cursor for the next call, 'has_more': bool}
+    """
+    rows = changes_query(query, sort_column, id_column, since, limit).execute().data or []
+    return changes_page(rows, sort_column, id_column, since, limit)
+
+
+def changes_query(query, sort_column, id_column, since, limit):
+    """The filtered, ordered query behind changes_since (for callers that execute it themselves)"""
+    if since:
+        query = query.or_(keyset_filter(sort_column, id_column, since, 'gt'))
+    return query.order(sort_column).order(id_column).limit(limit + 1)
+
+
+def _settled(value, settle_point):
+    """True if a row stamped `value` is older than the settle point"""
+    try:
+        # Stamped with datetime.now() (local wall clock), whatever offset the column reports
+        stamped = datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return True
+    return stamped <= settle_point
+
+
+def changes_page(rows, sort_column, id_column, since, limit):
+    """Shape the rows of a changes_query into the changes_since result"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    settle_point = datetime.now() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    settled = 0
+    while settled < len(rows) and (rows[settled].get(sort_column) is None
+                                   or _settled(rows[settled].get(sort_column), settle_point)):
+        settled += 1
+    if settled < len(rows):
+        # The rest is too recent to pass - the next call reads it again (and anything stored late)
+        has_more = False
+    last = rows[settled - 1] if settled else None
+    cursor = encode_cursor(last.get(sort_column), last.get(id_column)) if last else since
+    return {'items': rows, 'cursor': cursor, 'has_more': has_more}
+
+
+def paginate(query, sort_column, id_column, limit, before=None, after=None, newest_first=True):
+    """
+    Apply keyset ordering/filters to a query and execute it.
+
+    Rows are always returned in display order: newest first when
+    `newest_first`, oldest first otherwise. `before` walks towards older
+    rows, `after` towards newer ones; without a cursor the newest page is
+    returned.
+
+    Returns:
+        dict: {'items': rows, 'before': cursor or None, 'after': cursor or None, 'has_more': bool}
+    """
+    rows = paginate_query(query, sort_column, id_column, limit, before, after).execute().data or []
+    return paginate_page(rows, sort_column, id_column, limit, after, newest_first)
+
+
+def paginate_query(query, sort_column, id_column, limit, before=None, after=None):
+    """The keyset-filtered, ordered query behind paginate (for callers that execute it themselves)"""
+    if before and after:
+        raise PaginationError('Use either before or after, not both')
+
+    if after:
+        query = query.or_(keyset_filter(sort_column, id_column, after, 'gt'))
+        query = query.order(sort_column).order(id_column)
+    else:
+        if before:
+            query = query.or_(keyset_filter(sort_column, id_column, before, 'lt'))
+        query = query.order(sort_column, desc=True).order(id_column, desc=True)
+    return query.limit(limit + 1)
+
+
+def paginate_page(rows, sort_column, id_column, limit, after=None, newest_first=True):
+    """Shape the rows of a paginate_query into the paginate result"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # rows are now nearest-to-cursor first; oldest/newest ends give the next cursors
+    newest_to_oldest = rows if not after else list(reversed(rows))
+    cursors = {'before': None, 'after': None}
+    if newest_to_oldest:
+        newest, oldest = newest_to_oldest[0], newest_to_oldest[-1]
+        cursors['before'] = encode_cursor(oldest.get(sort_column), oldest.get(id_column))
+        cursors['after'] = encode_cursor(newest.get(sort_column), newest.get(id_column))
+
+    items = newest_to_oldest if newest_first else list(reversed(newest_to_oldest))
+    return {'items': items, 'before': cursors['before'], 'after': cursors['after'], 'has_more': has_more}
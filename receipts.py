@@ -0,0 +1,52 @@
+from datetime import datetime
+
+# ============================================
+# DELIVERY / READ RECEIPTS
+# ============================================
+# Facebook sends `delivery` and `read` events carrying a watermark: every
+# message the page sent up to that time was delivered / read. Each one
+# becomes a ranged status update on the conversation's agent messages,
+# queued in the write batcher, which coalesces a burst of receipts into
+# one update per (conversation, status):
+#   delivery:  status 'sent'               -> 'delivered'
+#   read:      status 'sent' / 'delivered' -> 'read'
+# ============================================
+
+# In the order they are applied - 'read' wins over 'delivered'
+RECEIPT_STATUSES = ('delivered', 'read')
+
+
+def parse_receipt(event, page_id):
+    """
+    Conversation, status and watermark of a delivery / read event.
+
+    Returns:
+        tuple: (conversation_id, status, watermark) or None if the event is not a receipt.
+               The watermark is an ISO timestamp comparable with messages.created_at.
+    """
+    if event.get('read'):
+        status, receipt = 'read', event['read']
+    elif event.get('delivery'):
+        status, receipt = 'delivered', event['delivery']
+    else:
+        return None
+    watermark = receipt.get('watermark')
+    sender_id = (event.get('sender') or {}).get('id')
+    if not watermark or not sender_id:
+        return None
+    # created_at is written with datetime.now().isoformat() (local time), so convert the same way
+    watermark = datetime.fromtimestamp(int(watermark) / 1000).isoformat()
+    return f"fb_{page_id}_{sender_id}", status, watermark
+
+
+def mark_receipt(supabase, conversation_id, status, watermark):
+    """Advance the status of every agent message up to `watermark` (one ranged update)"""
+    query = supabase.table('messages').update({'status': status}) \
+        .eq('conversation_id', conversation_id) \
+        .eq('sender_type', 'agent') \
+        .lte('created_at', watermark)
+    if status == 'read':
+        query = query.in_('status', ['sent', 'delivered'])
+    else:
+        query = query.eq('status', 'sent')
+    query.execute()
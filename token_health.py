@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import validate_page_token, log_token_report
+from log import get_logger
+
+# ============================================
+# BACKGROUND TOKEN VALIDATION
+# ============================================
+# Page tokens are checked with debug_token off the boot path: a background
+# thread validates all pages concurrently once the app is up, then again
+# every TOKEN_REFRESH_INTERVAL. Results go to a shared JSON file with a TTL;
+# a worker that finds fresh results there (or another worker holding the
+# lock) skips the Graph calls. /health/tokens reads the file.
+#
+# Settings (env):
+#   TOKEN_STATUS_FILE          shared results file (default token_status.json)
+#   TOKEN_STATUS_TTL           seconds a result stays fresh (default 3600)
+#   TOKEN_REFRESH_INTERVAL     seconds between background checks (default TOKEN_STATUS_TTL)
+#   TOKEN_VALIDATION_WORKERS   concurrent debug_token calls (default 8)
+# ============================================
+
+log = get_logger('token_health')
+
+TOKEN_STATUS_FILE = os.getenv('TOKEN_STATUS_FILE', 'token_status.json')
+TOKEN_STATUS_TTL = int(os.getenv('TOKEN_STATUS_TTL', '3600'))
+TOKEN_REFRESH_INTERVAL = int(os.getenv('TOKEN_REFRESH_INTERVAL', str(TOKEN_STATUS_TTL)))
+TOKEN_VALIDATION_WORKERS = int(os.getenv('TOKEN_VALIDATION_WORKERS', '8'))
+
+
+def _token_hash(access_token):
+    """Results are tied to the token they checked - a replaced token is validated again"""
+    return hashlib.sha256((access_token or '').encode()).hexdigest()[:16]
+
+
+class TokenValidator:
+    """
+    Shared, TTL-cached page token status.
+
+    Args:
+        get_pages: fn() -> {page_id: {'name', 'accessToken'}}
+    """
+
+    def __init__(self, get_pages, path=TOKEN_STATUS_FILE, ttl=TOKEN_STATUS_TTL,
+                 refresh_interval=TOKEN_REFRESH_INTERVAL, workers=TOKEN_VALIDATION_WORKERS):
+        self.get_pages = get_pages
+        self.path = path
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.workers = max(1, workers)
+        self._results = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        # Stats
+        self.validations = 0
+        self.last_run = None
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, results):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(results, f)
+        os.replace(tmp_path, self.path)
+
+    def _is_fresh(self, entry, access_token, now):
+        return bool(entry) and entry.get('token_hash') == _token_hash(access_token) \
+            and now - entry.get('checked_at', 0) < self.ttl
+
+    def refresh(self, force=False):
+        """
+        Validate every page without a fresh shared result, concurrently.
+
+        Returns:
+            dict: {page_id: result} for all configured pages
+        """
+        pages = self.get_pages()
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is validating - use what is shared so far
+                results = self._read()
+                with self._lock:
+                    self._results = results
+                return results
+
+            try:
+                now = time.time()
+                results = self._read()
+                stale = [(page_id, config.get('accessToken')) for page_id, config in pages.items()
+                         if force or not self._is_fresh(results.get(page_id), config.get('accessToken'), now)]
+
+                if stale:
+                    with ThreadPoolExecutor(max_workers=min(self.workers, len(stale))) as executor:
+                        checked = list(executor.map(lambda item: validate_page_token(*item), stale))
+                    now = time.time()
+                    for (page_id, access_token), result in zip(stale, checked):
+                        results[page_id] = dict(result, checked_at=now, token_hash=_token_hash(access_token))
+                    self.validations += len(stale)
+
+                # Drop pages that are no longer configured
+                results = {page_id: result for page_id, result in results.items() if page_id in pages}
+                if stale:
+                    self._write(results)
+                    log_token_report({page_id: results[page_id] for page_id, _ in stale})
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        with self._lock:
+            self._results = results
+            self.last_run = time.time()
+        return results
+
+    def start(self):
+        """Validate in the background now and every refresh_interval"""
+        if self._pid == os.getpid() and self._thread:
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='token-validation', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.warning('Token validation failed', error=str(e))
+            if self.refresh_interval <= 0:
+                break
+            time.sleep(self.refresh_interval)
+
+    def status(self):
+        """
+        Token status per page for /health/tokens (never includes the token).
+
+        Returns:
+            dict: {'healthy', 'pages': {page_id: {...}}}
+        """
+        pages = self.get_pages()
+        shared = self._read() or self._results
+        now = time.time()
+        report = {}
+        for page_id, config in pages.items():
+            entry = shared.get(page_id)
+            if not entry or entry.get('token_hash') != _token_hash(config.get('accessToken')):
+                report[page_id] = {'name': config.get('name'), 'valid': None, 'checked': False}
+                continue
+            data = entry.get('data') or {}
+            report[page_id] = {
+                'name': config.get('name'),
+                'valid': entry.get('valid'),
+                'checked': True,
+                'error': entry.get('error'),
+                'type': data.get('type'),
+                'expires_at': data.get('expires_at'),
+                'expiry_message': data.get('expiry_message'),
+                'checked_at': entry.get('checked_at'),
+                'stale': now - entry.get('checked_at', 0) >= self.ttl
+            }
+        return {
+            'healthy': all(p['valid'] is not False for p in report.values()),
+            'pages': report
+        }
+
+    def stats(self):
+        return {
+            'validations': self.validations,
+            'last_run': self.last_run,
+            'ttl': self.ttl,
+            'refresh_interval': self.refresh_interval
+        }
@@ -0,0 +1,273 @@
+import os
+import time
+import fcntl
+import sqlite3
+import threading
+from datetime import datetime
+from cache import CACHE_DB_PATH
+from log import get_logger
+
+# ============================================
+# UNREPLIED COUNTERS
+# ============================================
+# Unreplied customer messages per conversation, in a SQLite table shared
+# by every gunicorn worker (so each worker returns the same counts):
+#   - the webhook records each inbound message by message_id, so a journal
+#     replay of an event that was already counted doesn't count it twice
+#   - send_message / send_image mark the conversation's messages up to the
+#     reply time as replied and advance the reply watermark in Supabase
+#     (customer messages up to it are flipped to replied=True)
+#   - rebuild() reconciles the table with Supabase, using the latest agent
+#     message of each conversation as the watermark for existing data. It
+#     runs in one worker at a time (file lock), at most once per interval
+#     across all workers, and only clears messages counted more than
+#     RECONCILE_GRACE seconds before it started, so messages still on their
+#     way through the write batcher keep their count.
+#
+# Settings (env):
+#   UNREPLIED_REBUILD_INTERVAL   seconds between background reconciliations
+#                                with Supabase (default 300, 0 = only the first build)
+#   UNREPLIED_DB_PATH            SQLite file shared by workers (default CACHE_DB_PATH)
+# ============================================
+
+log = get_logger('unreplied')
+
+UNREPLIED_REBUILD_INTERVAL = int(os.getenv('UNREPLIED_REBUILD_INTERVAL', '300'))
+UNREPLIED_DB_PATH = os.getenv('UNREPLIED_DB_PATH', CACHE_DB_PATH)
+
+# Seconds a counted message is safe from reconciliation (its row may not be stored yet)
+RECONCILE_GRACE = 60
+# Seconds replied messages are remembered (a late replay of them is not counted again)
+REPLIED_RETENTION = 7 * 24 * 3600
+
+
+def split_conversation_id(conversation_id):
+    """
+    Split 'fb_{page_id}_{psid}' into (page_id, psid).
+
+    Returns:
+        tuple or None if the id has another format
+    """
+    parts = conversation_id.split('_', 2)
+    if len(parts) != 3 or parts[0] != 'fb':
+        return None
+    return parts[1], parts[2]
+
+
+def _scan(supabase, table, columns, where, page_size=1000):
+    """Page through matching rows by id (keyset, so each page is an index range)"""
+    last_id = None
+    while True:
+        query = where(supabase.table(table).select(f'id, {columns}'))
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        rows = query.order('id').limit(page_size).execute().data or []
+        yield from rows
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1]['id']
+
+
+class UnrepliedCounters:
+    """Unreplied messages per conversation shared by workers, keyed for the dashboard as 'pageId_psid'"""
+
+    def __init__(self, path=UNREPLIED_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS unreplied_messages ('
+                     'message_id TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, created_at TEXT NOT NULL, '
+                     'replied INTEGER NOT NULL DEFAULT 0, counted_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS unreplied_conversation_idx '
+                     'ON unreplied_messages (conversation_id, replied, created_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS unreplied_rebuilds ('
+                     'id INTEGER PRIMARY KEY CHECK (id = 1), finished_at REAL NOT NULL, finished TEXT NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def increment(self, conversation_id, message_id, created_at):
+        """
+        Count an inbound message (once per message_id).
+
+        Returns:
+            int: the conversation's unreplied count
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR IGNORE INTO unreplied_messages (message_id, conversation_id, created_at, '
+                         'counted_at) VALUES (?, ?, ?, ?)', (message_id, conversation_id, created_at, time.time()))
+            count = conn.execute('SELECT COUNT(*) FROM unreplied_messages WHERE conversation_id = ? AND replied = 0',
+                                 (conversation_id,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.prune()
+        return count
+
+    def reset(self, conversation_id, watermark):
+        """Mark the conversation's messages up to `watermark` (the reply time) as replied"""
+        self._conn().execute('UPDATE unreplied_messages SET replied = 1 WHERE conversation_id = ? AND replied = 0 '
+                             'AND created_at <= ?', (conversation_id, watermark))
+
+    def get(self, conversation_id):
+        return self._conn().execute('SELECT COUNT(*) FROM unreplied_messages WHERE conversation_id = ? '
+                                    'AND replied = 0', (conversation_id,)).fetchone()[0]
+
+    def prune(self):
+        self._conn().execute('DELETE FROM unreplied_messages WHERE replied = 1 AND counted_at < ?',
+                             (time.time() - REPLIED_RETENTION,))
+
+    @property
+    def ready(self):
+        """True once any worker has built the counters"""
+        return self._last_rebuild() is not None
+
+    @property
+    def last_rebuild(self):
+        row = self._last_rebuild()
+        return row[1] if row else None
+
+    def _last_rebuild(self):
+        return self._conn().execute('SELECT finished_at, finished FROM unreplied_rebuilds WHERE id = 1').fetchone()
+
+    def snapshot(self):
+        """
+        Counts for conversations with unreplied messages.
+
+        Returns:
+            dict: "pageId_psid" -> count
+        """
+        rows = self._conn().execute('SELECT conversation_id, COUNT(*) FROM unreplied_messages WHERE replied = 0 '
+                                    'GROUP BY conversation_id').fetchall()
+        counts = {}
+        for conversation_id, count in rows:
+            ids = split_conversation_id(conversation_id)
+            if ids:
+                counts[f'{ids[0]}_{ids[1]}'] = count
+        return counts
+
+    def rebuild(self, supabase, persist=False, min_interval=None):
+        """
+        Reconcile the counters with Supabase.
+
+        A conversation's watermark is its latest agent message; customer
+        messages still marked replied=False but created before it count as
+        replied. With persist=True those messages are flipped in the
+        database too (one ranged update per conversation), which is the
+        one-time migration for data stored before watermarks existed.
+
+        Args:
+            supabase: Supabase client
+            persist: write replied=True below each watermark
+            min_interval: skip (return None) if another worker is rebuilding
+                          or one finished less than this many seconds ago
+
+        Returns:
+            int or None: number of conversations with unreplied messages, None if skipped
+        """
+        with open(f'{self.path}.unreplied.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (fcntl.LOCK_NB if min_interval is not None else 0))
+            except BlockingIOError:
+                return None
+            try:
+                last = self._last_rebuild()
+                if min_interval is not None and last and time.time() - last[0] < min_interval:
+                    return None
+                return self._rebuild(supabase, persist)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rebuild(self, supabase, persist):
+        started = time.time()
+        candidates = {}
+        for row in _scan(supabase, 'messages', 'message_id, conversation_id, created_at',
+                         lambda q: q.eq('sender_type', 'customer').eq('replied', False)):
+            if row.get('message_id'):
+                candidates[row['message_id']] = (row['conversation_id'], row.get('created_at') or '')
+
+        watermarks = _agent_watermarks(supabase, candidates.values())
+        unreplied = {}
+        stale = set()
+        for message_id, (conversation_id, created_at) in candidates.items():
+            if created_at <= watermarks.get(conversation_id, ''):
+                stale.add(conversation_id)
+            else:
+                unreplied[message_id] = (conversation_id, created_at)
+
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO unreplied_messages (message_id, conversation_id, created_at, '
+                             'counted_at) VALUES (?, ?, ?, ?)',
+                             [(message_id, conversation_id, created_at, started)
+                              for message_id, (conversation_id, created_at) in unreplied.items()])
+            # Counted here but replied (or gone) in Supabase - only messages old enough to be stored by now
+            counted = conn.execute('SELECT message_id FROM unreplied_messages WHERE replied = 0 AND counted_at < ?',
+                                   (started - RECONCILE_GRACE,)).fetchall()
+            conn.executemany('UPDATE unreplied_messages SET replied = 1 WHERE message_id = ?',
+                             [(message_id,) for message_id, in counted if message_id not in unreplied])
+            conn.execute('INSERT OR REPLACE INTO unreplied_rebuilds (id, finished_at, finished) VALUES (1, ?, ?)',
+                         (time.time(), datetime.now().isoformat()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if persist:
+            for conversation_id in stale:
+                mark_replied(supabase, conversation_id, watermarks[conversation_id])
+
+        conversations = len(self.snapshot())
+        log.info('Unreplied counters rebuilt', conversations=conversations,
+                 watermarks_persisted=len(stale) if persist else None)
+        return conversations
+
+
+def _agent_watermarks(supabase, candidates, chunk_size=100):
+    """
+    Latest agent message time of each conversation with unreplied candidates.
+    Only agent messages at or after the conversation chunk's oldest
+    candidate can make one of them stale, so older ones are not read.
+
+    Args:
+        candidates: iterable of (conversation_id, created_at)
+    """
+    oldest = {}
+    for conversation_id, created_at in candidates:
+        if created_at < oldest.get(conversation_id, created_at + '~'):
+            oldest[conversation_id] = created_at
+    conversation_ids = sorted(oldest)
+    watermarks = {}
+    for start in range(0, len(conversation_ids), chunk_size):
+        chunk = conversation_ids[start:start + chunk_size]
+        since = min(oldest[conversation_id] for conversation_id in chunk)
+        for row in _scan(supabase, 'messages', 'conversation_id, created_at',
+                         lambda q: q.eq('sender_type', 'agent').in_('conversation_id', chunk).gte('created_at', since)):
+            created_at = row.get('created_at') or ''
+            if created_at > watermarks.get(row['conversation_id'], ''):
+                watermarks[row['conversation_id']] = created_at
+    return watermarks
+
+
+def mark_replied(supabase, conversation_id, watermark):
+    """Flip every customer message up to `watermark` to replied=True (one ranged update)"""
+    supabase.table('messages').update({'replied': True}) \
+        .eq('conversation_id', conversation_id) \
+        .eq('sender_type', 'customer') \
+        .eq('replied', False) \
+        .lte('created_at', watermark) \
+        .execute()